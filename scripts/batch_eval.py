@@ -5,120 +5,168 @@ it runs over all queries in query.text and get the top 10 results,
 and then qrels.text is used to compute the NDCG metric
 
 usage:
-    python batch_eval.py index_file query.text qrels.text n
+    python batch_eval.py index_file query.text qrels.text n [--workers N] [--profile] [--profile-dump FILE]
 
-    output is the average NDCG over all the queries for boolean model and vector model respectively.
-	also compute the p-value of the two ranking results. 
+    output is the average NDCG over all the queries for boolean model, vector model and BM25 respectively,
+	with their mean latency per query. also compute the p-value of the ranking results. 
+    P@k, recall@k, MAP and MRR, and the paired t-test and permutation test p-values, are also reported.
+    --workers N ranks the queries in N processes sharing the memory-mapped index, with the same results.
+    --profile prints the time spent in each query stage, and --profile-dump FILE writes it as JSON (see timing.py)
 '''
 
 import sys
 import doc
-import math
-import scipy
+import time
 import random
 import warnings
+import multiprocessing
 
 from util import *
 from index import *
 from query import *
-from metrics import *
+from evaluation import evaluate, significance, MEASURES
 from cranqry import *
-
-def batch_eval(qrys, query_Ids, query_qrels_mapping, qrels_dict, invertedIndex, collection, k):
-    # Instantiate the QueryProcessor
-    queryProcessor = QueryProcessor("None", invertedIndex, collection)
-    
-    # Initialize Boolean and Vector NDCG Scores
-    boolean_ndcg_scores = []
-    total_boolean_ndcg_scores = 0
-
-    vector_ndcg_scores = []
-    total_vector_ndcg_scores = 0
-
+from timing import QueryTimer, StageProfile, NULL_TIMER
+
+def timed(queryProcessor, profile, queryId, model, function, *args):
+    ''' call function(*args), recording the stages of queryProcessor in profile when profiling'''
+    if profile is None:
+        return function(*args)
+    queryProcessor.timer = QueryTimer()
+    try:
+        return function(*args)
+    finally:
+        profile.add(queryId, model, queryProcessor.timer)
+        queryProcessor.timer = NULL_TIMER
+
+def rankQueries(queryProcessor, qrys, query_Ids, k, profile=None, verbose=True):
+    ''' the Boolean, Vector and BM25 rankings (lists of docIDs) of each query, in query_Ids order, and the time spent in each model'''
+    # Preprocess ALL raw queries
+    preprocessed_queries = []
     for queryId in query_Ids:
-        print("Processing QueryID: {}".format(queryId))
-
-        # Get the corresponding qrels_Id of the queryId
-        qrels_Id = query_qrels_mapping[queryId]
-
-        # Get the corresponding list of relevant qrels docs 
-        list_of_relevant_qrels_docs = qrels_dict[qrels_Id]
-
         queryProcessor.raw_query = qrys[str(queryId)].text
-    
-        # Preprocess the raw query
-        preprocessed_query, preprocessed_query_with_positions = queryProcessor.preprocessing()
-
-        # Score the preprocessed_query with Boolean Model
-        y_true_boolean = []
-        y_score_boolean = []
-
-        list_of_docIDs = queryProcessor.booleanQuery(preprocessed_query)
-
-        if list_of_docIDs:
-            for docID in list_of_docIDs:
-                if docID not in list_of_relevant_qrels_docs:
-                    y_true_boolean.append(0)
-                else:
-                    y_true_boolean.append(1)
-                y_score_boolean.append(1)
-            
-            while len(y_true_boolean) != k:
-                y_true_boolean.append(0)
-                y_score_boolean.append(0)
-            
-            boolean_ndcg_score = ndcg_score(y_true_boolean, y_score_boolean, k) 
-            if math.isnan(boolean_ndcg_score):
-                boolean_ndcg_score = float(0)
-            
-            boolean_ndcg_scores.append(boolean_ndcg_score)
-            total_boolean_ndcg_scores += boolean_ndcg_score
-
-            #print("QueryID: {}\tBoolean NDCG: {}".format(queryId, round(boolean_ndcg_score, 5)))
-            
-        else:
-            boolean_ndcg_scores.append(float(0))
-            total_boolean_ndcg_scores += float(0)
-
-        # Score the preprocessed_query with Vector Model 
-        y_true_vector = []
-        y_score_vector = []
-
-        top_k_pairs = queryProcessor.vectorQuery(preprocessed_query, k, test=0)
-        
-        for pair in top_k_pairs:
-            if pair[0] not in list_of_relevant_qrels_docs:
-                y_true_vector.append(0)
-            else:
-                y_true_vector.append(1)
-            y_score_vector.append(pair[1])
-        
-        vector_ndcg_score = ndcg_score(y_true_vector, y_score_vector, k)
-        if math.isnan(vector_ndcg_score):
-            vector_ndcg_score = float(0)
-
-        vector_ndcg_scores.append(vector_ndcg_score)
-        total_vector_ndcg_scores += vector_ndcg_score
-
-        #print("QueryID: {}\tNDCG Score: {}".format(queryId, round(vector_ndcg_score, 5)))
+        preprocessed_queries.append(timed(queryProcessor, profile, queryId, "preprocessing", queryProcessor.preprocessing)[0])
+
+    # Retrieve ALL queries with Boolean Model; the unranked docIDs are taken in docID order
+    boolean_rankings = []
+    boolean_time = 0.0
+    for queryId, preprocessed_query in zip(query_Ids, preprocessed_queries):
+        if verbose:
+            print("Processing QueryID: {}".format(queryId))
+        start = time.time()
+        boolean_rankings.append(timed(queryProcessor, profile, queryId, "0", queryProcessor.booleanQuery, preprocessed_query))
+        boolean_time += time.time() - start
+
+    # Score ALL queries with Vector Model at once, using the sparse matrix backend
+    start = time.time()
+    vector_top_k_pairs = timed(queryProcessor, profile, "batch", "1", queryProcessor.batchVectorQuery, preprocessed_queries, k)
+    vector_time = time.time() - start
+
+    # Rank ALL queries with BM25
+    start = time.time()
+    bm25_top_k_pairs = [timed(queryProcessor, profile, queryId, "2", queryProcessor.bm25Query, preprocessed_query, k)
+                        for queryId, preprocessed_query in zip(query_Ids, preprocessed_queries)]
+    bm25_time = time.time() - start
+
+    vector_rankings = [[docid for docid, _ in pairs] for pairs in vector_top_k_pairs]
+    bm25_rankings = [[docid for docid, _ in pairs] for pairs in bm25_top_k_pairs]
+    return boolean_rankings, vector_rankings, bm25_rankings, [boolean_time, vector_time, bm25_time]
+
+# The state shared with the worker processes of a parallel evaluation. It is set before the pool is created, so that
+# forked workers inherit it: the memory-mapped index and the cached TF-IDF matrix are shared, never pickled
+_shared = None
+
+def rankShard(query_Ids):
+    ''' rank a shard of queries in a worker process; returns the rankings, the model times and the profiled stages'''
+    queryProcessor, qrys, k, profiling = _shared
+    profile = StageProfile() if profiling else None
+    rankings = rankQueries(queryProcessor, qrys, query_Ids, k, profile, False)
+    return rankings, profile.queries if profile is not None else []
+
+def shards(query_Ids, n):
+    ''' split query_Ids into n contiguous shards of about the same size'''
+    size = (len(query_Ids) + n - 1) // n
+    return [query_Ids[i:i + size] for i in range(0, len(query_Ids), size)]
+
+def batch_eval(qrys, query_Ids, query_qrels_mapping, qrels_dict, invertedIndex, collection, k, profile=None, workers=1):
+    ''' evaluate the queries with the three models; with several workers, contiguous shards of the queries are
+        ranked by a pool of forked processes and gathered in query order, so the results are those of the serial run.
+        The rankings of all the queries are then evaluated at once with evaluation.py'''
+    global _shared
 
-    # Compute the Average NDCG Scores for both Boolean and Vector Models
-    average_boolean_ndcg_scores = total_boolean_ndcg_scores / len(boolean_ndcg_scores)
-    average_vector_ndcg_scores = total_vector_ndcg_scores / len(vector_ndcg_scores)
+    # Instantiate the QueryProcessor
+    queryProcessor = QueryProcessor("None", invertedIndex, collection)
 
-    # Compute the p-value using wilcoxon-test on Boolean and Vector NDCGs
+    start = time.time()
+    if workers <= 1 or len(query_Ids) <= 1:
+        boolean_rankings, vector_rankings, bm25_rankings, times = rankQueries(queryProcessor, qrys, query_Ids, k, profile)
+    else:
+        # Build the TF-IDF matrix of the batch Vector scoring once, before forking
+        invertedIndex.tfidfMatrix()
+        _shared = (queryProcessor, qrys, k, profile is not None)
+        pool = multiprocessing.Pool(min(workers, len(query_Ids)))
+        try:
+            results = pool.map(rankShard, shards(query_Ids, min(workers, len(query_Ids))))
+        finally:
+            pool.close()
+            pool.join()
+            _shared = None
+
+        boolean_rankings, vector_rankings, bm25_rankings, times = [], [], [], [0.0, 0.0, 0.0]
+        for (booleans, vectors, bm25s, shard_times), stages in results:
+            boolean_rankings.extend(booleans)
+            vector_rankings.extend(vectors)
+            bm25_rankings.extend(bm25s)
+            times = [total + shard_time for total, shard_time in zip(times, shard_times)]
+            if profile is not None:
+                profile.queries.extend(stages)
+    elapsed = time.time() - start
+    boolean_time, vector_time, bm25_time = times
+
+    # Evaluate the rankings of ALL queries against their relevant qrels docs at once
+    start = time.time()
+    qrels = [qrels_dict[query_qrels_mapping[queryId]] for queryId in query_Ids]
+    boolean_measures = evaluate(boolean_rankings, qrels, k)
+    vector_measures = evaluate(vector_rankings, qrels, k)
+    bm25_measures = evaluate(bm25_rankings, qrels, k)
+
+    # Compute the p-values of the paired tests on Boolean and Vector NDCGs, and on Vector and BM25 NDCGs
     warnings.simplefilter("ignore") # Ignore SciPy warnings when computing Wilcoxon with zero-values Boolean NDCG vector
-    p_value = scipy.stats.wilcoxon(boolean_ndcg_scores, vector_ndcg_scores)[1]
-
-    print("\nAvg. Boolean NDCG Scores:\t{}".format(round(average_boolean_ndcg_scores, 5)))
-    print("Avg. Vector  NDCG Scores:\t{}".format(round(average_vector_ndcg_scores, 5)))
-    print("Wilcoxon Test P-Value:\t\t{}\n".format(p_value))
+    tests = significance(boolean_measures["ndcg"], vector_measures["ndcg"])
+    bm25_tests = significance(vector_measures["ndcg"], bm25_measures["ndcg"])
+    p_value = tests["wilcoxon"]
+    metrics_time = time.time() - start
+
+    print("\nAvg. Boolean NDCG Scores:\t{}\tMean latency: {:.3f} ms".format(round(boolean_measures["ndcg"].mean(), 5), 1000 * boolean_time / len(query_Ids)))
+    print("Avg. Vector  NDCG Scores:\t{}\tMean latency: {:.3f} ms (batch)".format(round(vector_measures["ndcg"].mean(), 5), 1000 * vector_time / len(query_Ids)))
+    print("Avg. BM25    NDCG Scores:\t{}\tMean latency: {:.3f} ms".format(round(bm25_measures["ndcg"].mean(), 5), 1000 * bm25_time / len(query_Ids)))
+    print("Wilcoxon Test P-Value:\t\t{}".format(p_value))
+    print("Wilcoxon Test P-Value (Vector vs BM25):\t{}".format(bm25_tests["wilcoxon"]))
+    print("Evaluation time: {:.3f} s with {} worker(s), metrics: {:.3f} ms\n".format(elapsed, max(workers, 1), 1000 * metrics_time))
+
+    print("Model\tNDCG@{0}\tP@{0}\tR@{0}\tMAP\tMRR".format(k))
+    for name, measures in (("Boolean", boolean_measures), ("Vector", vector_measures), ("BM25", bm25_measures)):
+        print("{}\t{}".format(name, "\t".join(["{:.5f}".format(measures[measure].mean()) for measure in MEASURES])))
+    print("\nNDCG p-values\t\tWilcoxon\tPaired t\tPermutation")
+    for name, comparison in (("Boolean vs Vector", tests), ("Vector vs BM25", bm25_tests)):
+        print("{}\t{:.3g}\t\t{:.3g}\t\t{:.3g}".format(name, comparison["wilcoxon"], comparison["ttest"], comparison["permutation"]))
+    print("")
 
     if p_value < 0.05:
         print("There is significant difference between Boolean and Vector Retrieval Model!")
     else:
         print("There is NO significant difference between Boolean and Vector Retrieval Model!")
 
+def reportStages(profile):
+    ''' print the stage times of the preprocessing and of each model separately'''
+    for model, name in (("preprocessing", "Preprocessing"), ("0", "Boolean"), ("1", "Vector (one batch)"), ("2", "BM25")):
+        stages = StageProfile()
+        for queryId, queryModel, timer in profile.queries:
+            if queryModel == model:
+                stages.add(queryId, queryModel, timer)
+        print("\n{}".format(name))
+        stages.report()
+
 def eval():
     # ToDo (Done)
     # Parse the commandline
@@ -129,6 +177,12 @@ def eval():
     # Number of randomly selected queries from query_text
     n = sys.argv[4]
 
+    # Per-stage timing of the queries
+    options = sys.argv[5:]
+    profile_dump = options[options.index("--profile-dump") + 1] if "--profile-dump" in options[:-1] else None
+    profile = StageProfile() if "--profile" in options or profile_dump else None
+    workers = int(options[options.index("--workers") + 1]) if "--workers" in options[:-1] else 1
+
     # Top K pairs
     # k = int(input("Top K Pairs? "))
     k = 10
@@ -171,7 +225,7 @@ def eval():
         rand_query_Ids = [qrels_query_mapping[qid] for qid in rand_qrels_Id]
 
         # N queries evaluation
-        batch_eval(qrys, rand_query_Ids, query_qrels_mapping, qrels_dict, invertedIndex, cf.collection, k)
+        batch_eval(qrys, rand_query_Ids, query_qrels_mapping, qrels_dict, invertedIndex, cf.collection, k, profile, workers)
         
     else:
         ### BATCH QUERIES PROCESSING ###
@@ -180,7 +234,12 @@ def eval():
         query_Ids = sorted([int(queryId) for queryId in query_Ids])
 
         # ALL queries evaluation
-        batch_eval(qrys, query_Ids, query_qrels_mapping, qrels_dict, invertedIndex, cf.collection, k)
+        batch_eval(qrys, query_Ids, query_qrels_mapping, qrels_dict, invertedIndex, cf.collection, k, profile, workers)
+
+    if "--profile" in options:
+        reportStages(profile)
+    if profile_dump:
+        profile.dump(profile_dump)
 
     print('Done')
 
@@ -0,0 +1,360 @@
+'''
+benchmarks for the search engine
+
+usage:
+    python benchmark.py memory cran.all
+    python benchmark.py pruning index_file query.text k
+    python benchmark.py phrase index_file query.text
+    python benchmark.py impact index_file query.text qrels.text k [budget ...]
+    python benchmark.py suite cran.all query.text results.json [scale ...]
+    python benchmark.py compare baseline.json results.json [tolerance]
+
+    memory:     compare the memory used by the compact array-backed posting lists
+                with the former layout of one Posting object per (term, document) pair
+    pruning:    compare the latency of exhaustive and WAND top k vector retrieval over
+                all queries, checking that both return the same results
+    phrase:     compare the latency of phrase and NEAR/5 queries with the Boolean AND of the same
+                terms, for the first two words (after stopword removal) of every query
+    impact:     compare exhaustive top k vector retrieval with score-at-a-time evaluation of the
+                impact-ordered postings, until the top k is final and within each posting budget
+                (default 1000, 500 and 250): latency, postings scored, NDCG@k and overlap of the top k
+    suite:      measure the indexing throughput, the save and load times, the index size on disk and in
+                memory, and the latency percentiles of the Boolean, Vector and BM25 models over all queries,
+                for the collection scaled up by each scale factor (default 1), and write them as JSON
+    compare:    compare a suite run with a baseline run, listing the metrics worse by more than
+                tolerance (default 0.1, i.e. 10%); exits with status 1 if there is any regression
+'''
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+
+from array import array
+from cran import CranFile
+from doc import Document
+from corpus import readCorpus
+from index import InvertedIndex, IndexItem, buildIndex
+from symspell import spellFilename
+from query import QueryProcessor
+from cranqry import loadCranQry, qidMapping
+from timing import QueryTimer
+from evaluation import evaluate
+
+class LegacyPosting:
+    ''' the former Posting: one object, with its own positions list, per (term, document) pair'''
+    def __init__(self, docID):
+        self.docID = docID
+        self.positions = []
+
+class LegacyIndexItem:
+    ''' the former IndexItem: a dict of Postings plus a parallel sorted_postings list'''
+    def __init__(self, term):
+        self.term = term
+        self.posting = {}
+        self.sorted_postings = []
+
+    def add(self, docid, pos):
+        if docid not in self.posting:
+            self.posting[docid] = LegacyPosting(docid)
+        self.posting[docid].positions.append(pos)
+
+    def sort(self):
+        self.sorted_postings = sorted(self.posting)
+        for docid in self.sorted_postings:
+            self.posting[docid].positions.sort()
+
+def deep_sizeof(obj, seen=None):
+    ''' approximate the memory used by an object and everything it references'''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(elem, seen) for elem in obj)
+    elif isinstance(obj, array):
+        pass # the items are stored inline in the array buffer
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+def rebuild(invertedIndex, item_class):
+    ''' rebuild the posting lists of an index with the given IndexItem layout'''
+    items = {}
+    for term in invertedIndex.items:
+        source = invertedIndex.items[term]
+        items[term] = item_class(term)
+        for posting in source.postings():
+            for pos in posting.positions:
+                items[term].add(posting.docID, pos)
+        items[term].sort()
+    return items
+
+def memory():
+    cf = CranFile(sys.argv[2])
+
+    print("Indexing {} documents...".format(len(cf.docs)))
+    invertedIndex = InvertedIndex()
+    for doc in cf.docs:
+        invertedIndex.indexDoc(doc)
+
+    results = []
+    for name, item_class in (("legacy (Posting objects)", LegacyIndexItem), ("compact (typed arrays)", IndexItem)):
+        items = rebuild(invertedIndex, item_class)
+        gc.collect()
+        results.append((name, len(items), deep_sizeof(items)))
+        del items
+
+    for name, nTerms, size in results:
+        print("{:<26}\t#Terms: {}\tMemory: {:.2f} MB".format(name, nTerms, size / (1024.0 * 1024.0)))
+    print("Compact / legacy memory ratio: {:.3f}".format(float(results[1][2]) / results[0][2]))
+
+def preprocessQueries(invertedIndex, query_text):
+    ''' return the preprocessed queries of query_text, in queryID order'''
+    qrys = loadCranQry(query_text)
+    queryProcessor = QueryProcessor("None", invertedIndex, None)
+    preprocessed_queries = []
+    for queryId in sorted(qrys, key=int):
+        queryProcessor.raw_query = qrys[queryId].text
+        preprocessed_queries.append(queryProcessor.preprocessing()[0])
+    return preprocessed_queries
+
+def pruning():
+    invertedIndex = InvertedIndex()
+    invertedIndex.load(sys.argv[2])
+    preprocessed_queries = preprocessQueries(invertedIndex, sys.argv[3])
+    k = int(sys.argv[4])
+
+    results = {}
+    for strategy in ("exhaustive", "wand"):
+        queryProcessor = QueryProcessor("None", invertedIndex, None, strategy)
+        start = time.time()
+        results[strategy] = [queryProcessor.vectorQuery(preprocessed_query, k, 0) for preprocessed_query in preprocessed_queries]
+        elapsed = time.time() - start
+        print("{:<10}	#Queries: {}	Total: {:.3f} s	Mean latency: {:.3f} ms".format(strategy, len(preprocessed_queries), elapsed, 1000 * elapsed / len(preprocessed_queries)))
+
+    print("Identical top {} results: {}".format(k, results["exhaustive"] == results["wand"]))
+
+def loadQrels(qrels_text, queryIds):
+    ''' the relevant docIDs of each query of query.text, in the order of queryIds'''
+    query_qrels_mapping, _ = qidMapping()
+    relevant = {}
+    with open(qrels_text) as f:
+        for line in f:
+            if line.split():
+                relevant.setdefault(int(line.split()[0]), []).append(int(line.split()[1]))
+    return [relevant.get(query_qrels_mapping[queryId], []) for queryId in queryIds]
+
+def impacts():
+    invertedIndex = InvertedIndex()
+    invertedIndex.load(sys.argv[2])
+    preprocessed_queries = preprocessQueries(invertedIndex, sys.argv[3])
+    qrels = loadQrels(sys.argv[4], sorted([int(queryId) for queryId in loadCranQry(sys.argv[3])]))
+    k = int(sys.argv[5])
+    budgets = [int(budget) for budget in sys.argv[6:]] or [1000, 500, 250]
+    invertedIndex.impactIndex() # loaded, or built if the index has none, before timing
+
+    exhaustive = None
+    for name, strategy, budget in [("exhaustive", "exhaustive", None), ("impact", "impact", None)] + [("impact/{}".format(budget), "impact", budget) for budget in budgets]:
+        queryProcessor = QueryProcessor("None", invertedIndex, None, strategy, budget=budget)
+        timing = latencies(lambda preprocessed_query : queryProcessor.vectorQuery(preprocessed_query, k, 0), preprocessed_queries)
+
+        # The rankings, counting the postings scored
+        queryProcessor.timer = QueryTimer()
+        rankings = [[docid for docid, _ in queryProcessor.vectorQuery(preprocessed_query, k, 0)] for preprocessed_query in preprocessed_queries]
+        exhaustive = exhaustive or rankings
+        overlap = sum([len(set(ranking) & set(reference)) / float(max(len(reference), 1)) for ranking, reference in zip(rankings, exhaustive)])
+        print("{:<12}	Mean latency: {:.3f} ms	p90: {:.3f} ms	Postings: {:.1f}	NDCG@{}: {:.5f}	Overlap: {:.3f}".format(
+              name, timing["mean_ms"], timing["p90_ms"], float(queryProcessor.timer.counts.get("postings", 0)) / len(preprocessed_queries),
+              k, evaluate(rankings, qrels, k)["ndcg"].mean(), overlap / len(preprocessed_queries)))
+
+def phrase():
+    invertedIndex = InvertedIndex()
+    invertedIndex.load(sys.argv[2])
+    analyzer = invertedIndex.analyzer
+    qrys = loadCranQry(sys.argv[3])
+
+    # The first two words of each query, adjacent once stopwords are removed
+    pairs = []
+    for queryId in sorted(qrys, key=int):
+        words = [word for word in analyzer.tokenize(qrys[queryId].text) if not analyzer.isStopWord(word)]
+        if len(words) >= 2:
+            pairs.append(words[:2])
+
+    queryProcessor = QueryProcessor("None", invertedIndex, None)
+    queries = [
+        ("AND", lambda pair: queryProcessor.booleanQuery(analyzer.analyzeTokens(pair))),
+        ("Phrase", lambda pair: positional(queryProcessor, '"{} {}"'.format(*pair))),
+        ("NEAR/5", lambda pair: positional(queryProcessor, "{} NEAR/5 {}".format(*pair))),
+    ]
+    # Decode the posting lists first, so that every run measures query evaluation only
+    for pair in pairs:
+        queries[0][1](pair)
+
+    for name, evaluate in queries:
+        start = time.time()
+        matches = sum([len(evaluate(pair)) for pair in pairs])
+        elapsed = time.time() - start
+        print("{:<8}	#Queries: {}	Mean #Docs: {:.1f}	Mean latency: {:.3f} ms".format(name, len(pairs), float(matches) / len(pairs), 1000 * elapsed / len(pairs)))
+
+def positional(queryProcessor, query):
+    queryProcessor.raw_query = query
+    return queryProcessor.expressionQuery()
+
+def scaledCorpus(filename, scale):
+    ''' the documents of a collection repeated scale times. Every copy after the first gets new docIDs
+        and its body words shuffled, so that the vocabulary and the document frequencies grow with it'''
+    docs = list(readCorpus(filename))
+    offset = max([int(doc.docID) for doc in docs])
+    for copy in range(scale):
+        rand = random.Random(copy)
+        for doc in docs:
+            if copy == 0:
+                yield doc
+                continue
+            words = doc.body.split()
+            rand.shuffle(words)
+            yield Document(str(copy * offset + int(doc.docID)), doc.title, doc.author, " ".join(words))
+
+def percentile(values, p):
+    ''' the nearest-rank p-th percentile of a list of values'''
+    ordered = sorted(values)
+    return ordered[max(int(round(p / 100.0 * len(ordered))) - 1, 0)]
+
+def latencies(evaluate, queries):
+    ''' the mean and percentile latencies, in ms, of evaluate over all queries, after a warm-up pass'''
+    for query in queries:
+        evaluate(query)
+    times = []
+    for query in queries:
+        start = time.time()
+        evaluate(query)
+        times.append(1000 * (time.time() - start))
+    return {"mean_ms": sum(times) / len(times), "p50_ms": percentile(times, 50),
+            "p90_ms": percentile(times, 90), "p99_ms": percentile(times, 99)}
+
+def runSuite(collection, query_text, scale, directory):
+    ''' build, save, load and query the collection scaled up scale times; return the measurements'''
+    start = time.time()
+    invertedIndex = buildIndex(scaledCorpus(collection, scale))
+    indexing = time.time() - start
+    nDocs = invertedIndex.nDocs
+    memory = deep_sizeof(invertedIndex.items)
+
+    index_file = os.path.join(directory, "index_{}".format(scale))
+    start = time.time()
+    invertedIndex.save(index_file)
+    save = time.time() - start
+    del invertedIndex
+    gc.collect()
+
+    start = time.time()
+    invertedIndex = InvertedIndex()
+    invertedIndex.load(index_file)
+    load = time.time() - start
+
+    qrys = loadCranQry(query_text)
+    texts = [qrys[queryId].text for queryId in sorted(qrys, key=int)]
+    queryProcessor = QueryProcessor("None", invertedIndex, None)
+    def preprocessed(evaluate):
+        def run(text):
+            queryProcessor.raw_query = text
+            return evaluate(queryProcessor.preprocessing()[0])
+        return run
+    queries = {
+        "boolean": latencies(preprocessed(queryProcessor.booleanQuery), texts),
+        "vector": latencies(preprocessed(lambda terms: queryProcessor.vectorQuery(terms, 10, 0)), texts),
+        "bm25": latencies(preprocessed(lambda terms: queryProcessor.bm25Query(terms, 10)), texts),
+    }
+    invertedIndex.close()
+
+    return {"scale": scale, "docs": nDocs, "queries": len(texts),
+            "indexing": {"seconds": indexing, "docs_per_sec": nDocs / max(indexing, 1e-9)},
+            "save_seconds": save, "load_seconds": load,
+            "disk_bytes": os.path.getsize(index_file) + os.path.getsize(spellFilename(index_file)),
+            "memory_bytes": memory, "latency": queries}
+
+def suite():
+    collection, query_text, output = sys.argv[2:5]
+    scales = [int(scale) for scale in sys.argv[5:]] or [1]
+
+    directory = tempfile.mkdtemp(prefix="benchmark")
+    try:
+        runs = []
+        for scale in scales:
+            run = runSuite(collection, query_text, scale, directory)
+            runs.append(run)
+            print("Scale {:<3}\t#Docs: {}\tIndexing: {:.1f} docs/sec\tSave: {:.3f} s\tLoad: {:.3f} s\tDisk: {:.2f} MB\tMemory: {:.2f} MB".format(
+                scale, run["docs"], run["indexing"]["docs_per_sec"], run["save_seconds"], run["load_seconds"],
+                run["disk_bytes"] / (1024.0 * 1024.0), run["memory_bytes"] / (1024.0 * 1024.0)))
+            for model in ("boolean", "vector", "bm25"):
+                latency = run["latency"][model]
+                print("\t{:<8}\tMean: {:.3f} ms\tp50: {:.3f} ms\tp90: {:.3f} ms\tp99: {:.3f} ms".format(
+                    model, latency["mean_ms"], latency["p50_ms"], latency["p90_ms"], latency["p99_ms"]))
+    finally:
+        shutil.rmtree(directory)
+
+    with open(output, "w") as f:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(), "collection": collection,
+                   "query_text": query_text, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "runs": runs}, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+# The metrics compared by compare: (path in a run, True if larger is better)
+METRICS = [(("indexing", "docs_per_sec"), True), (("save_seconds",), False), (("load_seconds",), False),
+           (("disk_bytes",), False), (("memory_bytes",), False)] + \
+          [(("latency", model, statistic), False) for model in ("boolean", "vector", "bm25")
+           for statistic in ("mean_ms", "p50_ms", "p90_ms", "p99_ms")]
+
+def metric(run, path):
+    for key in path:
+        run = run[key]
+    return run
+
+def compare():
+    with open(sys.argv[2]) as f:
+        baseline = dict([(run["scale"], run) for run in json.load(f)["runs"]])
+    with open(sys.argv[3]) as f:
+        current = dict([(run["scale"], run) for run in json.load(f)["runs"]])
+    tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+
+    regressions = 0
+    for scale in sorted(set(baseline) & set(current)):
+        print("Scale {}".format(scale))
+        for path, larger_is_better in METRICS:
+            before, after = metric(baseline[scale], path), metric(current[scale], path)
+            change = (after - before) / float(before) if before else 0.0
+            regression = (-change if larger_is_better else change) > tolerance
+            regressions += regression
+            print("\t{:<24}\t{:>12.3f}\t{:>12.3f}\t{:+.1%}{}".format(".".join(path), before, after, change, "\tREGRESSION" if regression else ""))
+    for scale in sorted(set(baseline) ^ set(current)):
+        print("Scale {} is only in {}".format(scale, sys.argv[2] if scale in baseline else sys.argv[3]))
+
+    print("{} regression(s) beyond {:.0%}".format(regressions, tolerance))
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    if sys.argv[1] == "memory":
+        memory()
+    elif sys.argv[1] == "pruning":
+        pruning()
+    elif sys.argv[1] == "phrase":
+        phrase()
+    elif sys.argv[1] == "impact":
+        impacts()
+    elif sys.argv[1] == "suite":
+        suite()
+    elif sys.argv[1] == "compare":
+        compare()
+    else:
+        print("Unknown benchmark {}. Please try again with memory, pruning, phrase, impact, suite or compare.".format(sys.argv[1]))
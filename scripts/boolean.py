@@ -0,0 +1,485 @@
+'''
+Boolean query language, with a cost-based planner and lazy evaluation
+
+    heat AND (transfer OR conduction) NOT "boundary layer"
+    pressure NEAR/3 distribution
+
+    operators are uppercase: NOT binds tightest, then AND, then OR, and adjacent operands are ANDed,
+    so "A B C" means A AND B AND C. "..." matches the phrase terms at consecutive positions, and A NEAR/k B
+    matches A and B at most k positions apart, in any order; with a phrase operand, its term next to the
+    operator is used. Positions are counted after stopword removal, both here and at indexing time.
+    Words are analyzed like the indexed text; stopwords and words that are not indexed are ignored,
+    as in QueryProcessor.booleanQuery. Unbalanced parentheses are closed or ignored.
+    A word or a phrase prefixed by a field, title:lift or author:"de young", only matches that field of
+    the documents (see index.FIELDS); the other words and phrases match the body, or with fields, any of
+    the given fields, like in QueryProcessor.booleanQuery. A phrase or a NEAR matches within a single field.
+
+    parse() compiles a query into an operator tree of tuples, and plan() turns the tree into lazy iterators
+    (build() does both, evaluate() also collects the docIDs):
+    - the operands of an AND are ordered by posting list length, and the shortest drives the intersection
+    - the NOT operands of an AND become a set difference instead of a complement of the collection
+    - a posting list cursor gallops to the next candidate when its list is at least SKIP_RATIO times
+      longer than the driving operand, otherwise it merges by scanning linearly
+    the iterators yield docIDs in increasing order, and only do the work needed for the docIDs consumed,
+    so the first page of a large OR is produced without materializing the whole result
+'''
+
+import re
+
+from intersect import PostingCursor, END, SKIP_RATIO, phraseMatch, withinDistance
+from index import splitField, fieldTerm, termField, BODY
+
+# A quoted phrase with an optional field prefix, a NEAR/k operator, a parenthesis or a word
+TOKEN = re.compile(r'(?:(\w+):)?"([^"]*)"|\bNEAR/(\d+)\b|([()])|([^\s"()]+)')
+PHRASE = re.compile(r'(?:(\w+):)?"([^"]*)"')
+OPERATORS = re.compile(r'"|\bNEAR/\d+\b|\b(AND|OR|NOT)\b')
+
+def hasOperators(query):
+    ''' true if the query uses the query language; plain queries are ANDs of their words'''
+    return OPERATORS.search(query) is not None
+
+def unquote(query):
+    ''' replace the quoted phrases of a query by their words, each prefixed by the field of its phrase:
+        author:"de young" becomes author:de author:young, for the ranked models that ignore word order'''
+    return PHRASE.sub(lambda match: " ".join([match.group(1) + ":" + word if match.group(1) else word
+                                              for word in match.group(2).split()]), query)
+
+### PARSING ###
+
+def tokenize(query):
+    ''' return the (kind, value) tokens of a query: phrase, near, paren, operator or word'''
+    tokens = []
+    for field, phrase, distance, paren, word in TOKEN.findall(query):
+        if distance:
+            tokens.append(("near", int(distance)))
+        elif paren:
+            tokens.append(("paren", paren))
+        elif word in ("AND", "OR", "NOT"):
+            tokens.append(("operator", word))
+        elif word:
+            tokens.append(("word", word))
+        else:
+            tokens.append(("phrase", field + ":" + phrase if field else phrase))
+    return tokens
+
+class Parser:
+    ''' recursive descent parser producing an operator tree:
+        ("term", term), ("phrase", [terms]), ("near", k, term, term), ("and", [nodes]), ("or", [nodes]),
+        ("not", node), or None for an operand without any term'''
+
+    def __init__(self, query, analyzer, fields=None):
+        self.tokens = tokenize(query)
+        self.i = 0
+        self.analyzer = analyzer
+        self.fields = sorted(fields) if fields else [BODY] # the fields matched by the words without a field
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else (None, None)
+
+    def parse(self):
+        node = self.parseOr()
+        while self.i < len(self.tokens):
+            # Skip an unbalanced closing parenthesis and continue with an implicit AND
+            self.i += 1
+            node = self.combine("and", [node, self.parseOr()])
+        return node
+
+    def combine(self, operator, nodes):
+        ''' the node applying operator to the nodes, flattening nested nodes of the same operator'''
+        flat = []
+        for node in nodes:
+            if node is not None and node[0] == operator:
+                flat.extend(node[1])
+            elif node is not None:
+                flat.append(node)
+        if len(flat) <= 1:
+            return flat[0] if flat else None
+        return (operator, flat)
+
+    def parseOr(self):
+        nodes = [self.parseAnd()]
+        while self.peek() == ("operator", "OR"):
+            self.i += 1
+            nodes.append(self.parseAnd())
+        return self.combine("or", nodes)
+
+    def parseAnd(self):
+        nodes = [self.parseNot()]
+        while True:
+            kind, value = self.peek()
+            if (kind, value) == ("operator", "AND"):
+                self.i += 1
+            elif kind is None or kind == "near" or (kind, value) in (("operator", "OR"), ("paren", ")")):
+                break
+            nodes.append(self.parseNot())
+        return self.combine("and", nodes)
+
+    def parseNot(self):
+        if self.peek() == ("operator", "NOT"):
+            self.i += 1
+            node = self.parseNot()
+            return ("not", node) if node is not None else None
+        return self.parseProximity()
+
+    def parseProximity(self):
+        ''' operand (NEAR/k operand)*; a NEAR constrains the terms next to it'''
+        node, terms = self.parsePrimary()
+        nodes = [node]
+        while self.peek()[0] == "near":
+            distance = self.peek()[1]
+            self.i += 1
+            right, right_terms = self.parsePrimary()
+            nodes.append(right)
+            if terms and right_terms:
+                # The alternative terms of the two operands in the same field
+                pairs = [(first, second) for first in terms[-1] for second in right_terms[0] if termField(first) == termField(second)]
+                pairs = pairs or [(terms[-1][0], right_terms[0][0])]
+                nodes.append(self.combine("or", [("near", distance, first, second) for first, second in pairs]))
+            terms = right_terms
+        # A word operand is implied by the NEAR constraining it
+        nears = [near for node in nodes if node is not None for near in (node[1] if node[0] == "or" else [node]) if near[0] == "near"]
+        constrained = set([term for near in nears for term in near[2:]])
+        return self.combine("and", [node for node in nodes if not implied(node, constrained)])
+
+    def parsePrimary(self):
+        ''' return the node of a parenthesized expression, a phrase or a word, and for NEAR, its analyzed
+            words, each as the tuple of its terms in the fields it matches'''
+        kind, value = self.peek()
+        if kind is None:
+            return None, []
+        self.i += 1
+        if kind == "paren":
+            if value == ")":
+                return None, []
+            node = self.parseOr()
+            if self.peek() == ("paren", ")"):
+                self.i += 1
+            return node, []
+        if kind in ("word", "phrase"):
+            field, text = splitField(value)
+            fields = [field] if text != value else self.fields
+            words = self.analyzer.analyze(text)
+            if not words:
+                return None, []
+            terms = [tuple([fieldTerm(field, word) for field in fields]) for word in words]
+            if kind == "phrase" and len(words) > 1:
+                return self.combine("or", [("phrase", [fieldTerm(field, word) for word in words]) for field in fields]), terms
+            return self.combine("and", [self.combine("or", [("term", term) for term in alternatives]) for alternatives in terms]), terms
+        # An operator without an operand, e.g. "A AND OR B"
+        return None, []
+
+def implied(node, constrained):
+    ''' true if a node only matches one of the constrained terms, so that a NEAR on them implies it'''
+    return node is not None and all([child[0] == "term" and child[1] in constrained
+                                     for child in (node[1] if node[0] == "or" else [node])])
+
+def parse(query, analyzer, fields=None):
+    ''' compile a query into an operator tree, see Parser; fields are those matched by the words without a field'''
+    return Parser(query, analyzer, fields).parse()
+
+### ITERATORS ###
+# Every iterator has the current docID (END once exhausted), its cost (an upper bound of the number of
+# docIDs it yields), next() and advance(target), which both return the new current docID
+
+class EmptyIterator:
+    def __init__(self):
+        self.docid = END
+        self.cost = 0
+
+    def next(self):
+        return END
+
+    def advance(self, target):
+        return END
+
+    def explain(self):
+        return "Empty"
+
+class AndIterator:
+    ''' intersection, driven by the cheapest child; the others are advanced to its candidates'''
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.cost = self.children[0].cost
+        for child in self.children[1:]:
+            if isinstance(child, PostingCursor):
+                child.gallop = child.cost >= SKIP_RATIO * self.cost
+        self.docid = self.align(self.children[0].docid)
+
+    def align(self, target):
+        ''' the first docID >= target in every child'''
+        children = self.children
+        while target < END:
+            target = children[0].advance(target)
+            for child in children[1:]:
+                docid = child.advance(target)
+                if docid != target:
+                    target = docid
+                    break
+            else:
+                return target
+        return END
+
+    def next(self):
+        self.docid = self.align(self.children[0].next())
+        return self.docid
+
+    def advance(self, target):
+        if self.docid < target:
+            self.docid = self.align(target)
+        return self.docid
+
+    def explain(self):
+        return "AND({})".format(", ".join([explain(child) for child in self.children]))
+
+class OrIterator:
+    ''' union, yielding the smallest current docID of the children'''
+
+    def __init__(self, children):
+        self.children = children
+        self.cost = sum([child.cost for child in children])
+        self.docid = min([child.docid for child in children])
+
+    def next(self):
+        for child in self.children:
+            if child.docid == self.docid:
+                child.next()
+        self.docid = min([child.docid for child in self.children])
+        return self.docid
+
+    def advance(self, target):
+        if self.docid < target:
+            for child in self.children:
+                child.advance(target)
+            self.docid = min([child.docid for child in self.children])
+        return self.docid
+
+    def explain(self):
+        return "OR({})".format(", ".join([explain(child) for child in self.children]))
+
+class AndNotIterator:
+    ''' set difference: the docIDs of positive that negative does not contain'''
+
+    def __init__(self, positive, negative):
+        self.positive = positive
+        self.negative = negative
+        self.cost = positive.cost
+        self.docid = self.skip(positive.docid)
+
+    def skip(self, docid):
+        while docid < END and self.negative.advance(docid) == docid:
+            docid = self.positive.next()
+        return docid
+
+    def next(self):
+        self.docid = self.skip(self.positive.next())
+        return self.docid
+
+    def advance(self, target):
+        if self.docid < target:
+            self.docid = self.skip(self.positive.advance(target))
+        return self.docid
+
+    def explain(self):
+        return "ANDNOT({}, {})".format(explain(self.positive), explain(self.negative))
+
+class PositionalIterator:
+    ''' the docIDs containing all the IndexItems, whose positions satisfy match(list of position arrays).
+        Positions are only decoded for the docIDs of the intersection'''
+
+    def __init__(self, items, match, name):
+        self.items = items
+        self.cursors = [TermCursor(item.docids, item.term) for item in items]
+        self.conjunction = AndIterator(self.cursors)
+        self.match = match
+        self.name = name
+        self.cost = self.conjunction.cost
+        self.docid = self.check(self.conjunction.docid)
+
+    def check(self, docid):
+        while docid < END:
+            positions = [item.positions[item.offsets[cursor.i]:item.offsets[cursor.i+1]] for item, cursor in zip(self.items, self.cursors)]
+            if self.match(positions):
+                return docid
+            docid = self.conjunction.next()
+        return END
+
+    def next(self):
+        self.docid = self.check(self.conjunction.next())
+        return self.docid
+
+    def advance(self, target):
+        if self.docid < target:
+            self.docid = self.check(self.conjunction.advance(target))
+        return self.docid
+
+    def explain(self):
+        return "{}({})".format(self.name, " ".join([item.term for item in self.items]))
+
+class TermCursor(PostingCursor):
+    ''' a PostingCursor over the posting list of a term'''
+
+    def __init__(self, docids, name):
+        PostingCursor.__init__(self, docids)
+        self.name = name
+
+    def explain(self):
+        return self.name if self.gallop else self.name + " merge"
+
+def explain(iterator):
+    ''' a readable description of a plan, with the cost of each node'''
+    return "{}[{}]".format(iterator.explain(), iterator.cost)
+
+### PLANNING ###
+
+class Complement:
+    ''' NOT operand, turned into a set difference by the enclosing AND, or from all documents'''
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+def allDocuments(index):
+    ''' cursor over every live document of the index, whatever the fields it has terms in'''
+    return TermCursor(index.documents(), "ALL")
+
+def resolve(node, index):
+    ''' a Complement as a difference from all documents; other iterators as they are'''
+    if isinstance(node, Complement):
+        return AndNotIterator(allDocuments(index), node.iterator)
+    return node
+
+def plan(tree, index):
+    ''' return the lazy iterator evaluating an operator tree over an index; None when no term is indexed'''
+    if tree is None:
+        return None
+    operator = tree[0]
+
+    if operator == "term":
+        item = index.find(tree[1])
+        if item == "None":
+            return None
+        return TermCursor(item.sorted_postings, tree[1])
+
+    if operator in ("phrase", "near"):
+        terms = tree[1] if operator == "phrase" else list(tree[2:])
+        items = [index.find(term) for term in terms]
+        if "None" in items:
+            return EmptyIterator()
+        if operator == "phrase":
+            offsets = list(range(len(terms)))
+            return PositionalIterator(items, lambda positions: phraseMatch(positions, offsets), "PHRASE")
+        distance = tree[1]
+        return PositionalIterator(items, lambda positions: withinDistance(positions[0], positions[1], distance), "NEAR/{}".format(distance))
+
+    if operator == "not":
+        child = plan(tree[1], index)
+        if child is None:
+            return None
+        if isinstance(child, Complement):
+            return child.iterator # NOT NOT A
+        return Complement(child)
+
+    children = [child for child in [plan(node, index) for node in tree[1]] if child is not None]
+    if not children:
+        return None
+
+    if operator == "or":
+        children = [resolve(child, index) for child in children]
+        children = [child for child in children if not isinstance(child, EmptyIterator)]
+        if not children:
+            return EmptyIterator()
+        return children[0] if len(children) == 1 else OrIterator(children)
+
+    # AND: intersect the positive operands, then subtract the union of the negative ones
+    positives = [child for child in children if not isinstance(child, Complement)]
+    negatives = [child.iterator for child in children if isinstance(child, Complement)]
+    if not positives:
+        if len(negatives) == 1:
+            return Complement(negatives[0])
+        positives = [allDocuments(index)]
+    if any([isinstance(child, EmptyIterator) for child in positives]):
+        return EmptyIterator()
+    iterator = positives[0] if len(positives) == 1 else AndIterator(positives)
+    negatives = [child for child in negatives if not isinstance(child, EmptyIterator)]
+    if negatives:
+        iterator = AndNotIterator(iterator, negatives[0] if len(negatives) == 1 else OrIterator(negatives))
+    return iterator
+
+def build(query, index, fields=None):
+    ''' parse and plan a query; returns an iterator'''
+    iterator = resolve(plan(parse(query, index.analyzer.queryView(), fields), index), index)
+    return iterator if iterator is not None else EmptyIterator()
+
+def evaluate(query, index, limit=None, offset=0, fields=None):
+    ''' return the sorted docIDs matching a query, or only the page of limit docIDs after the first offset.
+        The words without a field match any of fields, by default the body'''
+    iterator = build(query, index, fields)
+    docids = []
+    docid = iterator.docid
+    skipped = 0
+    while docid < END and (limit is None or len(docids) < limit):
+        if skipped < offset:
+            skipped += 1
+        else:
+            docids.append(docid)
+        docid = iterator.next()
+    return docids
+
+def test():
+    ''' a NOT-only query returns the documents with an empty body, or without any indexed term, in an in-memory,
+        a loaded and a segmented index'''
+    import os
+    import shutil
+    import tempfile
+    from doc import Document
+    from index import InvertedIndex
+    from segments import SegmentedIndex
+
+    docs = [Document("1", "heat flux", "", "heat transfer in a wall"), Document("2", "wing flutter", "smith", ""),
+            Document("3", "", "", "boundary layer"), Document("4", "", "", "")]
+    index = InvertedIndex()
+    for doc in docs:
+        index.indexDoc(doc)
+    index.sort()
+    index.computeStatistics()
+    assert evaluate("NOT heat", index) == [2, 3, 4], evaluate("NOT heat", index)
+    assert evaluate("NOT title:wing", index) == [1, 3, 4]
+
+    # With fields, the words, phrases and NEARs without a field match any of them, each within one field
+    fields = {"title": 2, "body": 1}
+    assert evaluate("wing NOT boundary", index, fields=fields) == [2]
+    assert evaluate('"heat flux"', index) == [] and evaluate('"heat flux"', index, fields=fields) == [1]
+    assert evaluate("wing NEAR/1 flutter", index) == [] and evaluate("wing NEAR/1 flutter", index, fields=fields) == [2]
+    assert evaluate("flux NEAR/3 transfer", index, fields=fields) == []
+    assert evaluate("body:heat OR title:flutter", index, fields={"title": 1}) == [1, 2]
+
+    # The ranked models search the words of a field restricted phrase in its field
+    assert unquote('author:"de young" "boundary layer" lift') == "author:de author:young boundary layer lift"
+    from query import QueryProcessor
+    assert QueryProcessor('author:"Smith" "wall"', index, None).preprocessing()[0] == [fieldTerm("author", "smith"), "wall"]
+
+    directory = tempfile.mkdtemp()
+    try:
+        index.save(os.path.join(directory, "index"))
+        loaded = InvertedIndex()
+        loaded.load(os.path.join(directory, "index"))
+        assert evaluate("NOT heat", loaded) == [2, 3, 4]
+        loaded.close()
+
+        segmented = SegmentedIndex(background=False, buffer_size=2)
+        for doc in docs:
+            segmented.addDocument(doc)
+        segmented.deleteDocument(3)
+        segmented.close()
+        assert evaluate("NOT heat", segmented.snapshot()) == [2, 4], evaluate("NOT heat", segmented.snapshot())
+
+        segmented.snapshot().save(os.path.join(directory, "snapshot"))
+        loaded = InvertedIndex()
+        loaded.load(os.path.join(directory, "snapshot"))
+        assert evaluate("NOT heat", loaded) == [2, 4], evaluate("NOT heat", loaded)
+        loaded.close()
+    finally:
+        shutil.rmtree(directory)
+    print("Pass")
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,67 @@
+'''
+command line client of the query server (server.py)
+
+    python client.py processing_algorithm query_text query_id [--server http://127.0.0.1:8080] [--snippets]
+
+    takes the same arguments as query.py, without the index_file: the queries are sent to a running
+    server instead of loading the index and parsing the collection on every invocation.
+    The results are printed in the same format as query.py
+'''
+
+import json
+import argparse
+
+try:
+    from urllib2 import urlopen, Request
+except ImportError:
+    from urllib.request import urlopen, Request
+
+from cranqry import loadCranQry
+
+def search(server, request):
+    ''' POST a request to the server's /search endpoint and return the decoded response'''
+    data = json.dumps(request).encode("utf-8")
+    response = urlopen(Request(server.rstrip("/") + "/search", data, {"Content-Type": "application/json"}))
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    finally:
+        response.close()
+
+def printResults(queryId, model, response, mode):
+    if model == "0":
+        if mode != "batch" or response["results"]:
+            print("QueryID: {}\t#Docs: {}\tDocIDs: {}".format(queryId, response["total"], response["results"]))
+    else:
+        print("QueryID: {}".format(queryId))
+        for result in response["results"]:
+            print("DocID: {}\tScore: {:.3f}".format(result["docID"], result["score"]))
+            if "snippet" in result:
+                print("\t{}\n\t{}".format(result["title"], result["snippet"]))
+        print("\n")
+
+def client():
+    parser = argparse.ArgumentParser(description="Send the queries of query_text to a running query server")
+    parser.add_argument("processing_algorithm", choices=["0", "1", "2"], help="0 for Boolean, 1 for Vector and 2 for BM25")
+    parser.add_argument("query_text")
+    parser.add_argument("query_id", help="a query ID of query_text, or batch to process all queries")
+    parser.add_argument("--server", default="http://127.0.0.1:8080", help="the URL of the query server")
+    parser.add_argument("--snippets", action="store_true", help="print the title and a highlighted snippet of each Vector and BM25 result")
+    args = parser.parse_args()
+
+    model = args.processing_algorithm
+    k = int(input("Top K Pairs? ")) if model in ("1", "2") else 0
+    qrys = loadCranQry(args.query_text)
+
+    if args.query_id != "batch":
+        response = search(args.server, {"query": qrys[args.query_id].text, "model": model, "k": k, "snippets": args.snippets})
+        printResults(args.query_id, model, response, "single")
+    else:
+        # All the queries are sent in one request
+        query_Ids = sorted([int(queryId) for queryId in qrys])
+        queries = [{"id": queryId, "query": qrys[str(queryId)].text} for queryId in query_Ids]
+        response = search(args.server, {"queries": queries, "model": model, "k": k, "snippets": args.snippets})
+        for result in response["results"]:
+            printResults(result["id"], model, result, "batch")
+
+if __name__ == '__main__':
+    client()
@@ -0,0 +1,66 @@
+'''
+pluggable readers streaming the Documents of a corpus file one at a time,
+so that collections of any size are indexed with a fixed memory footprint
+
+    cranfield   the Cranfield format of cran.all (.I/.T/.A/.B/.W field markers)
+    jsonl       one JSON object per line, with an integer "id" and optional "title",
+                "author" and "body" fields; the line number is used when "id" is missing
+    text        one document body per line; the docID is the line number
+
+the jsonl and text files are read as UTF-8, and the text of the Documents is returned as native strs
+(util.nativeText), like that of the Cranfield reader
+
+a reader is any function taking a filename and yielding Documents; more formats
+are added with registerReader
+'''
+
+import io
+import json
+
+from doc import Document
+from cran import readCranfield
+from util import nativeText
+
+def documentID(value, filename, lineno):
+    ''' the docID of a record: an integer, or a string of digits, that fits the int32 docIDs of the index'''
+    try:
+        docid = int(value) if not isinstance(value, (bool, float)) else None
+    except (TypeError, ValueError):
+        docid = None
+    if docid is None or not 0 <= docid < 2 ** 31:
+        raise ValueError("{} line {}: the id must be an integer from 0 to 2^31 - 1, got {!r}".format(filename, lineno, value))
+    return str(docid)
+
+def readJsonl(filename):
+    ''' yield the Documents of a JSON lines file'''
+    with io.open(filename, encoding="utf-8", errors="replace") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError("{} line {}: invalid JSON: {}".format(filename, lineno, e))
+            if not isinstance(record, dict):
+                raise ValueError("{} line {}: expected a JSON object".format(filename, lineno))
+            yield Document(documentID(record.get("id", lineno), filename, lineno), nativeText(record.get("title") or ""),
+                           nativeText(record.get("author") or ""), nativeText(record.get("body") or ""))
+
+def readText(filename):
+    ''' yield the Documents of a plain text file, one per line'''
+    with io.open(filename, encoding="utf-8", errors="replace") as f:
+        for lineno, line in enumerate(f, 1):
+            if line.strip():
+                yield Document(str(lineno), "", "", nativeText(line))
+
+READERS = {"cranfield": readCranfield, "jsonl": readJsonl, "text": readText}
+
+def registerReader(name, reader):
+    ''' make a reader available to readCorpus under the given format name'''
+    READERS[name] = reader
+
+def readCorpus(filename, format="cranfield"):
+    ''' stream the Documents of a corpus file in the given format'''
+    if format not in READERS:
+        raise ValueError("Unknown corpus format {}. Supported formats: {}".format(format, ", ".join(sorted(READERS))))
+    return READERS[format](filename)
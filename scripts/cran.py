@@ -4,47 +4,55 @@ Processing the special format used by the Cranfield Dataset
 
 from doc import Document, Collection
 
-class CranFile:
-    def __init__(self, filename):
-        self.docs = []
-        self.collection = Collection()
+# Field markers of a Cranfield record; each record starts with a ".I docID" line
+FIELDS = {".T": "title", ".A": "author", ".B": "source", ".W": "body"}
 
-        cf = open(filename)
-        docid = ''
-        title = ''
-        author = ''
-        body = ''
+def readCranfield(filename):
+    ''' yield the Documents of a Cranfield collection file one at a time.
+        Markers are only recognized as whole lines; once the abstract (.W) has started,
+        stray field marker lines inside it are dropped instead of starting a new field'''
+    docid = None
+    fields = {}
+    field = None
+    lines = []
 
+    with open(filename) as cf:
         for line in cf:
-            if '.I' in line:
-                if docid != '':
-                    body = buf
-                    self.docs.append(Document(docid, title, author, body))
+            marker = line.rstrip()
+            if marker.startswith(".I "):
+                if docid is not None:
+                    fields[field] = "".join(lines)
+                    yield Document(docid, fields.get("title", ""), fields.get("author", ""), fields.get("body", ""))
                 # start a new document
-                docid = line.strip().split()[1]
-                buf = ''
-            elif '.T' in line:
-                None
-            elif '.A' in line:
-                title = buf # got title
-                buf = ''
-            elif '.B' in line:
-                author = buf # got author
-                buf = ''
-            elif '.W' in line:
-                buf = '' # skip affiliation
+                docid = marker.split()[1]
+                fields = {}
+                field = None
+                lines = []
+            elif marker in FIELDS:
+                if field != "body":
+                    fields[field] = "".join(lines)
+                    field = FIELDS[marker]
+                    lines = []
             else:
-                buf += line
-        self.docs.append(Document(docid, title, author, buf)) # the last one
+                lines.append(line)
+
+    if docid is not None:
+        fields[field] = "".join(lines)
+        yield Document(docid, fields.get("title", ""), fields.get("author", ""), fields.get("body", "")) # the last one
+
+class CranFile:
+    def __init__(self, filename):
+        self.docs = list(readCranfield(filename))
+        self.collection = Collection()
 
         # Create the document Collection
         for i in range(len(self.docs)):
             self.collection.add(self.docs[i].docID, self.docs[i])
-        
+
 if __name__ == '__main__':
     ''' testing '''
 
     cf = CranFile ('cran.all')
     # for doc in cf.docs:
     #     print(doc.docID, doc.title, doc.body)
-    print("Length of CranFile documents:", len(cf.docs))
\ No newline at end of file
+    print("Length of CranFile documents:", len(cf.docs))
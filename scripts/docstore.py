@@ -0,0 +1,115 @@
+'''
+compressed document store, to read a document by docID without loading the collection
+
+    the documents are stored in blocks of BLOCK_SIZE consecutive documents of the collection, each
+    block a zlib compressed JSON list of [docID, title, author, body]. The store is written next to
+    the index file, as index_file.docs, in the binary index format, without terms:
+
+        DOCIDS      the sorted docIDs (int32)
+        DOCSLOT     the rank in the collection of the document of each sorted docID (int32)
+        BLOCKLEN    the compressed length of each block (int32)
+        DOCDATA     the compressed blocks, one after the other
+
+    it is memory-mapped: finding a document binary searches DOCIDS and decompresses a single block,
+    and the most recently decompressed blocks are kept in an LRU cache
+'''
+
+import os
+import json
+import zlib
+
+from array import array
+from bisect import bisect_left
+from doc import Document
+from util import LRUCache
+from indexfile import IndexWriter, IndexFile
+
+BLOCK_SIZE = 16 # documents per compressed block: larger blocks compress better, smaller ones decompress faster
+SUFFIX = ".docs"
+
+def _native(text):
+    ''' json decodes to unicode: back to the str of the collection under Python 2'''
+    return text.encode("utf-8") if str is bytes else text
+
+def docstoreFilename(index_file):
+    return index_file + SUFFIX
+
+def writeDocumentStore(docs, index_file, block_size=BLOCK_SIZE):
+    ''' write the document store of a stream of Documents next to an index file; return the number of documents'''
+    docids = []
+    lengths = array('i')
+    data = []
+    block = []
+
+    def flush():
+        compressed = zlib.compress(json.dumps(block).encode("utf-8"), 9)
+        lengths.append(len(compressed))
+        data.append(compressed)
+        del block[:]
+
+    for doc in docs:
+        docids.append(int(doc.docID))
+        block.append([doc.docID, doc.title, doc.author, doc.body])
+        if len(block) == block_size:
+            flush()
+    if block:
+        flush()
+
+    slots = sorted(range(len(docids)), key=lambda slot : docids[slot])
+    writer = IndexWriter(docstoreFilename(index_file))
+    writer.close({"docs": len(docids), "block_size": block_size},
+                 {b"DOCIDS": array('i', [docids[slot] for slot in slots]), b"DOCSLOT": array('i', slots),
+                  b"BLOCKLEN": lengths, b"DOCDATA": array('B', b"".join(data))})
+    return len(docids)
+
+class DocumentStore:
+    ''' memory-mapped view of a document store; find(docID) returns a Document, like Collection.find'''
+
+    def __init__(self, filename, cache_size=64):
+        self.source = IndexFile(filename)
+        self.block_size = self.source.meta["block_size"]
+        self.docids = self.source.array(b"DOCIDS", 'i')
+        self.slots = self.source.array(b"DOCSLOT", 'i')
+        self.data_offset = self.source.sections[b"DOCDATA"][0]
+        self.offsets = [0]
+        for length in self.source.array(b"BLOCKLEN", 'i'):
+            self.offsets.append(self.offsets[-1] + length)
+        self.blocks = LRUCache(cache_size)
+
+    def block(self, i):
+        ''' the decompressed documents of the i-th block'''
+        docs = self.blocks.get(i)
+        if docs is None:
+            start = self.data_offset + self.offsets[i]
+            docs = json.loads(zlib.decompress(self.source.mm[start:self.data_offset + self.offsets[i+1]]).decode("utf-8"))
+            self.blocks.put(i, docs)
+        return docs
+
+    def find(self, docID):
+        ''' return the Document of a docID, or None if the store has no such document'''
+        docid = int(docID)
+        i = bisect_left(self.docids, docid)
+        if i == len(self.docids) or self.docids[i] != docid:
+            return None
+        slot = self.slots[i]
+        fields = self.block(slot // self.block_size)[slot % self.block_size]
+        return Document(*[_native(field) for field in fields])
+
+    def __len__(self):
+        return len(self.docids)
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+def removeDocumentStore(index_file):
+    ''' remove the document store of an index file being rewritten, which would no longer match it'''
+    if os.path.exists(docstoreFilename(index_file)):
+        os.remove(docstoreFilename(index_file))
+
+def loadDocumentStore(index_file):
+    ''' memory-map the document store written next to an index file, or return None if there is none'''
+    if not os.path.exists(docstoreFilename(index_file)):
+        return None
+    return DocumentStore(docstoreFilename(index_file))
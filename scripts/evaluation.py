@@ -0,0 +1,119 @@
+'''
+vectorized evaluation of ranked runs
+
+    a run is a queries x k matrix of ranked docIDs, padded with -1 (runMatrix). Its relevance is
+    looked up against the qrels of all the queries at once (relevanceMatrix), then every measure is
+    computed for all the queries with array operations:
+
+    ndcg        NDCG@k with binary gains. By default the ideal ranking is the best reordering of the
+                retrieved documents, as computed by metrics.ndcg_score; with ideal="relevant" it ranks
+                all the relevant documents of the query first
+    precision   P@k
+    recall      recall@k
+    ap          average precision at k (its mean over the queries is MAP)
+    rr          reciprocal rank of the first relevant document (its mean is MRR)
+
+    the paired significance tests compare two per-query score arrays: the Wilcoxon signed-rank test,
+    the paired t-test, and a randomized permutation test drawing all its sign flips as one matrix
+'''
+
+import numpy as np
+import scipy.stats
+
+MEASURES = ["ndcg", "precision", "recall", "ap", "rr"]
+
+def runMatrix(rankings, k):
+    ''' the queries x k matrix of a list of rankings (docIDs, best first), truncated to k and padded with -1'''
+    run = np.full((len(rankings), k), -1, dtype=np.int64)
+    for i, ranking in enumerate(rankings):
+        ranking = list(ranking)[:k]
+        run[i, :len(ranking)] = ranking
+    return run
+
+def relevanceMatrix(run, qrels):
+    ''' the boolean matrix of the relevant entries of a run, and the number of relevant documents of each query.
+        qrels holds the relevant docIDs of each query, in the order of the run rows'''
+    n_relevant = np.array([len(set(relevant)) for relevant in qrels], dtype=np.int64)
+    relevant = np.array([docid for docs in qrels for docid in set(docs)], dtype=np.int64)
+    queries = np.repeat(np.arange(len(qrels), dtype=np.int64), n_relevant)
+
+    # Encode the (query, docID) pairs as single integers, so that one membership test covers all the queries
+    width = int(max(run.max() if run.size else 0, relevant.max() if relevant.size else 0)) + 1
+    codes = np.arange(run.shape[0], dtype=np.int64)[:, None] * width + run
+    rel = np.in1d(codes.ravel(), queries * width + relevant).reshape(run.shape) & (run >= 0)
+    return rel, n_relevant
+
+def discounts(k):
+    ''' the DCG discount of each rank: 1 / log2(rank + 1)'''
+    return 1.0 / np.log2(np.arange(k) + 2.0)
+
+def safeDivide(numerator, denominator):
+    ''' numerator / denominator, with 0 where the denominator is 0'''
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    result = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+def ndcg(rel, n_relevant, ideal="retrieved"):
+    discount = discounts(rel.shape[1])
+    ideal_dcg = np.concatenate(([0.0], np.cumsum(discount)))
+    n_ideal = rel.sum(axis=1) if ideal == "retrieved" else np.minimum(n_relevant, rel.shape[1])
+    return safeDivide((rel * discount).sum(axis=1), ideal_dcg[n_ideal])
+
+def precision(rel, n_relevant):
+    return rel.sum(axis=1) / float(rel.shape[1])
+
+def recall(rel, n_relevant):
+    return safeDivide(rel.sum(axis=1), n_relevant)
+
+def averagePrecision(rel, n_relevant):
+    precisions = np.cumsum(rel, axis=1) / np.arange(1.0, rel.shape[1] + 1)
+    return safeDivide((precisions * rel).sum(axis=1), n_relevant)
+
+def reciprocalRank(rel, n_relevant):
+    first = rel.argmax(axis=1)
+    return np.where(rel.any(axis=1), 1.0 / (first + 1), 0.0)
+
+def evaluate(rankings, qrels, k, ideal="retrieved"):
+    ''' the per-query measures of a run: {measure: array over the queries}'''
+    rel, n_relevant = relevanceMatrix(runMatrix(rankings, k), qrels)
+    return {"ndcg": ndcg(rel, n_relevant, ideal), "precision": precision(rel, n_relevant), "recall": recall(rel, n_relevant),
+            "ap": averagePrecision(rel, n_relevant), "rr": reciprocalRank(rel, n_relevant)}
+
+def wilcoxon(a, b):
+    ''' the p-value of the Wilcoxon signed-rank test of paired scores'''
+    return scipy.stats.wilcoxon(a, b)[1]
+
+def pairedTTest(a, b):
+    ''' the p-value of the paired t-test of paired scores, 1.0 when the scores are all identical'''
+    if np.array_equal(a, b):
+        return 1.0
+    return scipy.stats.ttest_rel(a, b)[1]
+
+def permutationTest(a, b, permutations=10000, seed=0):
+    ''' the two-sided p-value of a randomized permutation test of the mean difference of paired scores:
+        the sign of every difference is flipped at random, for all the permutations at once'''
+    differences = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    n = len(differences)
+    if n == 0:
+        return 1.0
+    observed = abs(differences.mean())
+    rand = np.random.RandomState(seed)
+
+    # A sign flip keeps or negates each difference: with one random bit per difference, the permuted
+    # sum is 2 * (the sum of the kept differences) - the sum of all differences. The bits are drawn
+    # a byte at a time, and the permutations processed in blocks of about a million bits
+    extreme = 0
+    block = max(1, (1 << 20) // n)
+    for done in range(0, permutations, block):
+        rows = min(block, permutations - done)
+        bits = np.unpackbits(np.frombuffer(rand.bytes(rows * ((n + 7) // 8)), dtype=np.uint8)).reshape(rows, -1)[:, :n]
+        means = np.abs(2 * bits.dot(differences) - differences.sum()) / n
+        extreme += np.count_nonzero(means >= observed - 1e-12)
+    # The observed assignment counts as one of the permutations, so the p-value is never 0
+    return (extreme + 1.0) / (permutations + 1)
+
+def significance(a, b, permutations=10000, seed=0):
+    ''' the p-values of the three paired tests of two per-query score arrays'''
+    return {"wilcoxon": wilcoxon(a, b), "ttest": pairedTTest(a, b), "permutation": permutationTest(a, b, permutations, seed)}
@@ -0,0 +1,118 @@
+'''
+impact-ordered postings, for score-at-a-time evaluation of the Vector model
+
+    the impact of a posting is its normalized weight tf * idf / document norm, quantized to an integer
+    level from 1 to LEVELS with a single scale for the whole index: level = round(weight / scale), where
+    scale = the largest weight / LEVELS. The postings of each term are ordered by decreasing level, then
+    by docID, so that they form segments of equal level, highest first. The cosine similarity of a query
+    and a document is approximated by the sum over the query terms of query weight * level * scale,
+    divided by the query norm.
+
+    the impact index is written next to the index file, as index_file.impact, in the binary index
+    format: the "term frequencies" of a term are the levels of its postings, and its positions are empty.
+    It is memory-mapped, and a posting list is only decoded when a query uses it.
+    QueryProcessor.impactQuery evaluates the segments of all the query terms in decreasing order of
+    their score contribution, and stops as soon as the top k can no longer change, or once a budget of
+    postings is spent
+'''
+
+import os
+
+from array import array
+from util import LRUCache
+from indexfile import IndexWriter, IndexFile
+
+LEVELS = 63 # the number of quantized impact levels: 6 bits rank about as well as 8, with fewer, longer segments
+SUFFIX = ".impact"
+
+def quantize(weight, scale):
+    ''' the impact level of a normalized weight, at least 1 for a positive weight'''
+    return min(max(int(round(weight / scale)), 1), LEVELS)
+
+def segmentEnd(levels, start):
+    ''' the end of the segment of equal levels starting at start, by binary search in the decreasing levels'''
+    level = levels[start]
+    lo, hi = start + 1, len(levels)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if levels[mid] == level:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class ImpactIndex:
+    ''' the impact-ordered (docids, levels) arrays of each term: a dict when built in memory,
+        the records of an IndexFile when loaded from an impact index file'''
+
+    def __init__(self, postings, scale, source=None, cache_size=10000):
+        self.postings = postings
+        self.scale = scale
+        self.source = source
+        self.decoded = LRUCache(cache_size)
+
+    def find(self, term):
+        ''' return the (docids, levels) of a term, or None if none of its postings has a positive weight.
+            The posting lists of an impact index file are decoded on first use and kept in an LRU cache'''
+        if self.source is None:
+            return self.postings.get(term)
+        postings = self.decoded.get(term)
+        if postings is None:
+            i = self.source.lookup(term)
+            if i < 0:
+                return None
+            postings = self.source.frequencies(i)
+            self.decoded.put(term, postings)
+        return postings
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+def impactOrder(item, norms, scale):
+    ''' sort the postings of an IndexItem by decreasing impact level, then docID, dropping the postings without weight'''
+    postings = sorted([(-quantize(tf * item.idf / norms[docid], scale), docid) for docid, tf in zip(item.docids, item.tfs)
+                       if norms[docid] > 0 and tf * item.idf > 0])
+    if not postings:
+        return None
+    return array('i', [docid for _, docid in postings]), array('i', [-level for level, _ in postings])
+
+def impactScale(index):
+    ''' the quantization step of an index: its largest normalized weight divided by LEVELS'''
+    return (max([index.find(term).max_weight for term in index.terms()] or [0.0]) / LEVELS) or 1.0
+
+def buildImpactIndex(index, normsOf):
+    ''' build an in-memory ImpactIndex of an InvertedIndex; normsOf(term) returns the document norms of the field of a term'''
+    scale = impactScale(index)
+    postings = {}
+    for term in index.terms():
+        ordered = impactOrder(index.find(term), normsOf(term), scale)
+        if ordered is not None:
+            postings[term] = ordered
+    return ImpactIndex(postings, scale)
+
+def impactFilename(index_file):
+    return index_file + SUFFIX
+
+def writeImpactIndex(index, index_file, normsOf):
+    ''' write the impact index of an InvertedIndex next to its index file'''
+    scale = impactScale(index)
+    writer = IndexWriter(impactFilename(index_file))
+    for term in index.terms():
+        ordered = impactOrder(index.find(term), normsOf(term), scale)
+        if ordered is not None:
+            writer.add(term, ordered[0], ordered[1], array('i'), index.find(term).idf, ordered[1][0] * scale)
+    writer.close({"levels": LEVELS, "scale": scale})
+
+def removeImpactIndex(index_file):
+    ''' remove the impact index of an index file being rewritten, which would no longer match it'''
+    if os.path.exists(impactFilename(index_file)):
+        os.remove(impactFilename(index_file))
+
+def loadImpactIndex(index_file):
+    ''' memory-map the impact index written next to an index file, or return None if there is none'''
+    if not os.path.exists(impactFilename(index_file)):
+        return None
+    source = IndexFile(impactFilename(index_file))
+    return ImpactIndex(None, source.meta["scale"], source)
@@ -4,9 +4,10 @@ Index structure:
 
     The Index class contains a list of IndexItems, stored in a dictionary type for easier access
 
-    each IndexItem contains the term and a set of PostingItems
+    each IndexItem contains the term and its posting list, stored compactly in typed arrays:
+    the sorted docIDs, their term frequencies, and a flat buffer of positions with per-document offsets
 
-    each PostingItem contains a document ID and a list of positions that the term occurs
+    a Posting is a (document ID, list of positions) view of one entry of the posting list
 
 '''
 
@@ -14,16 +15,30 @@ import sys
 import doc
 import json
 import math
+import time
+import argparse
+import multiprocessing
 import jsonpickle
+import numpy as np
+
+from array import array
+from scipy import sparse
+from bisect import bisect_left
 
 from util import *
 from cran import CranFile
+from corpus import readCorpus, READERS
+from indexfile import IndexWriter, IndexFile, isIndexFile
+from symspell import writeSpellIndex, loadSpellIndex, buildCorrector
+from impact import writeImpactIndex, loadImpactIndex, buildImpactIndex, removeImpactIndex, impactFilename
+from docstore import writeDocumentStore, removeDocumentStore, docstoreFilename
 from collections import OrderedDict
 
 class Posting:
-    def __init__(self, docID):
+    ''' a lightweight (docID, positions) view of one entry of a compact IndexItem'''
+    def __init__(self, docID, positions=None):
         self.docID = docID
-        self.positions = []
+        self.positions = positions if positions is not None else []
 
     def append(self, pos):
         self.positions.append(pos)
@@ -49,55 +64,255 @@ class Posting:
         return len(self.positions)
 
 class IndexItem:
+    ''' compact posting list of a term, backed by typed arrays instead of one Posting object per document
+
+        docids[i] is the i-th document containing the term, tfs[i] its term frequency, and
+        its positions are stored in the flat buffer positions[offsets[i]:offsets[i+1]]'''
+
     def __init__(self, term):
         self.term = term
-        self.posting = {} # postings are stored in a python dict for easier index building
-        self.sorted_postings = [] # may sort them by docID for easier query processing
+        self.docids = array('i')
+        self.tfs = array('i')
+        self.offsets = array('i', [0])
+        self.positions = array('i')
+        self.is_sorted = True # False once a docID or a position arrives out of order
+        self.idf = 0.0 # computed by InvertedIndex.computeStatistics
+        self.max_weight = 0.0 # the largest tf * idf / document norm, bounding the term's score contribution
+
+    @property
+    def sorted_postings(self):
+        ''' the docIDs of the posting list, sorted after sort() is called'''
+        return self.docids
 
     def add(self, docid, pos):
         ''' add a posting'''
-        if not self.posting.has_key(docid):
-            self.posting[docid] = Posting(docid)
-        self.posting[docid].append(pos)
+        docids = self.docids
+        if docids and docids[-1] == docid:
+            if pos < self.positions[-1]:
+                self.is_sorted = False
+            self.positions.append(pos)
+            self.tfs[-1] += 1
+            self.offsets[-1] += 1
+        else:
+            if docids and docid < docids[-1]:
+                self.is_sorted = False
+            docids.append(docid)
+            self.tfs.append(1)
+            self.positions.append(pos)
+            self.offsets.append(len(self.positions))
+
+    def load(self, docids, tfs, positions):
+        ''' set the posting list from sorted docID, term frequency and positions arrays'''
+        self.docids = docids
+        self.tfs = tfs
+        self.positions = positions
+        self.offsets = array('i', [0])
+        end = 0
+        for tf in tfs:
+            end += tf
+            self.offsets.append(end)
+        self.is_sorted = True
+
+    def extend(self, docids, tfs, positions):
+        ''' append the postings of another range of documents, given as sorted arrays'''
+        if not len(docids):
+            return
+        if self.docids and docids[0] <= self.docids[-1]:
+            self.is_sorted = False
+        end = len(self.positions)
+        self.docids.extend(docids)
+        self.tfs.extend(tfs)
+        self.positions.extend(positions)
+        for tf in tfs:
+            end += tf
+            self.offsets.append(end)
+
+    def get(self, docid):
+        ''' return the Posting of a document, or None if the term does not occur in it'''
+        if not self.is_sorted:
+            self.sort()
+        i = bisect_left(self.docids, docid)
+        if i == len(self.docids) or self.docids[i] != docid:
+            return None
+        return Posting(docid, self.positions[self.offsets[i]:self.offsets[i+1]].tolist())
+
+    def postings(self):
+        ''' iterate over the Postings in docID order'''
+        offsets = self.offsets
+        for i in range(len(self.docids)):
+            yield Posting(self.docids[i], self.positions[offsets[i]:offsets[i+1]].tolist())
 
     def sort(self):
         ''' sort by document ID for more efficient merging. For each document also sort the positions'''
         # ToDo (Done)
-        # Sort by document ID and save the sorted docID order to the self.sorted_postings list
-        self.sorted_postings = sorted(self.posting.iterkeys())
+        # Documents are indexed in increasing docID order, so the arrays are usually sorted already
+        if self.is_sorted:
+            return
+
+        # Gather the positions of each docID, merging repeated runs of the same document
+        runs = {}
+        offsets = self.offsets
+        for i in range(len(self.docids)):
+            runs.setdefault(self.docids[i], []).extend(self.positions[offsets[i]:offsets[i+1]])
+
+        self.docids = array('i', sorted(runs))
+        self.tfs = array('i')
+        self.offsets = array('i', [0])
+        self.positions = array('i')
+        for docid in self.docids:
+            positions = sorted(runs[docid])
+            self.tfs.append(len(positions))
+            self.positions.extend(positions)
+            self.offsets.append(len(self.positions))
+        self.is_sorted = True
+
+    def __getstate__(self):
+        ''' arrays are serialized as plain lists'''
+        return {"term": self.term, "docids": self.docids.tolist(), "tfs": self.tfs.tolist(),
+                "offsets": self.offsets.tolist(), "positions": self.positions.tolist(), "is_sorted": self.is_sorted,
+                "idf": self.idf, "max_weight": self.max_weight}
+
+    def __setstate__(self, state):
+        self.term = state["term"]
+        if "posting" in state:
+            # Index files written with the former one-Posting-object-per-document layout
+            self.__init__(state["term"])
+            for docid in sorted(state["posting"], key=int):
+                for pos in state["posting"][docid].positions:
+                    self.add(int(docid), pos)
+            self.sort()
+            return
+        self.docids = array('i', state["docids"])
+        self.tfs = array('i', state["tfs"])
+        self.offsets = array('i', state["offsets"])
+        self.positions = array('i', state["positions"])
+        self.is_sorted = state["is_sorted"]
+        self.idf = state.get("idf", 0.0)
+        self.max_weight = state.get("max_weight", 0.0)
+
+def inverseDocumentFrequency(nDocs, df):
+    ''' log(total documents / documents with the term)'''
+    return math.log(float(nDocs) / df, 10)
+
+def addSquaredWeights(squares, docids, tfs, idf):
+    ''' add the squared TF-IDF weights of a posting list to the per-docID sums of squares'''
+    for docid, tf in zip(docids, tfs):
+        squares[docid] += (tf * idf) ** 2
+
+def bm25InverseDocumentFrequency(nDocs, df):
+    ''' the BM25 IDF, log(1 + (N - df + 0.5) / (df + 0.5)), which stays positive for frequent terms'''
+    return math.log(1 + (nDocs - df + 0.5) / (df + 0.5))
+
+def addLengths(lengths, docids, tfs):
+    ''' add the term frequencies of a posting list to the per-docID document lengths'''
+    for docid, tf in zip(docids, tfs):
+        lengths[docid] += tf
+
+def averageLength(lengths, nDocs):
+    return float(sum(lengths)) / nDocs if nDocs else 0.0
+
+def maxWeight(docids, tfs, idf, docNorms):
+    ''' the largest normalized weight tf * idf / document norm of a posting list'''
+    return max([tf * idf / docNorms[docid] for docid, tf in zip(docids, tfs) if docNorms[docid] > 0] or [0.0])
+
+### FIELDS ###
+# The body is indexed under its terms as they are. The other fields of a Document are indexed in the same
+# index under field terms, the field name and the term joined by FIELD_SEPARATOR, which no token contains,
+# each with its own positions, document norms and lengths. Queries restrict a word to a field with title:word
+
+BODY = "body"
+FIELDS = ("title", "author") # the fields indexed besides the body
+FIELD_SEPARATOR = "\x1f"
+FIELD_SECTIONS = {"title": (b"TINORM", b"TILEN"), "author": (b"AUNORM", b"AULEN")} # index file sections of the field statistics
+
+def fieldTerm(field, term):
+    ''' the index term of a term in a field'''
+    return term if field == BODY else field + FIELD_SEPARATOR + term
+
+def termField(term):
+    ''' the field of an index term'''
+    return term.split(FIELD_SEPARATOR, 1)[0] if FIELD_SEPARATOR in term else BODY
+
+def splitField(word):
+    ''' split a field restricted query word, title:lift, into its field and word; other words are in the body'''
+    field, separator, rest = word.partition(":")
+    if separator and rest and field.lower() in (BODY,) + FIELDS:
+        return field.lower(), rest
+    return BODY, word
+
+class FieldStatistics:
+    ''' accumulates the sums of squared TF-IDF weights and the lengths of the documents in each field,
+        from posting lists added in sorted term order'''
+
+    def __init__(self, maxDocID):
+        self.maxDocID = maxDocID
+        self.squares = {}
+        self.lengths = {}
+
+    def add(self, term, docids, tfs, idf):
+        self.addWeights(term, docids, tfs, idf)
+        addLengths(self.lengths[termField(term)], docids, tfs)
+
+    def addWeights(self, term, docids, tfs, idf):
+        ''' add the squared weights of a posting list only, when the lengths of the documents are set apart'''
+        field = termField(term)
+        if field not in self.squares:
+            self.squares[field] = array('d', [0.0]) * (self.maxDocID + 1)
+            self.lengths[field] = array('i', [0]) * (self.maxDocID + 1)
+        addSquaredWeights(self.squares[field], docids, tfs, idf)
+
+    def fields(self, nDocs):
+        ''' {field: (document norms, document lengths, average length)}, always including the body'''
+        if BODY not in self.squares:
+            self.add(BODY, [], [], 0.0)
+        return dict([(field, (array('d', [math.sqrt(square) for square in self.squares[field]]), self.lengths[field],
+                              averageLength(self.lengths[field], nDocs))) for field in self.squares])
+
+def fieldSections(fieldStats):
+    ''' the index file metadata (field -> average length) and arrays of the statistics of the fields other than the body'''
+    meta, arrays = {}, {}
+    for field, (norms, lengths, avgdl) in fieldStats.items():
+        meta[field] = avgdl
+        arrays[FIELD_SECTIONS[field][0]] = norms
+        arrays[FIELD_SECTIONS[field][1]] = lengths
+    return meta, arrays
 
-        # Sort the positions within each document
-        for docid in self.sorted_postings:
-            self.posting[docid].sort()
-        
 class InvertedIndex:
 
-    def __init__(self):
+    def __init__(self, analyzer=None, postings_cache_size=10000):
         self.items = {} # list of IndexItems
         self.nDocs = 0  # the number of indexed documents
+        self.docids = array('i') # the docIDs of the indexed documents, including those without any indexed term
+        self.source = None # the memory-mapped IndexFile posting lists are decoded from, once loaded
+        self.decoded = LRUCache(postings_cache_size) # the posting lists decoded from source, most recently used
+        self.generation = 0 # incremented whenever the index changes, invalidating cached query results
+        self.docNorms = array('d') # the TF-IDF vector norm of each document, indexed by docID
+        self.docLengths = array('i') # the number of indexed terms of each document, indexed by docID, for BM25
+        self.avgdl = 0.0 # the average document length
+        self.fieldStats = {} # {field: (document norms, document lengths, average length)} of the fields other than the body
+        self.matrix = None # the document x term TF-IDF matrix and its term -> column mapping, built by tfidfMatrix
+        self.analyzer = analyzer if analyzer is not None else Analyzer(record=True) # records the word -> stem map of the indexed vocabulary
+        self.nPostings = 0 # counts of postings and positions added, to estimate the memory used while indexing
+        self.nPositions = 0
+        self.corrector = None # the SpellCorrector of the vocabulary, loaded on first use
+        self.impacts = None # the ImpactIndex of the postings, loaded on first use
 
     def indexDoc(self, doc, mode=0): # indexing a Document object
-        ''' indexing a document, using the simple SPIMI algorithm, but no need to store blocks due to the small collection we are handling. Using save/load the whole index instead'''
+        ''' indexing a document, using the SPIMI algorithm: each term is added directly to its posting list in memory.
+            spimi.py flushes the in-memory index as a sorted block once a memory budget is reached, and merges the blocks'''
 
         # ToDo: indexing only title and body; use some functions defined in util.py (Done)
         # (1) convert to lower cases, (Done)
         # (2) remove stopwords, (Done)
         # (3) stemming (Done)
 
-        # Tokenizing
-        document_terms = lowerCaseAndSplit(doc.body)
-        if mode == "test":
-            print("List of tokens (lowercased):\n{}\n".format(document_terms))
-
-        # Remove stopwords
-        document_terms = removeStopWords(document_terms)
+        # Tokenizing, then removing stopwords and stemming in a single pass with the Analyzer
+        tokens = self.analyzer.tokenize(doc.body)
+        document_terms = self.analyzer.analyzeTokens(tokens)
         if mode == "test":
+            print("List of tokens (lowercased):\n{}\n".format(tokens))
             # Test for stopwords removal
-            print("After stopwords removal:\n{}\n".format(document_terms))
-
-        # Stem the list of terms
-        document_terms = stemming(document_terms)
-        if mode == "test":
+            print("After stopwords removal:\n{}\n".format([token for token in tokens if not self.analyzer.isStopWord(token)]))
             # Test for stemming
             print("After stemming:\n{}\n".format(document_terms))
 
@@ -106,6 +321,15 @@ class InvertedIndex:
         for i in range(len(document_terms)):
             terms_with_positions.append((document_terms[i], i+1))
 
+        # The other fields, as field terms with their own positions
+        for field in FIELDS:
+            field_terms = self.analyzer.analyze(getattr(doc, field, "") or "")
+            for i in range(len(field_terms)):
+                terms_with_positions.append((fieldTerm(field, field_terms[i]), i+1))
+
+        self.nPostings += len(set([term for term, _ in terms_with_positions]))
+        self.nPositions += len(terms_with_positions)
+
         # Create an IndexItem object for each 
         for term in terms_with_positions:
             if term[0] not in self.items:
@@ -115,6 +339,27 @@ class InvertedIndex:
                 self.items[term[0]].add(int(doc.docID), int(term[1]))
         
         self.nDocs += 1
+        self.docids.append(int(doc.docID))
+        self.generation += 1
+
+    def merge(self, documents, postings, vocabulary):
+        ''' merge a partial index built over other documents, e.g. by a worker process; documents is the
+            array of their docIDs, postings a list of (term, docids, tfs, positions) with sorted arrays'''
+        for term, docids, tfs, positions in postings:
+            if term not in self.items:
+                self.items[term] = IndexItem(term)
+            self.items[term].extend(docids, tfs, positions)
+            self.nPostings += len(docids)
+            self.nPositions += len(positions)
+        self.nDocs += len(documents)
+        self.docids.extend(documents)
+        self.generation += 1
+        self.analyzer.vocabulary.update(vocabulary)
+
+    def memoryUsage(self):
+        ''' estimate the bytes used by the posting lists being built: 4 bytes per docID, term frequency,
+            offset and position, plus about 2 KB per term for the IndexItem object, its arrays and its dict entry'''
+        return 12 * self.nPostings + 4 * self.nPositions + 2048 * len(self.items)
 
     def sort(self):
         ''' sort all posting lists by docID'''
@@ -126,39 +371,230 @@ class InvertedIndex:
         # ToDo (Done)
         self.items = OrderedDict(sorted(self.items.items(), key=lambda t: t[0]))
 
+        self.computeStatistics()
+
+    def computeStatistics(self):
+        ''' precompute the IDF of every term, the norm of every document's TF-IDF vector, the document
+            lengths and the upper bound of every term's score contribution, so that query processing
+            needs no collection-wide computation'''
+        for item in self.items.values():
+            item.sort()
+        maxDocID = max([item.docids[-1] for item in self.items.values() if item.docids] or [0])
+        statistics = FieldStatistics(maxDocID)
+
+        for term in sorted(self.items):
+            item = self.items[term]
+            item.idf = inverseDocumentFrequency(self.nDocs, len(item.docids))
+            statistics.add(term, item.docids, item.tfs, item.idf)
+        self.setFieldStatistics(statistics.fields(self.nDocs))
+
+        # Upper bound of the normalized weight of each term, used to skip documents in WAND
+        for term, item in self.items.items():
+            item.max_weight = maxWeight(item.docids, item.tfs, item.idf, self.norms(termField(term)))
+        self.generation += 1
+
+    def setFieldStatistics(self, fields):
+        ''' set the document norms, lengths and average lengths of every field, as computed by FieldStatistics'''
+        self.docNorms, self.docLengths, self.avgdl = fields.pop(BODY)
+        self.fieldStats = fields
+
     def find(self, term):
-        return self.items.get(term, "None")
+        ''' return the IndexItem of a term, or "None". Posting lists of a loaded index are decoded on access
+            and kept in a bounded LRU cache, so that frequent terms are reused across queries'''
+        item = self.items.get(term)
+        if item is None and self.source is not None:
+            item = self.decoded.get(term)
+            if item is None:
+                i = self.source.lookup(term)
+                if i >= 0:
+                    item = IndexItem(term)
+                    item.load(*self.source.postings(i))
+                    item.idf = self.source.idf(i)
+                    item.max_weight = self.source.max_weight(i)
+                    self.decoded.put(term, item)
+        return item if item is not None else "None"
+
+    def terms(self):
+        ''' return all indexed terms in sorted order'''
+        if self.source is not None:
+            return list(self.source.terms())
+        return sorted(self.items)
 
     def save(self, filename):
         ''' save to disk'''
         # ToDo: using your preferred method to serialize/deserialize the index (Done)
+        # The index is saved in the binary format of indexfile.py
         print("Saving to disk...")
-        with open(filename, "w") as f:
-            for term in self.items:
-                f.write(jsonpickle.encode(self.items[term]))
-                f.write('\n')
-            f.write(jsonpickle.encode(self.nDocs))
-        
+        writer = IndexWriter(filename)
+        for term in self.terms():
+            item = self.find(term)
+            item.sort()
+            writer.add(term, item.docids, item.tfs, item.positions, item.idf, item.max_weight)
+        fields, arrays = fieldSections(self.fieldStats)
+        arrays.update({b"DOCNORM": self.docNorms, b"DOCLEN": self.docLengths, b"DOCIDS": array('i', sorted(self.docids))})
+        writer.close({"nDocs": self.nDocs, "avgdl": self.avgdl, "fields": fields, "analyzer": self.analyzer.config()},
+                     arrays, {b"VOCAB": self.analyzer.vocabulary})
+
+        # The spelling correction index of the vocabulary, next to the index file
+        writeSpellIndex(filename)
+        removeImpactIndex(filename)
+        removeDocumentStore(filename)
+
         print("InvertedIndex successfully saved to {}\n".format(filename))
 
     def load(self, filename):
         ''' load from disk'''
         # ToDo (Done)
         print("Loading from disk...")
-        with open(filename, "r") as f:
-            data = f.readlines()
-            for i in range(len(data)-1):
-                indexItem = jsonpickle.decode(data[i])
-                self.items[indexItem.term] = indexItem
-            self.nDocs = jsonpickle.decode(data[-1])
-        
+        self.close()
+        self.items = {}
+        self.docids = array('i')
+        self.decoded.clear()
+        self.corrector = None
+        self.impacts = None
+        self.matrix = None
+        self.generation += 1
+        if isIndexFile(filename):
+            # Only the header and the metadata are read here, posting lists are decoded lazily by find()
+            self.source = IndexFile(filename)
+            self.nDocs = self.source.meta["nDocs"]
+            self.docids = self.source.array(b"DOCIDS", 'i') if b"DOCIDS" in self.source.sections else array('i')
+            self.docNorms = self.source.array(b"DOCNORM", 'd')
+            self.docLengths = self.source.array(b"DOCLEN", 'i')
+            self.avgdl = self.source.meta["avgdl"]
+            self.fieldStats = dict([(field, (self.source.array(FIELD_SECTIONS[field][0], 'd'), self.source.array(FIELD_SECTIONS[field][1], 'i'), avgdl))
+                                    for field, avgdl in self.source.meta["fields"].items()])
+
+            # Restore the Analyzer used at indexing time, warm with its vocabulary -> stem map
+            config = self.source.meta["analyzer"]
+            self.analyzer = Analyzer(config["stopwords"], config["stemmer"], config["cache_size"], self.source.stringMap(b"VOCAB"))
+        else:
+            # Index files written by jsonpickle, one IndexItem per line
+            with open(filename, "r") as f:
+                data = f.readlines()
+                for i in range(len(data)-1):
+                    indexItem = jsonpickle.decode(data[i])
+                    if not hasattr(indexItem, "docids"):
+                        # Convert an IndexItem saved with the former Posting-per-document layout
+                        indexItem.__setstate__(dict(indexItem.__dict__))
+                    self.items[indexItem.term] = indexItem
+                self.nDocs = jsonpickle.decode(data[-1])
+            self.analyzer = Analyzer()
+            self.computeStatistics()
+
         print("InvertedIndex successfully loaded to memory from {}\n".format(filename))
 
+    def close(self):
+        ''' release the memory-mapped index file, if any'''
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.corrector is not None:
+            self.corrector.close()
+            self.corrector = None
+        if self.impacts is not None:
+            self.impacts.close()
+            self.impacts = None
+
+    def spellCorrector(self):
+        ''' return the SpellCorrector of the indexed vocabulary. A loaded index memory-maps the correction index
+            saved next to it on first use, or returns None if there is none; an in-memory index builds one'''
+        if self.corrector is None:
+            if self.source is not None:
+                self.corrector = loadSpellIndex(self.source.filename)
+            else:
+                weights = {}
+                for word, stem in self.analyzer.vocabulary.items():
+                    item = self.find(stem)
+                    if item != "None":
+                        weights[word] = len(item.docids)
+                self.corrector = buildCorrector(weights)
+        return self.corrector
+
+    def impactIndex(self):
+        ''' return the ImpactIndex of the postings, see impact.py. A loaded index memory-maps the impact index
+            saved next to it on first use; without one, or for an in-memory index, it is built in memory'''
+        if self.impacts is None:
+            if self.source is not None:
+                self.impacts = loadImpactIndex(self.source.filename)
+            if self.impacts is None:
+                self.impacts = buildImpactIndex(self, self.fieldNorms)
+        return self.impacts
+
+    def writeImpacts(self, filename):
+        ''' write the impact index of the postings next to the index file filename'''
+        writeImpactIndex(self, filename, self.fieldNorms)
+
+    def fieldNorms(self, term):
+        ''' return the document norms of the field of an index term'''
+        return self.norms(termField(term))
+
     def idf(self, term):
-        ''' compute the inverted document frequency for a given term'''
+        ''' return the inverted document frequency for a given term'''
         # ToDo: return the IDF of the term
-        # log(total documents/ documents with term i)
-        return math.log(self.nDocs / len(self.items[term].sorted_postings), 10)
+        # log(total documents/ documents with term i), precomputed by computeStatistics
+        return self.find(term).idf
+
+    def docFrequency(self, term):
+        ''' return the number of documents containing a term'''
+        item = self.find(term)
+        return len(item.docids) if item != "None" else 0
+
+    def documents(self):
+        ''' return the sorted docIDs of the indexed documents, including those without any indexed term.
+            Index files written before the docIDs were recorded only know the documents with an indexed
+            term in any field, the body, title or author'''
+        if self.docids:
+            return sorted(self.docids)
+        lengths = [self.lengths(field) for field in (BODY,) + FIELDS]
+        return [docid for docid in range(max([len(field_lengths) for field_lengths in lengths]))
+                if any([docid < len(field_lengths) and field_lengths[docid] > 0 for field_lengths in lengths])]
+
+    def docNorm(self, docid):
+        ''' return the norm of the document's TF-IDF vector'''
+        return self.docNorms[docid]
+
+    def norms(self, field=BODY):
+        ''' return the array of document norms in a field, indexed by docID'''
+        if field == BODY:
+            return self.docNorms
+        return self.fieldStats[field][0] if field in self.fieldStats else array('d')
+
+    def lengths(self, field=BODY):
+        ''' return the array of document lengths in a field, indexed by docID'''
+        if field == BODY:
+            return self.docLengths
+        return self.fieldStats[field][1] if field in self.fieldStats else array('i')
+
+    def averageDocLength(self, field=BODY):
+        ''' return the average document length in a field'''
+        if field == BODY:
+            return self.avgdl
+        return self.fieldStats[field][2] if field in self.fieldStats else 0.0
+
+    def tfidfMatrix(self):
+        ''' export the body of the index as a scipy.sparse CSR matrix with one row per docID and one column per term,
+            holding the L2 normalized TF-IDF weights. Returns (matrix, {term: column}), built once and cached'''
+        if self.matrix is None:
+            columns = {}
+            rows, cols, data = array('i'), array('i'), array('d')
+            for term in self.terms():
+                if FIELD_SEPARATOR in term:
+                    continue
+                item = self.find(term)
+                columns[term] = len(columns)
+                for docid, tf in zip(item.docids, item.tfs):
+                    if self.docNorms[docid] > 0:
+                        rows.append(docid)
+                        cols.append(columns[term])
+                        data.append(tf * item.idf / self.docNorms[docid])
+
+            rows = np.frombuffer(rows, dtype=np.int32)
+            cols = np.frombuffer(cols, dtype=np.int32)
+            data = np.frombuffer(data, dtype=np.float64)
+            matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(self.docNorms), len(columns)))
+            self.matrix = (matrix, columns)
+        return self.matrix
 
     # more methods if needed
 
@@ -187,9 +623,9 @@ def test():
 
     # Check the posting list, term frequency, and IDF
     print("== Statistics for the term 'lift' BEFORE saving the index to disk (invertedIndex_1) ==")
-    print("Posting list:\t{}".format(invertedIndex_1.find("lift").sorted_postings))
-    print("Positions:\t{}".format(invertedIndex_1.find("lift").posting[1].positions))
-    print("TF:\t\t{}".format(invertedIndex_1.find("lift").posting[1].term_freq()))
+    print("Posting list:\t{}".format(invertedIndex_1.find("lift").sorted_postings.tolist()))
+    print("Positions:\t{}".format(invertedIndex_1.find("lift").get(1).positions))
+    print("TF:\t\t{}".format(invertedIndex_1.find("lift").get(1).term_freq()))
     print("IDF:\t\t{}\n".format(round(invertedIndex_1.idf("lift"), 5)))
 
     # Save the invertedIndex
@@ -203,36 +639,118 @@ def test():
 
     # Check the posting list, term frequency, and IDF
     print("== Statistics for the term 'lift' AFTER loading the index from disk (invertedIndex_2) ==")
-    print("Posting list:\t{}".format(invertedIndex_2.find("lift").sorted_postings))
-    print("Positions:\t{}".format(invertedIndex_2.find("lift").posting["1"].positions))
-    print("TF:\t\t{}".format(invertedIndex_2.find("lift").posting["1"].term_freq()))
+    print("Posting list:\t{}".format(invertedIndex_2.find("lift").sorted_postings.tolist()))
+    print("Positions:\t{}".format(invertedIndex_2.find("lift").get(1).positions))
+    print("TF:\t\t{}".format(invertedIndex_2.find("lift").get(1).term_freq()))
     print("IDF:\t\t{}\n".format(round(invertedIndex_2.idf("lift"), 5)))
 
     print('Pass')
 
-def indexingCranfield():
-    # ToDo: indexing the Cranfield dataset and save the index to a file (Done)
-    # command line usage: "python index.py cran.all index_file" (Done)
-    # the index is saved to index_file (Done)
-
-    # Import the cran.all collection
-    cf = CranFile(sys.argv[1])
-
-    # Instantiate an invertedIndex
+_worker_analyzer = None
+
+def indexBatch(docs):
+    ''' index a batch of documents in a worker process; return a picklable partial index
+        (docIDs, [(term, docids, tfs, positions)], vocabulary) to merge with InvertedIndex.merge'''
+    global _worker_analyzer
+    if _worker_analyzer is None:
+        _worker_analyzer = Analyzer(record=True)
+
+    # The Analyzer and its stem cache stay warm across batches; each batch reports the new words it stemmed
+    _worker_analyzer.vocabulary = {}
+    partial = InvertedIndex(_worker_analyzer)
+    for doc in docs:
+        partial.indexDoc(doc)
+
+    postings = []
+    for term in partial.items:
+        item = partial.items[term]
+        item.sort()
+        postings.append((term, item.docids, item.tfs, item.positions))
+    return partial.docids, postings, _worker_analyzer.vocabulary
+
+def batches(docs, size):
+    ''' split a document stream into lists of consecutive documents'''
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def buildIndex(docs, workers=1, batch_size=250):
+    ''' index a document stream and return the sorted InvertedIndex. With several workers, batches of
+        consecutive documents are indexed by a process pool and the partial indexes are merged in stream
+        order, so the result is identical to the serial build'''
     invertedIndex = InvertedIndex()
 
-    # Loop through and index each document in the Cran collection
-    for doc in cf.docs:
-        print("Indexing document {}".format(doc.docID))
-        invertedIndex.indexDoc(doc)
-
-    print("\nTotal documents indexed: {}".format(invertedIndex.nDocs))
+    if workers <= 1:
+        for doc in docs:
+            invertedIndex.indexDoc(doc)
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for documents, postings, vocabulary in pool.imap(indexBatch, batches(docs, batch_size)):
+                invertedIndex.merge(documents, postings, vocabulary)
+        finally:
+            pool.close()
+            pool.join()
 
     # Sort the invertedIndex
     invertedIndex.sort()
+    return invertedIndex
 
-    # Save the invertedIndex
-    invertedIndex.save(sys.argv[2])
+def indexingCranfield():
+    # ToDo: indexing the Cranfield dataset and save the index to a file (Done)
+    # command line usage: "python index.py cran.all index_file" (Done)
+    # the index is saved to index_file (Done)
+
+    # Parse the commandline
+    parser = argparse.ArgumentParser(description="Index a collection and save the index to index_file")
+    parser.add_argument("collection")
+    parser.add_argument("index_file")
+    parser.add_argument("--format", choices=sorted(READERS), default="cranfield", help="format of the collection file")
+    parser.add_argument("--workers", type=int, default=1, help="number of indexing processes")
+    parser.add_argument("--batch-size", type=int, default=250, help="number of documents per batch sent to a worker")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="index with SPIMI, flushing sorted blocks to disk whenever the in-memory block reaches this many MB")
+    parser.add_argument("--impacts", action="store_true",
+                        help="also write the impact-ordered postings, for score-at-a-time queries (--strategy impact)")
+    parser.add_argument("--docstore", action="store_true",
+                        help="also write the compressed document store, for result titles and snippets without the collection")
+    args = parser.parse_args()
+
+    # Stream the collection and index each document as it is read
+    start = time.time()
+    if args.memory_budget is not None:
+        # spimi imports this module, hence the local import
+        from spimi import spimiIndex
+        nDocs, nBlocks = spimiIndex(readCorpus(args.collection, args.format), args.index_file, int(args.memory_budget * 1024 * 1024))
+        elapsed = time.time() - start
+        print("Total documents indexed: {} in {} block(s)".format(nDocs, nBlocks))
+        print("Indexing time: {:.3f} s ({:.1f} docs/sec)\n".format(elapsed, nDocs / max(elapsed, 1e-9)))
+        print("InvertedIndex successfully saved to {}\n".format(args.index_file))
+    else:
+        invertedIndex = buildIndex(readCorpus(args.collection, args.format), args.workers, args.batch_size)
+        elapsed = time.time() - start
+
+        print("Total documents indexed: {}".format(invertedIndex.nDocs))
+        print("Indexing time: {:.3f} s ({:.1f} docs/sec with {} worker(s))\n".format(elapsed, invertedIndex.nDocs / max(elapsed, 1e-9), max(args.workers, 1)))
+
+        # Save the invertedIndex
+        invertedIndex.save(args.index_file)
+
+    if args.impacts:
+        invertedIndex = InvertedIndex()
+        invertedIndex.load(args.index_file)
+        invertedIndex.writeImpacts(args.index_file)
+        invertedIndex.close()
+        print("Impact-ordered postings saved to {}\n".format(impactFilename(args.index_file)))
+
+    if args.docstore:
+        nDocs = writeDocumentStore(readCorpus(args.collection, args.format), args.index_file)
+        print("{} documents saved to {}\n".format(nDocs, docstoreFilename(args.index_file)))
 
     print('Done')
 
@@ -0,0 +1,295 @@
+'''
+binary on-disk format of the InvertedIndex
+
+    header      magic "SSEINDEX", format version, number of sections and a table of
+                (name, offset, length) entries locating each section in the file
+
+    sections    8-byte aligned byte ranges:
+
+        META        JSON metadata of the index (nDocs, average document length, byte order, ...)
+        TERMS       one fixed-size record per term, sorted by term (the title and author terms are
+                    prefixed with their field, see index.fieldTerm):
+                    (term offset, term length, document frequency, postings offset, positions offset,
+                    idf, max weight: the largest tf * idf / document norm of the term)
+        TERMSTR     the utf-8 bytes of all terms, referenced by the term records
+        POSTINGS    for each term, its docIDs followed by their term frequencies (int32)
+        POSITION    for each term, the flat positions buffer of its posting list (int32)
+        DOCNORM     the TF-IDF vector norm of each document, indexed by docID (float64)
+        DOCLEN      the length of each document in indexed terms, indexed by docID (int32)
+        TINORM      the norms and lengths of the documents' title,
+        TILEN
+        AUNORM      and of their author field, like DOCNORM and DOCLEN
+        AULEN
+        DOCIDS      the sorted docIDs of all the indexed documents, even those without any indexed term (int32)
+        VOCAB       the word -> stem map of the analyzer, as a sorted string map:
+                    the number of entries n, n + 1 offsets into a blob of "key\0value" entries
+
+    the file is opened with mmap: the term dictionary is binary searched in place and a
+    posting list is only decoded the first time it is looked up
+'''
+
+import sys
+import json
+import mmap
+import struct
+import shutil
+import tempfile
+
+from array import array
+
+MAGIC = b"SSEINDEX"
+VERSION = 5
+
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<8sQQ")
+MAX_SECTIONS = 16
+HEADER_SIZE = HEADER.size + MAX_SECTIONS * SECTION.size
+
+TERM_RECORD = struct.Struct("<QIIQQdd")
+
+def _encode(term):
+    return term if isinstance(term, bytes) else term.encode("utf-8")
+
+def _decode(data):
+    return data if str is bytes else data.decode("utf-8")
+
+def _tobytes(values):
+    return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+def _stringMap(mapping):
+    ''' encode a string -> string mapping as a sorted string map section'''
+    entries = [_encode(key) + b"\0" + _encode(value) for key, value in sorted(mapping.items())]
+    offsets = [0]
+    for entry in entries:
+        offsets.append(offsets[-1] + len(entry))
+    return struct.pack("<Q{}Q".format(len(offsets)), len(entries), *offsets) + b"".join(entries)
+
+def isIndexFile(filename):
+    ''' return true if the file is written in the binary index format'''
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class IndexWriter:
+    ''' write an index file term by term, in increasing term order.
+        postings are streamed to disk, only the term dictionary is kept in memory'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "wb")
+        self.f.write(b"\0" * HEADER_SIZE)
+        self.sections = []
+
+        # The postings are written directly into the index file, the positions to a spill file
+        self.postings_start = self.f.tell()
+        self.positions = tempfile.TemporaryFile()
+        self.positions_size = 0
+
+        self.records = []
+        self.termstr = []
+        self.termstr_size = 0
+        self.last_term = None
+
+    def add(self, term, docids, tfs, positions, idf, max_weight):
+        ''' append the posting list of a term; docids, tfs and positions are int32 arrays'''
+        term = _encode(term)
+        if self.last_term is not None and term <= self.last_term:
+            raise ValueError("Terms must be added in increasing order: {!r} after {!r}".format(term, self.last_term))
+        self.last_term = term
+
+        postings_offset = self.f.tell() - self.postings_start
+        self.f.write(_tobytes(docids))
+        self.f.write(_tobytes(tfs))
+
+        positions_offset = self.positions_size
+        data = _tobytes(positions)
+        self.positions.write(data)
+        self.positions_size += len(data)
+
+        self.records.append(TERM_RECORD.pack(self.termstr_size, len(term), len(docids), postings_offset, positions_offset, idf, max_weight))
+        self.termstr.append(term)
+        self.termstr_size += len(term)
+
+    def _section(self, name, data=None):
+        ''' start a new aligned section, writing data if given; return its offset'''
+        self.f.write(b"\0" * (-self.f.tell() % 8))
+        offset = self.f.tell()
+        if data is not None:
+            self.f.write(data)
+            self.sections.append((name, offset, len(data)))
+        return offset
+
+    def close(self, meta, arrays={}, maps={}):
+        ''' write the term dictionary, the named per-document arrays and string maps, the metadata and the header'''
+        self.sections.append((b"POSTINGS", self.postings_start, self.f.tell() - self.postings_start))
+
+        offset = self._section(b"POSITION")
+        self.positions.seek(0)
+        shutil.copyfileobj(self.positions, self.f)
+        self.positions.close()
+        self.sections.append((b"POSITION", offset, self.positions_size))
+
+        self._section(b"TERMSTR", b"".join(self.termstr))
+        self._section(b"TERMS", b"".join(self.records))
+        for name in sorted(arrays):
+            self._section(name, _tobytes(arrays[name]))
+        for name in sorted(maps):
+            self._section(name, _stringMap(maps[name]))
+
+        meta = dict(meta)
+        meta["byteorder"] = sys.byteorder
+        meta["nTerms"] = len(self.records)
+        self._section(b"META", json.dumps(meta, sort_keys=True).encode("utf-8"))
+
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, len(self.sections)))
+        for name, offset, length in self.sections:
+            self.f.write(SECTION.pack(name, offset, length))
+        self.f.close()
+
+class IndexFile:
+    ''' read-only, memory-mapped view of an index file'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, nSections = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a binary index file".format(filename))
+        if version != VERSION:
+            raise ValueError("{} uses index format version {}, expected {}. Please rebuild the index".format(filename, version, VERSION))
+
+        self.sections = {}
+        for i in range(nSections):
+            name, offset, length = SECTION.unpack_from(self.mm, HEADER.size + i * SECTION.size)
+            self.sections[name.rstrip(b"\0")] = (offset, length)
+
+        self.meta = json.loads(self.section(b"META").decode("utf-8"))
+        self.swap = self.meta["byteorder"] != sys.byteorder
+        self.nTerms = self.meta["nTerms"]
+        self.terms_offset = self.sections[b"TERMS"][0]
+        self.termstr_offset = self.sections[b"TERMSTR"][0]
+        self.postings_offset = self.sections[b"POSTINGS"][0]
+        self.positions_offset = self.sections[b"POSITION"][0]
+
+    def section(self, name):
+        offset, length = self.sections[name]
+        return self.mm[offset:offset+length]
+
+    def stringMap(self, name):
+        ''' return a StringMap view of a string map section, or None if the index has none'''
+        if name not in self.sections:
+            return None
+        return StringMap(self.mm, self.sections[name][0])
+
+    def _array(self, start, count, typecode='i'):
+        ''' decode count values of the typecode starting at byte offset start'''
+        itemsize = array(typecode).itemsize
+        values = array(typecode, self.mm[start:start + itemsize * count])
+        if self.swap:
+            values.byteswap()
+        return values
+
+    def array(self, name, typecode):
+        ''' decode a whole per-document array section'''
+        offset, length = self.sections[name]
+        return self._array(offset, length // array(typecode).itemsize, typecode)
+
+    def record(self, i):
+        ''' return (term, df, postings offset, positions offset, idf, max weight) of the i-th term'''
+        term_offset, term_len, df, postings_offset, positions_offset, idf, max_weight = TERM_RECORD.unpack_from(self.mm, self.terms_offset + i * TERM_RECORD.size)
+        start = self.termstr_offset + term_offset
+        return self.mm[start:start+term_len], df, postings_offset, positions_offset, idf, max_weight
+
+    def lookup(self, term):
+        ''' binary search the term dictionary; return the record index of the term or -1'''
+        term = _encode(term)
+        lo, hi = 0, self.nTerms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nTerms and self.record(lo)[0] == term:
+            return lo
+        return -1
+
+    def idf(self, i):
+        return self.record(i)[4]
+
+    def max_weight(self, i):
+        return self.record(i)[5]
+
+    def frequencies(self, i):
+        ''' decode the (docids, tfs) arrays of the i-th term'''
+        term, df, postings_offset, positions_offset, idf, max_weight = self.record(i)
+        start = self.postings_offset + postings_offset
+        return self._array(start, df), self._array(start + 4 * df, df)
+
+    def postings(self, i):
+        ''' decode the (docids, tfs, positions) arrays of the i-th term'''
+        term, df, postings_offset, positions_offset, idf, max_weight = self.record(i)
+        start = self.postings_offset + postings_offset
+        docids = self._array(start, df)
+        tfs = self._array(start + 4 * df, df)
+        positions = self._array(self.positions_offset + positions_offset, sum(tfs))
+        return docids, tfs, positions
+
+    def terms(self):
+        ''' iterate over all terms in sorted order'''
+        for i in range(self.nTerms):
+            yield _decode(self.record(i)[0])
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+class StringMap:
+    ''' read-only view of a sorted string map section, binary searched in place'''
+
+    PROBE_DEPTH = 12 # the keys of the first binary search probes, the same for every lookup, are kept decoded
+
+    def __init__(self, mm, offset):
+        self.mm = mm
+        self.n = struct.unpack_from("<Q", mm, offset)[0]
+        self.offsets = offset + 8
+        self.blob = self.offsets + 8 * (self.n + 1)
+        self.probes = {}
+
+    def entry(self, i):
+        start, end = struct.unpack_from("<QQ", self.mm, self.offsets + 8 * i)
+        key, value = self.mm[self.blob+start:self.blob+end].split(b"\0", 1)
+        return key, value
+
+    def get(self, key, default=None):
+        key = _encode(key)
+        lo, hi = 0, self.n
+        depth = 0
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if depth < self.PROBE_DEPTH:
+                probe = self.probes.get(mid)
+                if probe is None:
+                    probe = self.probes[mid] = self.entry(mid)[0]
+                depth += 1
+            else:
+                probe = self.entry(mid)[0]
+            if probe < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n:
+            entry_key, value = self.entry(lo)
+            if entry_key == key:
+                return _decode(value)
+        return default
+
+    def items(self):
+        for i in range(self.n):
+            key, value = self.entry(i)
+            yield _decode(key), _decode(value)
+
+    def __len__(self):
+        return self.n
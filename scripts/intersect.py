@@ -0,0 +1,177 @@
+'''
+conjunctive intersection of sorted docID lists
+
+    merge:      linear merge, walking both lists in step. Best when the lists have similar lengths
+    skip:       walks the shorter list and follows sqrt(n)-spaced skip pointers over the longer one
+    gallop:     exponential search for each docID of the shorter list in the longer one,
+                best when one list is much shorter than the other
+
+    intersect() picks a strategy from the length ratio of the two lists and
+    intersectAll() intersects N lists, starting from the rarest term
+
+    PostingCursor walks a posting list document-at-a-time, with galloping advance
+
+    phraseMatch() and withinDistance() check the positional constraints of phrase and NEAR/k queries
+'''
+
+import math
+
+from bisect import bisect_left
+
+SKIP_RATIO = 4      # use skip pointers when the longer list is at least 4 times longer
+GALLOP_RATIO = 32   # use galloping search when it is at least 32 times longer
+
+def merge(list_1, list_2):
+    ''' linear merge of two sorted lists'''
+    answer = []
+    i, j = 0, 0
+    len_1, len_2 = len(list_1), len(list_2)
+
+    while i < len_1 and j < len_2:
+        if list_1[i] == list_2[j]:
+            answer.append(list_1[i])
+            i += 1
+            j += 1
+        elif list_1[i] < list_2[j]:
+            i += 1
+        else:
+            j += 1
+
+    return answer
+
+def skip(short, long):
+    ''' intersect using skip pointers spaced sqrt(len(long)) apart on the longer list'''
+    answer = []
+    step = max(int(math.sqrt(len(long))), 1)
+    j = 0
+    len_long = len(long)
+
+    for docid in short:
+        # Follow the skip pointers while they do not overshoot the docID, then scan linearly
+        while j + step < len_long and long[j + step] <= docid:
+            j += step
+        while j < len_long and long[j] < docid:
+            j += 1
+        if j == len_long:
+            break
+        if long[j] == docid:
+            answer.append(docid)
+            j += 1
+
+    return answer
+
+def gallop(short, long):
+    ''' intersect using exponential search of each docID of the shorter list in the longer list'''
+    answer = []
+    lo = 0
+    len_long = len(long)
+
+    for docid in short:
+        # Double the probe distance until it passes the docID, then binary search the last interval
+        bound = 1
+        while lo + bound < len_long and long[lo + bound] < docid:
+            bound *= 2
+        lo = bisect_left(long, docid, lo + bound // 2, min(lo + bound + 1, len_long))
+        if lo == len_long:
+            break
+        if long[lo] == docid:
+            answer.append(docid)
+            lo += 1
+
+    return answer
+
+def intersect(list_1, list_2):
+    ''' intersect two sorted docID lists, choosing the strategy from their length ratio'''
+    if len(list_1) > len(list_2):
+        list_1, list_2 = list_2, list_1
+    if not list_1:
+        return []
+
+    ratio = len(list_2) / float(len(list_1))
+    if ratio >= GALLOP_RATIO:
+        return gallop(list_1, list_2)
+    if ratio >= SKIP_RATIO:
+        return skip(list_1, list_2)
+    return merge(list_1, list_2)
+
+def intersectAll(lists):
+    ''' N-way intersection, starting from the rarest list so intermediate results stay short'''
+    if not lists:
+        return []
+
+    lists = sorted(lists, key=len)
+    answer = list(lists[0])
+    for postings in lists[1:]:
+        if not answer:
+            break
+        answer = intersect(answer, postings)
+
+    return answer
+
+END = 2 ** 31 # docID of an exhausted cursor, larger than any int32 docID
+
+class PostingCursor:
+    ''' document-at-a-time iterator over a sorted docID list (and optionally its term frequencies)'''
+
+    def __init__(self, docids, tfs=None):
+        self.docids = docids
+        self.tfs = tfs
+        self.i = 0
+        self.docid = docids[0] if len(docids) else END
+        self.cost = len(docids)
+        self.gallop = True # advance by galloping search, or by a linear scan when the targets are close
+
+    def next(self):
+        ''' move to the next docID'''
+        self.i += 1
+        self.docid = self.docids[self.i] if self.i < len(self.docids) else END
+        return self.docid
+
+    def advance(self, target):
+        ''' move to the first docID >= target, galloping from the current position unless gallop is off'''
+        if self.docid >= target:
+            return self.docid
+        if not self.gallop:
+            while self.docid < target:
+                self.next()
+            return self.docid
+        docids = self.docids
+        bound = 1
+        while self.i + bound < len(docids) and docids[self.i + bound] < target:
+            bound *= 2
+        self.i = bisect_left(docids, target, self.i + bound // 2, min(self.i + bound + 1, len(docids)))
+        self.docid = docids[self.i] if self.i < len(docids) else END
+        return self.docid
+
+    def tf(self):
+        return self.tfs[self.i]
+
+def phraseMatch(positions, offsets):
+    ''' true if the terms occur at the given relative offsets: there is a position p such that
+        p + offsets[j] is in positions[j] for every term j. positions are sorted lists'''
+    # Start from the rarest term, then keep the start positions that every other term confirms
+    rarest = min(range(len(positions)), key=lambda j: len(positions[j]))
+    starts = [p - offsets[rarest] for p in positions[rarest]]
+    for j in range(len(positions)):
+        if j == rarest or not starts:
+            continue
+        others = positions[j]
+        confirmed = []
+        for start in starts:
+            i = bisect_left(others, start + offsets[j])
+            if i < len(others) and others[i] == start + offsets[j]:
+                confirmed.append(start)
+        starts = confirmed
+    return len(starts) > 0
+
+def withinDistance(positions_1, positions_2, k):
+    ''' true if two sorted position lists have positions at most k apart, in any order'''
+    i, j = 0, 0
+    while i < len(positions_1) and j < len(positions_2):
+        if abs(positions_1[i] - positions_2[j]) <= k:
+            return True
+        if positions_1[i] < positions_2[j]:
+            i += 1
+        else:
+            j += 1
+    return False
@@ -6,22 +6,80 @@ query processing
 
 import sys
 import doc
+import boolean
 import math
-import copy
+import heapq
+import argparse
 import numpy as np
 
+from scipy import sparse
+
 from util import *
 from index import *
 from cranqry import *
-from norvig_spell import correction
+from intersect import intersectAll, PostingCursor, END
+from impact import segmentEnd
+from snippets import snippet, positionMatches
+from docstore import loadDocumentStore
+from timing import QueryTimer, StageProfile, NULL_TIMER, profileCall
+
+BM25_K1 = 1.2 # term frequency saturation
+BM25_B = 0.75 # document length normalization
+
+class QueryCache:
+    ''' LRU cache of query results, keyed by the sorted preprocessed terms, the retrieval model and k,
+        so that queries reducing to the same terms share their results. Results are only valid for one
+        generation of the index: the cache is emptied when the index generation changes'''
+
+    def __init__(self, capacity=1000):
+        self.results = LRUCache(capacity)
+        self.generation = None
+
+    def key(self, index, preprocessed_query, model, k):
+        if index.generation != self.generation:
+            self.results.clear()
+            self.generation = index.generation
+        return (tuple(sorted(preprocessed_query)), model, k)
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, results):
+        self.results.put(key, results)
+
+    def stats(self):
+        return self.results.stats()
 
 class QueryProcessor:
 
-    def __init__(self, query, index, collection):
-        ''' index is the inverted index; collection is the document collection'''
+    def __init__(self, query, index, collection, strategy="exhaustive", cache=None, spell=False, fields=None, budget=None):
+        ''' index is the inverted index; collection is the document collection, or a DocumentStore;
+            strategy is the top-k evaluation of vectorQuery, "exhaustive", "wand" or "impact" (score-at-a-time
+            on the impact-ordered postings, scoring at most budget postings if given, see impactQuery);
+            cache is an optional QueryCache shared by the QueryProcessors of the index;
+            with spell, the query words missing from the indexed vocabulary are spelling corrected;
+            fields maps the fields searched by the words without a field to their weight, e.g. {"body": 1, "title": 2},
+            by default only the body is searched.
+            timer records the time of each query stage, see timing.py; eval sets it when profiling'''
         self.raw_query = query
         self.index = index
         self.docs = collection
+        self.strategy = strategy
+        self.cache = cache
+        self.spell = spell
+        self.fields = dict(fields) if fields else None
+        self.budget = budget
+        self.timer = NULL_TIMER
+
+    def cacheModel(self, model):
+        ''' the model part of the cache key of a query, which depends on the field weights and on the
+            approximate impact strategy'''
+        options = ()
+        if self.fields is not None:
+            options += (tuple(sorted(self.fields.items())),)
+        if self.strategy == "impact" and model == "vector":
+            options += (self.strategy, self.budget)
+        return (model,) + options if options else model
 
     def preprocessing(self):
         ''' apply the same preprocessing steps used by indexing,
@@ -34,21 +92,43 @@ class QueryProcessor:
 
         #ToDo: return a list of terms (Done)
 
-        # Tokenizing
-        query_terms = lowerCaseAndSplit(self.raw_query)
-        
-        # # Apply Norvig's Spelling Corrector
-        # query_terms_spell_checked = []
-        # for term in query_terms:
-        #     query_terms_spell_checked.append(correction(term))
+        # The same Analyzer used at indexing time, restored from the index, that records no query word
+        analyzer = self.index.analyzer.queryView()
+        timer = self.timer
 
-        query_terms_spell_checked = query_terms
-
-        # Remove stopwords from the list of query terms
-        query_terms_spell_checked = removeStopWords(query_terms_spell_checked)
+        # Tokenizing; field restricted words, title:lift, are analyzed without their field, and the words
+        # of a quoted phrase, author:"de young", each with the field of the phrase
+        query_fields = None
+        with timer.stage("tokenize"):
+            query_terms = analyzer.tokenize(boolean.unquote(self.raw_query))
+            if any([":" in term for term in query_terms]):
+                query_fields = [splitField(term)[0] for term in query_terms]
+                query_terms = [splitField(term)[1] for term in query_terms]
 
-        # Stem the list of query terms
-        query_terms_spell_checked = stemming(query_terms_spell_checked)
+        # Apply the SymSpell corrector of the index, only to the words missing from the indexed vocabulary
+        query_terms_spell_checked = query_terms
+        corrector = self.index.spellCorrector() if self.spell else None
+        if corrector is not None:
+            with timer.stage("spell"):
+                query_terms_spell_checked = []
+                for term in query_terms:
+                    if term.isalpha() and not analyzer.isStopWord(term) and analyzer.vocabulary.get(term) is None:
+                        term = corrector.correct(term)
+                    query_terms_spell_checked.append(term)
+
+        # Remove stopwords and stem the list of query terms, in a single pass unless the two are timed apart
+        if query_fields is not None:
+            with timer.stage("stopwords"):
+                kept = [(field, term) for field, term in zip(query_fields, query_terms_spell_checked) if not analyzer.isStopWord(term)]
+            with timer.stage("stem"):
+                query_terms_spell_checked = [fieldTerm(field, analyzer.stem(term)) for field, term in kept]
+        elif timer.enabled:
+            with timer.stage("stopwords"):
+                query_terms_spell_checked = [term for term in query_terms_spell_checked if not analyzer.isStopWord(term)]
+            with timer.stage("stem"):
+                query_terms_spell_checked = [analyzer.stem(term) for term in query_terms_spell_checked]
+        else:
+            query_terms_spell_checked = analyzer.analyzeTokens(query_terms_spell_checked)
 
         # Generate the (query_term, position) pair
         query_terms_spell_checked_with_positions = []
@@ -60,53 +140,74 @@ class QueryProcessor:
     def booleanQuery(self, preprocessed_query):
         ''' boolean query processing; note that a query like "A B C" is transformed to "A AND B AND C" for retrieving posting lists and merge them'''
         #ToDo: return a list of docIDs (Done)
-        # Intersecting two posting lists
-
-        def intersect(posting_1, posting_2):
-            answer = [] # The final intersect of the two posting lists
-
-            # Make a deep copy of the posting list to preserve the original posting in the invertedIndex
-            posting_1_copy = copy.deepcopy(posting_1)
-            posting_2_copy = copy.deepcopy(posting_2)
-
-            while (len(posting_1_copy) != 0) and (len(posting_2_copy) != 0):
-                if posting_1_copy[0] == posting_2_copy[0]:
-                    answer.append(posting_1_copy[0])
-                    posting_1_copy.pop(0)
-                    posting_2_copy.pop(0)
-                elif posting_1_copy[0] < posting_2_copy[0]:
-                    posting_1_copy.pop(0)
-                else:
-                    posting_2_copy.pop(0)
-            
-            return answer
-
-        # Approach: Optimize booleanQuery processing using Document Frequency
-        # Rational: Since every term in the query are AND, during the merge/intersect, 
-        # We can intersect the 2 smallest posting lists since all intermediate results will be no longer than the smallest posting list,
-        # to minimize time and work needed
-
-        term_doc_freq_postings = []
+        if self.cache is not None:
+            key = self.cache.key(self.index, preprocessed_query, self.cacheModel("boolean"), 0)
+            docids = self.cache.get(key)
+            if docids is None:
+                docids = self.booleanQueryUncached(preprocessed_query)
+                self.cache.put(key, docids)
+            return list(docids)
+        return self.booleanQueryUncached(preprocessed_query)
 
-        # Create a list of (term, document frequency, sorted_postings) tuple
-        for term in preprocessed_query:
-            if self.index.find(term) == "None":
-                continue
-            term_doc_freq_postings.append((term, len(self.index.items[term].sorted_postings), self.index.items[term].sorted_postings))
+    def booleanQueryUncached(self, preprocessed_query):
 
-        # Sort the tuple by increasing document frequency
-        term_doc_freq_postings = sorted(term_doc_freq_postings, key=lambda elem : elem[1])
+        # Approach: Optimize booleanQuery processing using Document Frequency
+        # Rational: Since every term in the query are AND, during the merge/intersect,
+        # We can intersect starting from the smallest posting lists since all intermediate results will be no longer than the smallest posting list,
+        # to minimize time and work needed. intersectAll orders the lists by document frequency and
+        # picks a linear merge, skip pointers or galloping search from the length ratio of each pair
+
+        # Retrieve the sorted posting lists, skipping terms that are not indexed
+        timer = self.timer
+        postings = []
+        with timer.stage("fetch"):
+            for term in preprocessed_query:
+                if self.fields is not None and FIELD_SEPARATOR not in term:
+                    # A word without a field matches the documents having it in any of the searched fields
+                    items = [item for item in [self.index.find(fieldTerm(field, term)) for field in sorted(self.fields)] if item != "None"]
+                    if items:
+                        postings.append(sorted(set([docid for item in items for docid in item.docids])))
+                        timer.count("postings", sum([len(item.docids) for item in items]))
+                    continue
+                item = self.index.find(term)
+                if item == "None":
+                    continue
+                postings.append(item.sorted_postings)
+                timer.count("postings", len(item.docids))
 
         # The MERGE
-        answer = intersect(term_doc_freq_postings[0][2], term_doc_freq_postings[1][2])
-
-        for i in range(2, len(term_doc_freq_postings)):
-            answer = intersect(answer, term_doc_freq_postings[i][2])
-        
-        return answer
+        with timer.stage("intersect"):
+            docids = intersectAll(postings)
+        timer.count("candidates", len(docids))
+        return docids
+
+    def hasOperators(self):
+        ''' true if the raw query uses the Boolean query language: AND, OR, NOT, "phrases" or NEAR/k'''
+        return boolean.hasOperators(self.raw_query)
+
+    def expressionQuery(self, limit=None, offset=0):
+        ''' evaluate the raw query with the Boolean query language of boolean.py, lazily: returns the
+            sorted docIDs, or only the page of limit docIDs after the first offset'''
+        with self.timer.stage("evaluate"):
+            docids = boolean.evaluate(self.raw_query, self.index, limit, offset, self.fields)
+        self.timer.count("candidates", len(docids))
+        return docids
 
     def vectorQuery(self, preprocessed_query, k, test):
         ''' vector query processing, using the cosine similarity. '''
+        if self.cache is not None and test != "test":
+            key = self.cache.key(self.index, preprocessed_query, self.cacheModel("vector"), k)
+            top_k = self.cache.get(key)
+            if top_k is None:
+                top_k = self.vectorQueryUncached(preprocessed_query, k, test)
+                self.cache.put(key, top_k)
+            return list(top_k)
+        return self.vectorQueryUncached(preprocessed_query, k, test)
+
+    def vectorQueryUncached(self, preprocessed_query, k, test):
+        if self.fields is not None or any([FIELD_SEPARATOR in term for term in preprocessed_query]):
+            return self.fieldVectorQuery(preprocessed_query, k)
+
         # ToDo: return top k pairs of (docID, similarity), ranked by their cosine similarity with the query in the descending order (Done)
         # You can use term frequency or TFIDF to construct the vectors (Done)
 
@@ -114,8 +215,8 @@ class QueryProcessor:
             # cosine_similarity(query, document) = dot_product(query, document) / ||query|| * ||document||
 
             dot_product = np.dot(query, document)
-            query_l2_norm = math.sqrt(sum(np.square(query)))
-            document_l2_norm = math.sqrt(sum(np.square(document)))
+            query_l2_norm = np.linalg.norm(query)
+            document_l2_norm = np.linalg.norm(document)
 
             if dot_product == float(0) or query_l2_norm == float(0) or document_l2_norm == float(0):
                 return float(0)
@@ -123,12 +224,14 @@ class QueryProcessor:
                 return dot_product / (query_l2_norm * document_l2_norm)
 
         # Filter out any term in preprocessed query that does not exist in the invertedIndex
+        timer = self.timer
         query_terms = []
-        for term in preprocessed_query:
-            if self.index.find(term) == "None":
-                continue
-            else:
-                query_terms.append(term)
+        with timer.stage("fetch"):
+            for term in preprocessed_query:
+                if self.index.find(term) == "None":
+                    continue
+                else:
+                    query_terms.append(term)
         
         # Compute the Query Term Frequency (TF)
         # TF is defined as the number of times the term appears in a given query
@@ -140,66 +243,49 @@ class QueryProcessor:
             else:
                 query_tf[term] += 1
         
-        # Compute the Document Term Frequency
-        document_tf = {}
-        list_of_relevant_docs = []
-        for term in query_terms:
-            if term not in document_tf:
-                document_tf[term] = {}
-                postings = self.index.items[term].sorted_postings
-
-                for docid in postings:
-                    document_tf[term][docid] = self.index.items[term].posting[str(docid)].term_freq()
-                    list_of_relevant_docs.append(docid)
-            else:
-                continue
-        list_of_relevant_docs = set(list_of_relevant_docs)
-
-        # Compute the Inverse Document Frequency
+        # Compute the Query TF-IDF weights, using the IDF precomputed at indexing time
+        # Terms are processed in sorted order so that the scores do not depend on the order of the query words
+        unique_terms = sorted(query_tf)
         document_idf = {}
-        for term in query_terms:
-            if term not in document_idf:
-                document_idf[term] = self.index.idf(term)
-            else:
-                continue
-        
-        # Compute the Query TF-IDF Vector
-        query_tf_idf = []
-        for term in query_terms:
-            query_tf_idf.append(query_tf[term] * document_idf[term])
-
-        # Compute the Document TF-IDF Vector
-        document_tf_idf = {}
-        for docid in list_of_relevant_docs:
-            document_tf_idf[docid] = []
-            for term in query_terms:
-                term_docs = [doc for doc in document_tf[term].iterkeys()]
-                if docid in term_docs:
-                    document_tf_idf[docid].append(document_tf[term][docid] * document_idf[term])
-                else:
-                    document_tf_idf[docid].append(0)
-        
-        # Compute the the Query Cosine Similarity of on ALL Relevant Documents
-        cosine_similarity_score = []
-        for docid in list_of_relevant_docs:
-            cosine_similarity_score.append((docid, cosine_similarity(query_tf_idf, document_tf_idf[docid])))
-
-        # Sort the Cosine Similarity Score on descending order (Highest score first)
-        cosine_similarity_score = sorted(cosine_similarity_score, key=lambda elem : elem[1], reverse=True)
-
-        # Return the top K results
-        top_k = []
-        for i in range(k):
-            top_k.append(cosine_similarity_score[i])
-        
+        query_tf_idf = {}
+        for term in unique_terms:
+            document_idf[term] = self.index.idf(term)
+            query_tf_idf[term] = query_tf[term] * document_idf[term]
+        query_l2_norm = math.sqrt(sum([query_tf_idf[term] ** 2 for term in unique_terms]))
+
+        if self.strategy == "wand":
+            with timer.stage("score"):
+                top_k = self.wand(unique_terms, query_tf_idf, query_l2_norm, k)
+        elif self.strategy == "impact":
+            top_k = self.impactQuery(unique_terms, query_tf_idf, query_l2_norm, k)
+        else:
+            # Term-at-a-time scoring: walk each posting list once, accumulating the
+            # dot product of the query and document TF-IDF vectors per docID
+            with timer.stage("score"):
+                accumulators = {}
+                for term in unique_terms:
+                    item = self.index.find(term)
+                    weight = query_tf_idf[term] * item.idf
+                    for docid, tf in zip(item.docids, item.tfs):
+                        accumulators[docid] = accumulators.get(docid, 0.0) + weight * tf
+                    timer.count("postings", len(item.docids))
+
+                # Compute the Cosine Similarity using the precomputed full document vector norms
+                cosine_similarity_score = []
+                for docid in accumulators:
+                    cosine_similarity_score.append((docid, self.cosine(accumulators[docid], query_l2_norm, docid)))
+                timer.count("candidates", len(accumulators))
+
+            # Select the top K results with a heap (highest score first, ties broken by the lower docID)
+            with timer.stage("sort"):
+                top_k = heapq.nlargest(k, cosine_similarity_score, key=lambda elem : (elem[1], -elem[0]))
+
         ### TESTS ###
         if test == "test":
-            j = 0
             print("\n== Query Terms ==")
-            for term in query_terms:
+            for term in unique_terms:
                 print("-> {}".format(term))
-                print("TF: {}\t\tIDF: {}\tTF-IDF: {}".format(query_tf[term], round(document_idf[term], 3), round(query_tf_idf[j], 3)))
-                j += 1
+                print("TF: {}\t\tIDF: {}\tTF-IDF: {}".format(query_tf[term], round(document_idf[term], 3), round(query_tf_idf[term], 3)))
             
             query_v = [0.702753576, 0.702753576]
             document_v = [0.140550715, 0.140550715]
@@ -212,7 +298,324 @@ class QueryProcessor:
 
         return top_k
 
-def eval(queryId, queryProcessor, processing_algorithm, mode, k, test=0):
+    def fieldVectorQuery(self, preprocessed_query, k):
+        ''' field weighted vector query processing: the sum over the fields of the field weight times the
+            cosine similarity of the query and the document field. A word without a field is matched in each
+            field of self.fields (by default only the body), a field restricted word only in its field.
+            The scoring is exhaustive, whatever self.strategy'''
+        timer = self.timer
+        weights = self.fields or {BODY: 1.0}
+
+        # The query terms of each field
+        field_terms = {}
+        with timer.stage("fetch"):
+            for term in preprocessed_query:
+                fields = [termField(term)] if FIELD_SEPARATOR in term else sorted(weights)
+                for field in fields:
+                    index_term = term if field == termField(term) else fieldTerm(field, term)
+                    if self.index.find(index_term) != "None":
+                        field_terms.setdefault(field, []).append(index_term)
+
+        # Term-at-a-time scoring of each field, accumulating the weighted cosine similarities per docID
+        with timer.stage("score"):
+            scores = {}
+            for field in sorted(field_terms):
+                query_tf = {}
+                for term in field_terms[field]:
+                    query_tf[term] = query_tf.get(term, 0) + 1
+                query_tf_idf = dict([(term, query_tf[term] * self.index.idf(term)) for term in query_tf])
+                query_l2_norm = math.sqrt(sum([query_tf_idf[term] ** 2 for term in sorted(query_tf)]))
+                if query_l2_norm == float(0):
+                    continue
+
+                accumulators = {}
+                for term in sorted(query_tf):
+                    item = self.index.find(term)
+                    weight = query_tf_idf[term] * item.idf
+                    for docid, tf in zip(item.docids, item.tfs):
+                        accumulators[docid] = accumulators.get(docid, 0.0) + weight * tf
+                    timer.count("postings", len(item.docids))
+
+                norms = self.index.norms(field)
+                field_weight = weights.get(field, 1.0)
+                for docid in accumulators:
+                    if norms[docid] > 0:
+                        scores[docid] = scores.get(docid, 0.0) + field_weight * accumulators[docid] / (query_l2_norm * norms[docid])
+            timer.count("candidates", len(scores))
+
+        # Highest score first, ties broken by the lower docID
+        with timer.stage("sort"):
+            return heapq.nlargest(k, scores.items(), key=lambda elem : (elem[1], -elem[0]))
+
+    def bm25Query(self, preprocessed_query, k, k1=BM25_K1, b=BM25_B):
+        ''' BM25 ranking: the sum over the query terms of
+            query tf * idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * document length / average document length)),
+            with the document lengths precomputed at indexing time. As in fieldVectorQuery, a word without a field
+            is matched in each field of self.fields (by default only the body), with the lengths of that field, and
+            its score multiplied by the field weight. Returns the top k (docID, score) pairs'''
+        if self.cache is not None:
+            key = self.cache.key(self.index, preprocessed_query, self.cacheModel("bm25"), k)
+            top_k = self.cache.get(key)
+            if top_k is None:
+                top_k = self.bm25QueryUncached(preprocessed_query, k, k1, b)
+                self.cache.put(key, top_k)
+            return list(top_k)
+        return self.bm25QueryUncached(preprocessed_query, k, k1, b)
+
+    def bm25QueryUncached(self, preprocessed_query, k, k1=BM25_K1, b=BM25_B):
+        timer = self.timer
+        weights = self.fields or {BODY: 1.0}
+        query_tf = {}
+        with timer.stage("fetch"):
+            for term in preprocessed_query:
+                fields = [termField(term)] if FIELD_SEPARATOR in term else sorted(weights)
+                for field in fields:
+                    index_term = term if field == termField(term) else fieldTerm(field, term)
+                    if self.index.find(index_term) != "None":
+                        query_tf[index_term] = query_tf.get(index_term, 0) + 1
+
+        # Term-at-a-time scoring, in sorted term order so that the scores do not depend on the word order.
+        # Length normalization of each document: k1 * (1 - b + b * length / average length), in the field of each term
+        with timer.stage("score"):
+            accumulators = {}
+            for term in sorted(query_tf):
+                item = self.index.find(term)
+                field = termField(term)
+                weight = weights.get(field, 1.0) * query_tf[term] * bm25InverseDocumentFrequency(self.index.nDocs, self.index.docFrequency(term)) * (k1 + 1)
+                field_lengths, field_avgdl = self.index.lengths(field), self.index.averageDocLength(field)
+                for docid, tf in zip(item.docids, item.tfs):
+                    accumulators[docid] = accumulators.get(docid, 0.0) + weight * tf / (tf + k1 * (1 - b + b * field_lengths[docid] / field_avgdl))
+                timer.count("postings", len(item.docids))
+            timer.count("candidates", len(accumulators))
+
+        # Highest score first, ties broken by the lower docID
+        with timer.stage("sort"):
+            return heapq.nlargest(k, accumulators.items(), key=lambda elem : (elem[1], -elem[0]))
+
+    def batchVectorQuery(self, preprocessed_queries, k):
+        ''' vector query processing of a whole batch of preprocessed queries with one sparse matrix product
+            of the normalized query TF-IDF vectors and the document x term matrix of the index.
+            Returns the top k (docID, similarity) pairs of each query, like vectorQuery,
+            except that documents with a zero similarity are not returned. Only the body is searched:
+            field restricted terms and the field weights are ignored'''
+        if self.cache is None:
+            return self.batchVectorQueryUncached(preprocessed_queries, k)
+
+        # Only the queries missing from the cache are scored
+        keys = [self.cache.key(self.index, preprocessed_query, "batch", k) for preprocessed_query in preprocessed_queries]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i in range(len(keys)) if results[i] is None]
+        scored = self.batchVectorQueryUncached([preprocessed_queries[i] for i in missing], k) if missing else []
+        for i, top_k in zip(missing, scored):
+            results[i] = top_k
+            self.cache.put(keys[i], top_k)
+        return [list(top_k) for top_k in results]
+
+    def batchVectorQueryUncached(self, preprocessed_queries, k):
+        timer = self.timer
+        with timer.stage("fetch"):
+            matrix, columns = self.index.tfidfMatrix()
+
+        # Build the normalized query x term TF-IDF matrix
+        rows, cols, data = [], [], []
+        for i in range(len(preprocessed_queries)):
+            query_tf = {}
+            for term in preprocessed_queries[i]:
+                if term in columns:
+                    query_tf[term] = query_tf.get(term, 0) + 1
+
+            query_tf_idf = dict([(term, query_tf[term] * self.index.idf(term)) for term in query_tf])
+            query_l2_norm = math.sqrt(sum([weight ** 2 for weight in query_tf_idf.values()]))
+            if query_l2_norm == float(0):
+                continue
+            for term in query_tf_idf:
+                rows.append(i)
+                cols.append(columns[term])
+                data.append(query_tf_idf[term] / query_l2_norm)
+        queries = sparse.csr_matrix((data, (rows, cols)), shape=(len(preprocessed_queries), matrix.shape[1]))
+
+        # Cosine similarity of every (query, document) pair
+        with timer.stage("score"):
+            scores = queries.dot(matrix.T).tocsr()
+        timer.count("candidates", scores.nnz)
+
+        # Row-wise top K selection: partition out the K-th best score, then rank the documents
+        # scoring at least as much (highest score first, ties broken by the lower docID)
+        results = []
+        with timer.stage("sort"):
+            for i in range(len(preprocessed_queries)):
+                start, end = scores.indptr[i], scores.indptr[i+1]
+                docids = scores.indices[start:end]
+                similarities = scores.data[start:end]
+                if k <= 0 or len(similarities) == 0:
+                    results.append([])
+                    continue
+                if len(similarities) > k:
+                    kth = np.partition(similarities, len(similarities) - k)[len(similarities) - k]
+                    candidates = np.flatnonzero(similarities >= kth)
+                    docids, similarities = docids[candidates], similarities[candidates]
+                order = np.lexsort((docids, -similarities))[:k]
+                results.append([(int(docids[j]), float(similarities[j])) for j in order])
+
+        return results
+
+    def cosine(self, dot_product, query_l2_norm, docid):
+        ''' cosine similarity from the dot product and the precomputed document norm'''
+        document_l2_norm = self.index.docNorm(docid)
+        if dot_product == float(0) or document_l2_norm == float(0):
+            return float(0)
+        return dot_product / (query_l2_norm * document_l2_norm)
+
+    def impactQuery(self, unique_terms, query_tf_idf, query_l2_norm, k):
+        ''' score-at-a-time top-k scoring on the impact-ordered postings of impact.py. The segments of equal
+            impact level of all the query terms are scored in decreasing order of their contribution,
+            query weight * level, so the most useful postings are read first. Scoring stops as soon as the
+            set of the top k documents can no longer change, or once self.budget postings are scored.
+            The scores are the quantized cosine similarities accumulated until then'''
+        timer = self.timer
+        if query_l2_norm == float(0) or k <= 0:
+            return []
+
+        # A heap of the next segment of each query term: (-contribution, term, start, docids, levels);
+        # pending holds the contribution of the next segment of each term, the most it can still add to a document
+        with timer.stage("fetch"):
+            impacts = self.index.impactIndex()
+            heap = []
+            pending = {}
+            for term in unique_terms:
+                postings = impacts.find(term)
+                if postings is not None:
+                    docids, levels = postings
+                    heap.append((-query_tf_idf[term] * levels[0], term, 0, docids, levels))
+                    pending[term] = query_tf_idf[term] * levels[0]
+            heapq.heapify(heap)
+
+        with timer.stage("score"):
+            accumulators = {}
+            scored = 0
+            unchecked = 0
+            while heap:
+                contribution, term, start, docids, levels = heapq.heappop(heap)
+                contribution = -contribution
+                end = segmentEnd(levels, start)
+                if end < len(levels):
+                    heapq.heappush(heap, (-query_tf_idf[term] * levels[end], term, end, docids, levels))
+                    pending[term] = query_tf_idf[term] * levels[end]
+                else:
+                    pending[term] = 0.0
+
+                if self.budget is not None:
+                    end = min(end, start + self.budget - scored)
+                for docid in docids[start:end]:
+                    accumulators[docid] = accumulators.get(docid, 0.0) + contribution
+                scored += end - start
+                if self.budget is not None and scored >= self.budget:
+                    break
+
+                # The check costs a pass over the accumulators, so it waits until as many postings were scored since the last one
+                unchecked += end - start
+                if unchecked >= len(accumulators):
+                    unchecked = 0
+                    if self.topKFinal(accumulators, sum(pending.values()), k):
+                        break
+            timer.count("postings", scored)
+            timer.count("candidates", len(accumulators))
+
+        # Highest score first, ties broken by the lower docID
+        with timer.stage("sort"):
+            top_k = heapq.nlargest(k, accumulators.items(), key=lambda elem : (elem[1], -elem[0]))
+            return [(docid, score * impacts.scale / query_l2_norm) for docid, score in top_k]
+
+    def topKFinal(self, accumulators, remaining, k):
+        ''' true if the set of the top k accumulated documents cannot change when no document can gain more than remaining'''
+        if len(accumulators) < k:
+            return remaining == 0
+        top = heapq.nlargest(k + 1, accumulators.values())
+        # A document outside the top k, or not scored yet, must stay below the k-th document
+        outside = top[k] if len(top) > k else 0.0
+        return outside + remaining < top[k-1]
+
+    def wand(self, unique_terms, query_tf_idf, query_l2_norm, k):
+        ''' document-at-a-time top-k scoring with WAND dynamic pruning. A document is only scored when the
+            sum of the score upper bounds of the terms that may contain it can beat the current k-th score.
+            Returns the same top k as the exhaustive term-at-a-time scoring'''
+        # One cursor per term, with the term's weight in the dot product and its score upper bound
+        # The bounds are widened by a relative epsilon to absorb floating point rounding
+        cursors = []
+        for term in unique_terms:
+            item = self.index.find(term)
+            cursor = PostingCursor(item.docids, item.tfs)
+            cursor.weight = query_tf_idf[term] * item.idf
+            cursor.bound = query_tf_idf[term] * item.max_weight / query_l2_norm * (1 + 1e-9) if query_l2_norm > 0 else float(0)
+            cursors.append(cursor)
+
+        top_k = [] # min-heap of (score, -docID)
+        while k > 0:
+            # Find the pivot: the first document, in docID order, whose accumulated upper bound beats the k-th score.
+            # Documents are visited in increasing docID order, so a later document tying the k-th score cannot enter
+            by_docid = sorted(cursors, key=lambda cursor : cursor.docid)
+            threshold = top_k[0][0] if len(top_k) == k else None
+            pivot = END
+            bound = float(0)
+            for cursor in by_docid:
+                if cursor.docid == END:
+                    break
+                bound += cursor.bound
+                if threshold is None or bound > threshold:
+                    pivot = cursor.docid
+                    break
+            if pivot == END:
+                break
+
+            if by_docid[0].docid == pivot:
+                # Score the pivot document, summing the terms in the same order as the exhaustive scoring
+                dot_product = float(0)
+                for cursor in cursors:
+                    if cursor.docid == pivot:
+                        dot_product += cursor.weight * cursor.tf()
+                        cursor.next()
+                score = (self.cosine(dot_product, query_l2_norm, pivot), -pivot)
+                self.timer.count("candidates")
+                if len(top_k) < k:
+                    heapq.heappush(top_k, score)
+                elif score > top_k[0]:
+                    heapq.heapreplace(top_k, score)
+            else:
+                # Documents before the pivot cannot make it to the top k, skip them
+                for cursor in by_docid:
+                    if cursor.docid >= pivot:
+                        break
+                    cursor.advance(pivot)
+
+        return [(-docid, score) for score, docid in sorted(top_k, reverse=True)]
+
+    def snippets(self, preprocessed_query, top_k_pairs):
+        ''' the title and the snippet of the body of each result, read from the documents of the
+            QueryProcessor; the snippet is the window of the body best matching the body terms of the
+            query, found from their positions in the index, see snippets.py'''
+        terms = sorted(set([term for term in preprocessed_query if FIELD_SEPARATOR not in term]))
+        results = []
+        for docid, _ in top_k_pairs:
+            doc = self.docs.find(str(docid)) if self.docs is not None else None
+            if doc is None:
+                results.append(("", ""))
+                continue
+            matches = positionMatches(self.index, terms, docid)
+            results.append((" ".join(doc.title.split()), snippet(doc.body, matches, self.index.analyzer.queryView())))
+        return results
+
+def eval(queryId, queryProcessor, processing_algorithm, mode, k, test=0, profile=None, snippets=False):
+    # With a StageProfile, time the stages of this query
+    if profile is not None:
+        queryProcessor.timer = QueryTimer()
+    try:
+        evaluate(queryId, queryProcessor, processing_algorithm, mode, k, test, snippets)
+    finally:
+        if profile is not None:
+            profile.add(queryId, processing_algorithm, queryProcessor.timer)
+            queryProcessor.timer = NULL_TIMER
+
+def evaluate(queryId, queryProcessor, processing_algorithm, mode, k, test=0, snippets=False):
     # Preprocess the raw query
     preprocessed_query, preprocessed_query_with_positions = queryProcessor.preprocessing()
 
@@ -221,7 +624,10 @@ def eval(queryId, queryProcessor, processing_algorithm, mode, k, test=0):
 
     # Evaluate the preprocessed_query with Boolean Model
     if processing_algorithm == "0":
-        list_of_docIDs = queryProcessor.booleanQuery(preprocessed_query)
+        if queryProcessor.hasOperators():
+            list_of_docIDs = queryProcessor.expressionQuery()
+        else:
+            list_of_docIDs = queryProcessor.booleanQuery(preprocessed_query)
 
         if test != "test":
             if mode == "batch":
@@ -235,11 +641,24 @@ def eval(queryId, queryProcessor, processing_algorithm, mode, k, test=0):
         top_k_pairs = queryProcessor.vectorQuery(preprocessed_query, k, test)
 
         if test != "test":
-            print("QueryID: {}".format(queryId))
-            for pair in top_k_pairs:
-                print("DocID: {}\tScore: {:.3f}".format(pair[0], pair[1]))
-            print("\n")
-                
+            printVectorResults(queryId, top_k_pairs, queryProcessor.snippets(preprocessed_query, top_k_pairs) if snippets else None)
+
+    # Rank the preprocessed_query with BM25
+    elif processing_algorithm == "2":
+        top_k_pairs = queryProcessor.bm25Query(preprocessed_query, k)
+
+        if test != "test":
+            printVectorResults(queryId, top_k_pairs, queryProcessor.snippets(preprocessed_query, top_k_pairs) if snippets else None)
+
+def printVectorResults(queryId, top_k_pairs, snippets=None):
+    ''' print the top k (docID, score) pairs of a query, with the (title, snippet) of each if given'''
+    print("QueryID: {}".format(queryId))
+    for i, pair in enumerate(top_k_pairs):
+        print("DocID: {}\tScore: {:.3f}".format(pair[0], pair[1]))
+        if snippets is not None:
+            print("\t{}\n\t{}".format(*snippets[i]))
+    print("\n")
+
 def test():
     ''' test your code thoroughly. put the testing cases here'''
     
@@ -285,34 +704,65 @@ def test():
 
     print('\nPass')
 
+def parseFieldWeights(text):
+    ''' the {field: weight} dict of a "title=2,body=1" command line argument'''
+    weights = {}
+    for item in text.split(","):
+        field, _, weight = item.partition("=")
+        field = field.strip().lower()
+        if field not in (BODY,) + FIELDS:
+            raise argparse.ArgumentTypeError("unknown field {}, use {}".format(field, ", ".join((BODY,) + FIELDS)))
+        try:
+            weights[field] = float(weight) if weight else 1.0
+        except ValueError:
+            raise argparse.ArgumentTypeError("the weight of {} must be a number".format(field))
+    return weights
+
 def query():
     ''' the main query processing program, using QueryProcessor'''
 
     # ToDo: the commandline usage: "echo query_string | python query.py index_file processing_algorithm" (Done)
-    # processing_algorithm: 0 for booleanQuery and 1 for vectorQuery (Done)
+    # processing_algorithm: 0 for booleanQuery, 1 for vectorQuery and 2 for bm25Query (Done)
     # for booleanQuery, the program will print the total number of documents and the list of document IDs (Done)
     # for vectorQuery, the program will output the top 3 most similar documents (Done)
 
     # Parse the commandline
-    index_file = sys.argv[1]
-
-    if sys.argv[2] != "0" and sys.argv[2] != "1":
-        print("Invalid processing_algorithm. Please try again with 0 for Boolean and 1 for Vector.")
-        exit()
-    else:
-        processing_algorithm = sys.argv[2]
-
-    query_text = sys.argv[3]
-    query_id = sys.argv[4]
-
-    # Prompt the user for top K results for Vector Model
-    if processing_algorithm == "1":
+    parser = argparse.ArgumentParser(description="Process the queries of query_text against index_file")
+    parser.add_argument("index_file")
+    parser.add_argument("processing_algorithm", choices=["0", "1", "2"], help="0 for Boolean, 1 for Vector and 2 for BM25")
+    parser.add_argument("query_text")
+    parser.add_argument("query_id", help="a query ID of query_text, or batch to process all queries")
+    parser.add_argument("--strategy", choices=["exhaustive", "wand", "impact"], default="exhaustive",
+                        help="top K evaluation of the Vector model: exhaustive scoring, WAND dynamic pruning or score-at-a-time on impact-ordered postings")
+    parser.add_argument("--budget", type=int, default=None, help="the most postings scored by a query with --strategy impact")
+    parser.add_argument("--spell", action="store_true", help="correct the spelling of the query words missing from the index")
+    parser.add_argument("--fields", type=parseFieldWeights, metavar="FIELD=WEIGHT,...",
+                        help="the fields searched by the query words and their weights, e.g. title=2,body=1")
+    parser.add_argument("--snippets", action="store_true", help="print the title and a highlighted snippet of each Vector and BM25 result")
+    parser.add_argument("--profile", action="store_true", help="print the time spent in each stage of the queries")
+    parser.add_argument("--profile-dump", metavar="FILE", help="write the per-query stage times and their histograms to FILE as JSON")
+    parser.add_argument("--cprofile", metavar="FILE", help="run a single query under cProfile and save the statistics to FILE")
+    args = parser.parse_args()
+    if args.cprofile and args.query_id == "batch":
+        parser.error("--cprofile profiles a single query, not batch")
+    if args.fields is not None and args.strategy != "exhaustive":
+        parser.error("--fields is only supported with --strategy exhaustive")
+
+    index_file = args.index_file
+    processing_algorithm = args.processing_algorithm
+    query_text = args.query_text
+    query_id = args.query_id
+
+    # Prompt the user for top K results for the Vector and BM25 Models
+    if processing_algorithm in ("1", "2"):
         k = int(input("Top K Pairs? "))
     else:
         k = 0
         
-    # Open the Cran.all Collection
-    cf = CranFile ('cran.all')
+    # Open the document store saved with the index, or else the Cran.all Collection
+    collection = loadDocumentStore(index_file)
+    if collection is None:
+        collection = CranFile ('cran.all').collection
 
     # Instantiate an invertedIndex
     invertedIndex = InvertedIndex()
@@ -323,16 +773,22 @@ def query():
     # Load the query_text file into qrys dictionary
     qrys = loadCranQry(query_text)
 
+    # Per-stage timing of the queries
+    profile = StageProfile() if args.profile or args.profile_dump else None
+
     if query_id != "batch":
         ### SINGLE QUERY PROCESSING ###
         # Retrieve the specific (raw) query based on query_id from the qrys dictionary
         query = qrys[query_id].text
 
         # Instantiate the QueryProcessor
-        queryProcessor = QueryProcessor(query, invertedIndex, cf.collection)
+        queryProcessor = QueryProcessor(query, invertedIndex, collection, args.strategy, spell=args.spell, fields=args.fields, budget=args.budget)
 
         # Evaluate the single query
-        eval(query_id, queryProcessor, processing_algorithm, "single", k)
+        if args.cprofile:
+            profileCall(args.cprofile, eval, query_id, queryProcessor, processing_algorithm, "single", k, 0, profile, args.snippets)
+        else:
+            eval(query_id, queryProcessor, processing_algorithm, "single", k, 0, profile, args.snippets)
 
     else: 
         ### BATCH QUERIES PROCESSING ###
@@ -340,12 +796,39 @@ def query():
         query_Ids = sorted([int(queryId) for queryId in query_Ids])
 
         # Instantiate the QueryProcessor
-        queryProcessor = QueryProcessor("None", invertedIndex, cf.collection)
-
-        # Evaluate ALL queries
-        for queryId in query_Ids:
-            queryProcessor.raw_query = qrys[str(queryId)].text
-            eval(queryId, queryProcessor, processing_algorithm, "batch", k)
+        queryProcessor = QueryProcessor("None", invertedIndex, collection, args.strategy, spell=args.spell, fields=args.fields, budget=args.budget)
+
+        if processing_algorithm == "1" and args.fields is None and args.strategy == "exhaustive":
+            # Score ALL queries at once with the sparse matrix backend, which is exhaustive: the other
+            # strategies evaluate each query below
+            # When profiling, each query's preprocessing is timed on its own and the batch scoring as one "batch" query
+            preprocessed_queries = []
+            for queryId in query_Ids:
+                queryProcessor.raw_query = qrys[str(queryId)].text
+                queryProcessor.timer = QueryTimer() if profile is not None else NULL_TIMER
+                preprocessed_queries.append(queryProcessor.preprocessing()[0])
+                if profile is not None:
+                    profile.add(queryId, processing_algorithm, queryProcessor.timer)
+
+            queryProcessor.timer = QueryTimer() if profile is not None else NULL_TIMER
+            ranked = queryProcessor.batchVectorQuery(preprocessed_queries, k)
+            if profile is not None:
+                profile.add("batch", processing_algorithm, queryProcessor.timer)
+            queryProcessor.timer = NULL_TIMER
+
+            for queryId, preprocessed_query, top_k_pairs in zip(query_Ids, preprocessed_queries, ranked):
+                printVectorResults(queryId, top_k_pairs, queryProcessor.snippets(preprocessed_query, top_k_pairs) if args.snippets else None)
+        else:
+            # Evaluate ALL queries
+            for queryId in query_Ids:
+                queryProcessor.raw_query = qrys[str(queryId)].text
+                eval(queryId, queryProcessor, processing_algorithm, "batch", k, 0, profile, args.snippets)
+
+    if profile is not None:
+        if args.profile:
+            profile.report()
+        if args.profile_dump:
+            profile.dump(args.profile_dump)
 
 if __name__ == '__main__':
     #test()
@@ -0,0 +1,513 @@
+'''
+incrementally updatable index, made of immutable segments
+
+    new documents are indexed into an in-memory write buffer, which is sealed into a small immutable
+    segment once it holds buffer_size documents (or when a snapshot is taken). Deleting a document
+    records a tombstone on the segment holding it. A tiered merge policy compacts segments of similar
+    size, dropping deleted documents, in a background thread.
+
+    queries run on an IndexSnapshot: the segments and tombstones at one point in time. A snapshot is an
+    InvertedIndex that merges the live postings of each term across its segments on first access, and
+    computes nDocs, the IDFs and the document norms over the live documents only, so its results are
+    identical to those of an index rebuilt from scratch. Merges never modify a segment in place, so a
+    snapshot stays consistent while they run.
+
+    a segment records the lengths of its documents in each field when it is written, so the lengths of a
+    snapshot are combined from those of its segments, without the deleted documents. The document norms
+    depend on the IDFs of the snapshot, which change with every addition or deletion: the first Vector or
+    BM25 query of a new snapshot reads the docIDs and term frequencies of every posting list once, without
+    the positions, in time linear in the size of the index, and keeps only the norms:
+
+        segmentedIndex = SegmentedIndex("index_dir")
+        segmentedIndex.addDocument(doc)
+        segmentedIndex.deleteDocument(docID)
+        queryProcessor = QueryProcessor(query, segmentedIndex.snapshot(), None)
+'''
+
+import os
+import json
+import math
+import heapq
+import threading
+
+from array import array
+from bisect import bisect_left
+from util import Analyzer, nativeText
+from indexfile import IndexWriter, IndexFile
+from index import InvertedIndex, IndexItem, FieldStatistics, inverseDocumentFrequency, maxWeight, termField, BODY, FIELDS, FIELD_SECTIONS
+
+def lengthSection(field):
+    ''' the segment file section of the document lengths of a field'''
+    return b"DOCLEN" if field == BODY else FIELD_SECTIONS[field][1]
+
+def documentLengths(index, docids):
+    ''' {field: the lengths of the documents of an index in the field}, aligned with its sorted docids'''
+    slots = dict([(docid, slot) for slot, docid in enumerate(docids)])
+    lengths = dict([(field, array('i', [0]) * len(docids)) for field in (BODY,) + FIELDS])
+    for term in index.terms():
+        item = index.find(term)
+        fieldLengths = lengths[termField(term)]
+        for docid, tf in zip(item.docids, item.tfs):
+            fieldLengths[slots[docid]] += tf
+    return lengths
+
+class Segment:
+    ''' an immutable segment: an InvertedIndex over some documents, their sorted docIDs, their lengths in
+        each field and the deleted ones. Deleting creates a new Segment sharing the index, so older snapshots
+        are not affected'''
+
+    def __init__(self, name, index, docids, lengths, deleted=frozenset()):
+        self.name = name
+        self.index = index
+        self.docids = docids
+        self.lengths = lengths
+        self.deleted = deleted
+
+    def contains(self, docid):
+        i = bisect_left(self.docids, docid)
+        return i < len(self.docids) and self.docids[i] == docid and docid not in self.deleted
+
+    def withDeleted(self, docids):
+        return Segment(self.name, self.index, self.docids, self.lengths, self.deleted | frozenset(docids))
+
+    def liveDocs(self):
+        return len(self.docids) - len(self.deleted)
+
+    def liveLengths(self, field, lengths):
+        ''' set the lengths of the live documents in a field, in an array indexed by docID'''
+        for docid, length in zip(self.docids, self.lengths[field]):
+            if docid not in self.deleted:
+                lengths[docid] = length
+
+    def liveFrequencies(self, term):
+        ''' return the (docids, tfs) arrays of the term without the deleted documents, or None.
+            The positions are not decoded, and the posting list is not cached'''
+        if self.index.source is not None:
+            i = self.index.source.lookup(term)
+            if i < 0:
+                return None
+            docids, tfs = self.index.source.frequencies(i)
+        else:
+            item = self.index.items.get(term)
+            if item is None:
+                return None
+            docids, tfs = item.docids, item.tfs
+        if self.deleted:
+            live = [i for i in range(len(docids)) if docids[i] not in self.deleted]
+            docids, tfs = array('i', [docids[i] for i in live]), array('i', [tfs[i] for i in live])
+        return (docids, tfs) if docids else None
+
+    def livePostings(self, term):
+        ''' return the (docids, tfs, positions) arrays of the term without the deleted documents, or None'''
+        item = self.index.find(term)
+        if item == "None":
+            return None
+        if not self.deleted:
+            return item.docids, item.tfs, item.positions
+
+        docids, tfs, positions = array('i'), array('i'), array('i')
+        for i in range(len(item.docids)):
+            if item.docids[i] not in self.deleted:
+                docids.append(item.docids[i])
+                tfs.append(item.tfs[i])
+                positions.extend(item.positions[item.offsets[i]:item.offsets[i+1]])
+        return (docids, tfs, positions) if docids else None
+
+class IndexSnapshot(InvertedIndex):
+    ''' a read-only InvertedIndex over the live documents of a set of segments'''
+
+    def __init__(self, segments, analyzer, generation):
+        InvertedIndex.__init__(self, analyzer)
+        self.segments = segments
+        self.generation = generation
+        self.nDocs = sum([segment.liveDocs() for segment in segments])
+        self.docNorms = None
+        self.bounded = set() # terms whose max_weight has been computed
+
+    def merged(self, term):
+        ''' the IndexItem of the live postings of a term across the segments, with its IDF, or None'''
+        item = self.items.get(term)
+        if item is None:
+            item = IndexItem(term)
+            for segment in self.segments:
+                postings = segment.livePostings(term)
+                if postings is not None:
+                    item.extend(*postings)
+            if not item.docids:
+                return None
+            item.sort()
+            item.idf = inverseDocumentFrequency(self.nDocs, len(item.docids))
+            self.items[term] = item
+        return item
+
+    def find(self, term):
+        item = self.merged(term)
+        if item is None:
+            return "None"
+        if term not in self.bounded:
+            item.max_weight = maxWeight(item.docids, item.tfs, item.idf, self.norms(termField(term)))
+            self.bounded.add(term)
+        return item
+
+    def liveFrequencies(self):
+        ''' iterate over the sorted terms with at least one live posting, with the (docids, tfs) of each segment'''
+        previous = None
+        for term in heapq.merge(*[segment.index.terms() for segment in self.segments]):
+            if term == previous:
+                continue
+            previous = term
+            postings = [segment.liveFrequencies(term) for segment in self.segments]
+            postings = [frequencies for frequencies in postings if frequencies is not None]
+            if postings:
+                yield term, postings
+
+    def terms(self):
+        ''' the sorted terms with at least one live posting'''
+        return [term for term, _ in self.liveFrequencies()]
+
+    def norms(self, field=BODY):
+        ''' compute the document norms and lengths of every field over the live documents on first use.
+            The lengths are combined from those of the segments; the norms depend on the IDFs of the
+            snapshot, so they add up the squared weights of the live postings of every term, in the same
+            term order as InvertedIndex.computeStatistics, without keeping the posting lists'''
+        if self.docNorms is None:
+            maxDocID = max([segment.docids[-1] for segment in self.segments if segment.docids] or [0])
+            statistics = FieldStatistics(maxDocID)
+            for term, postings in self.liveFrequencies():
+                idf = inverseDocumentFrequency(self.nDocs, sum([len(docids) for docids, _ in postings]))
+                for docids, tfs in postings:
+                    statistics.addWeights(term, docids, tfs, idf)
+            for lengthsField, lengths in statistics.lengths.items():
+                for segment in self.segments:
+                    segment.liveLengths(lengthsField, lengths)
+            self.setFieldStatistics(statistics.fields(self.nDocs))
+        return InvertedIndex.norms(self, field)
+
+    def lengths(self, field=BODY):
+        self.norms()
+        return InvertedIndex.lengths(self, field)
+
+    def averageDocLength(self, field=BODY):
+        self.norms()
+        return InvertedIndex.averageDocLength(self, field)
+
+    def docNorm(self, docid):
+        return self.norms()[docid]
+
+    def documents(self):
+        ''' the sorted docIDs of the segments, without the deleted ones'''
+        return sorted([docid for segment in self.segments for docid in segment.docids if docid not in segment.deleted])
+
+    def tfidfMatrix(self):
+        self.norms()
+        return InvertedIndex.tfidfMatrix(self)
+
+    def save(self, filename):
+        ''' write the snapshot as a single, fully merged index file'''
+        self.norms()
+        self.docids = array('i', self.documents())
+        InvertedIndex.save(self, filename)
+
+class SegmentedIndex:
+    ''' an index supporting document additions and deletions, see the module documentation.
+        When a directory is given, sealed segments are written to it as index files and
+        reopened memory-mapped, and a manifest records the live segments and tombstones'''
+
+    MANIFEST = "manifest.json"
+    VOCABULARY = "vocabulary.json"
+
+    def __init__(self, directory=None, buffer_size=1000, merge_factor=4, background=True):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.merge_factor = merge_factor
+        self.background = background
+
+        self.lock = threading.RLock()
+        self.analyzer = Analyzer(record=True)
+        self.segments = () # the current immutable segments, replaced as a whole on every change
+        self.generation = 0 # incremented on every change visible to queries
+        self.nextSegment = 0
+        self.current = None # the latest snapshot
+        self.merging = set() # names of the segments being merged
+        self.savedVocabulary = 0 # size of the vocabulary last written to the directory
+        self.mergeThread = None
+        self.newBuffer()
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            elif os.path.exists(os.path.join(directory, self.MANIFEST)):
+                self.openManifest()
+
+    def newBuffer(self):
+        self.buffer = InvertedIndex(self.analyzer)
+        self.bufferDocids = array('i')
+
+    def addDocument(self, doc):
+        ''' index a Document; it becomes visible to queries with the next snapshot'''
+        with self.lock:
+            if self.contains(int(doc.docID)):
+                raise ValueError("Document {} is already indexed, delete it first to update it".format(doc.docID))
+            self.buffer.indexDoc(doc)
+            self.bufferDocids.append(int(doc.docID))
+            if len(self.bufferDocids) >= self.buffer_size:
+                self.flush()
+
+    def deleteDocument(self, docid):
+        ''' record a tombstone for a document; return false if the document is not indexed'''
+        with self.lock:
+            if docid in self.bufferDocids:
+                self.flush()
+            segments = []
+            found = False
+            for segment in self.segments:
+                if segment.contains(docid):
+                    segment = segment.withDeleted([docid])
+                    found = True
+                segments.append(segment)
+            if found:
+                self.commit(tuple(segments))
+            return found
+
+    def contains(self, docid):
+        with self.lock:
+            return docid in self.bufferDocids or any([segment.contains(docid) for segment in self.segments])
+
+    def flush(self):
+        ''' seal the write buffer into a new segment'''
+        with self.lock:
+            if not len(self.bufferDocids):
+                return
+            segment = self.seal(self.buffer, sorted(self.bufferDocids))
+            self.newBuffer()
+            self.commit(self.segments + (segment,))
+        self.maybeMerge()
+
+    def seal(self, index, docids):
+        ''' turn an in-memory index into a Segment, written to the directory if any'''
+        with self.lock:
+            name = "segment{}".format(self.nextSegment)
+            self.nextSegment += 1
+        docids = array('i', docids)
+
+        for item in index.items.values():
+            item.sort()
+        lengths = documentLengths(index, docids)
+        if self.directory is None:
+            return Segment(name, index, docids, lengths)
+
+        filename = os.path.join(self.directory, name)
+        writer = IndexWriter(filename)
+        for term in sorted(index.items):
+            item = index.items[term]
+            writer.add(term, item.docids, item.tfs, item.positions, 0.0, 0.0)
+        arrays = dict([(lengthSection(field), fieldLengths) for field, fieldLengths in lengths.items()])
+        arrays[b"DOCIDS"] = docids
+        writer.close({"nDocs": index.nDocs}, arrays)
+        return self.openSegment(name)
+
+    def openSegment(self, name, deleted=()):
+        source = IndexFile(os.path.join(self.directory, name))
+        index = InvertedIndex(self.analyzer)
+        index.source = source
+        index.nDocs = source.meta["nDocs"]
+        docids = source.array(b"DOCIDS", 'i')
+        if all([lengthSection(field) in source.sections for field in (BODY,) + FIELDS]):
+            lengths = dict([(field, source.array(lengthSection(field), 'i')) for field in (BODY,) + FIELDS])
+        else:
+            lengths = documentLengths(index, docids) # segments written before their lengths were recorded
+        return Segment(name, index, docids, lengths, frozenset(deleted))
+
+    def commit(self, segments):
+        ''' publish a new set of segments'''
+        with self.lock:
+            self.segments = segments
+            self.generation += 1
+            if self.directory is not None:
+                self.writeManifest()
+
+    def snapshot(self, refresh=True):
+        ''' return an IndexSnapshot of the current segments; with refresh, buffered documents are flushed first.
+            Snapshots are reused until the next change'''
+        if refresh:
+            self.flush()
+        with self.lock:
+            if self.current is None or self.current.generation != self.generation:
+                self.current = IndexSnapshot(self.segments, self.analyzer, self.generation)
+            return self.current
+
+    ### MERGING ###
+
+    def tier(self, segment):
+        return int(math.log(max(segment.liveDocs(), 1), self.merge_factor))
+
+    def selectMerge(self):
+        ''' tiered merge policy: merge merge_factor segments of the same size tier, or a segment with
+            at least half of its documents deleted'''
+        tiers = {}
+        for segment in self.segments:
+            if segment.name in self.merging:
+                continue
+            if segment.deleted and len(segment.deleted) * 2 >= len(segment.docids):
+                return [segment]
+            tiers.setdefault(self.tier(segment), []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][:self.merge_factor]
+        return None
+
+    def maybeMerge(self):
+        ''' start merging if the merge policy selects segments, in a background thread if enabled'''
+        with self.lock:
+            if self.mergeThread is not None and self.mergeThread.is_alive():
+                return # the running merge thread checks the policy again when it is done
+            if self.selectMerge() is None:
+                return
+            if self.background:
+                self.mergeThread = threading.Thread(target=self.mergeLoop)
+                self.mergeThread.daemon = True
+                self.mergeThread.start()
+                return
+        self.mergeLoop()
+
+    def mergeLoop(self):
+        while True:
+            with self.lock:
+                segments = self.selectMerge()
+                if segments is None:
+                    return
+                self.merging.update([segment.name for segment in segments])
+            try:
+                self.merge(segments)
+            finally:
+                with self.lock:
+                    self.merging.difference_update([segment.name for segment in segments])
+
+    def merge(self, segments):
+        ''' merge the live documents of segments into a new segment, without holding the lock,
+            then swap it in, carrying over the deletions made in the meantime'''
+        merged = InvertedIndex(self.analyzer)
+        for term in heapq.merge(*[segment.index.terms() for segment in segments]):
+            if term in merged.items:
+                continue
+            item = IndexItem(term)
+            for segment in segments:
+                postings = segment.livePostings(term)
+                if postings is not None:
+                    item.extend(*postings)
+            if item.docids:
+                merged.items[term] = item
+        docids = sorted([docid for segment in segments for docid in segment.docids if docid not in segment.deleted])
+        merged.nDocs = len(docids)
+        segment = self.seal(merged, docids) if docids else None # dropped when all its documents are deleted
+
+        with self.lock:
+            names = dict([(old.name, old) for old in segments])
+            current = [old for old in self.segments if old.name in names]
+            deletedSince = [docid for old in current for docid in old.deleted - names[old.name].deleted]
+            if deletedSince and segment is not None:
+                segment = segment.withDeleted(deletedSince)
+
+            # Replace the merged segments by the new one, at the position of the first of them
+            replaced = []
+            for old in self.segments:
+                if old.name not in names:
+                    replaced.append(old)
+                elif segment is not None and segment not in replaced:
+                    replaced.append(segment)
+            self.commit(tuple(replaced))
+
+        if self.directory is not None:
+            for name in names:
+                os.remove(os.path.join(self.directory, name))
+
+    def waitForMerges(self):
+        thread = self.mergeThread
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        ''' flush the buffer and wait for the running merges'''
+        self.flush()
+        self.waitForMerges()
+
+    ### PERSISTENCE ###
+
+    def writeManifest(self):
+        manifest = {"generation": self.generation, "nextSegment": self.nextSegment, "analyzer": self.analyzer.config(),
+                    "segments": [{"name": segment.name, "deleted": sorted(segment.deleted)} for segment in self.segments]}
+        files = [(self.MANIFEST, manifest)]
+        if len(self.analyzer.vocabulary) != self.savedVocabulary:
+            # The vocabulary only grows, and only when documents are added
+            files.insert(0, (self.VOCABULARY, self.analyzer.vocabulary))
+            self.savedVocabulary = len(self.analyzer.vocabulary)
+        for name, data in files:
+            filename = os.path.join(self.directory, name)
+            with open(filename + ".tmp", "w") as f:
+                f.write(json.dumps(data, sort_keys=True))
+            os.rename(filename + ".tmp", filename) # atomic replace
+
+    def openManifest(self):
+        with open(os.path.join(self.directory, self.MANIFEST)) as f:
+            manifest = json.load(f)
+        with open(os.path.join(self.directory, self.VOCABULARY)) as f:
+            vocabulary = dict([(nativeText(word), nativeText(stem)) for word, stem in json.load(f).items()])
+
+        config = manifest["analyzer"]
+        self.analyzer = Analyzer(config["stopwords"], config["stemmer"], config["cache_size"], vocabulary, record=True)
+        self.savedVocabulary = len(vocabulary)
+        self.newBuffer()
+        self.generation = manifest["generation"]
+        self.nextSegment = manifest["nextSegment"]
+        self.segments = tuple([self.openSegment(str(segment["name"]), segment["deleted"]) for segment in manifest["segments"]])
+
+def test():
+    ''' queries never add their words to the vocabulary: a misspelled query is corrected every time,
+        and only the indexed words are persisted'''
+    import shutil
+    import tempfile
+    from doc import Document
+    from query import QueryProcessor
+
+    directory = tempfile.mkdtemp()
+    try:
+        index = SegmentedIndex(directory, buffer_size=2, background=False)
+        for docid, body in enumerate(["heat transfer", "heat flux in a wall", "boundary layer"], 1):
+            index.addDocument(Document(str(docid), "", "", body))
+        index.close()
+
+        # The words of a query without spelling correction are stemmed as they are
+        assert QueryProcessor("heta trasnfer", index.snapshot(), None).preprocessing()[0] == ["heta", "trasnfer"]
+        for _ in range(2):
+            queryProcessor = QueryProcessor("heta trasnfer", index.snapshot(), None, spell=True)
+            assert queryProcessor.preprocessing()[0] == ["heat", "transfer"], queryProcessor.preprocessing()[0]
+            assert queryProcessor.booleanQuery(queryProcessor.preprocessing()[0]) == [1]
+        assert "heta" not in index.analyzer.vocabulary and "trasnfer" not in index.analyzer.vocabulary
+
+        index.addDocument(Document("4", "", "", "wing"))
+        index.close()
+        reopened = SegmentedIndex(directory, background=False)
+        assert sorted(reopened.analyzer.vocabulary) == ["boundary", "flux", "heat", "layer", "transfer", "wall", "wing"], sorted(reopened.analyzer.vocabulary)
+
+        # The statistics of a snapshot are those of an index of its live documents, and computing
+        # them keeps no posting list
+        reopened.addDocument(Document("5", "heat shield", "de young", "heat flux"))
+        reopened.deleteDocument(2)
+        snapshot = reopened.snapshot()
+        rebuilt = InvertedIndex(Analyzer())
+        for docid, title, author, body in [("1", "", "", "heat transfer"), ("3", "", "", "boundary layer"),
+                                           ("4", "", "", "wing"), ("5", "heat shield", "de young", "heat flux")]:
+            rebuilt.indexDoc(Document(docid, title, author, body))
+        rebuilt.sort()
+        for field in (BODY,) + FIELDS:
+            assert list(snapshot.norms(field)) == list(rebuilt.norms(field)), field
+            assert list(snapshot.lengths(field)) == list(rebuilt.lengths(field)), field
+            assert snapshot.averageDocLength(field) == rebuilt.averageDocLength(field), field
+        assert not snapshot.items
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+    print("Pass")
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,257 @@
+'''
+query server, keeping the index and the collection resident in memory
+
+    python server.py index_file [--collection cran.all] [--host 127.0.0.1] [--port 8080]
+
+    the index is loaded once at start-up, along with its document store (index.py --docstore), or else the
+    collection, parsed in memory; queries are then answered over
+    HTTP by a thread per connection. Requests and responses are JSON:
+
+    GET  /health                                        {"nDocs": ...}
+    GET  /stats                                         hit/miss counters of the result and posting list caches
+    GET  /search?q=...&model=1&k=10&snippets=1          one query
+    POST /search  {"query": ..., "model": "1", "k": 10, "snippets": true}
+    POST /search  {"queries": [{"id": ..., "query": ...}, ...], "model": "1", "k": 10}
+
+    model is "0" for the Boolean model, "1" for the Vector model and "2" for BM25, as in query.py. Boolean queries may use
+    the query language of boolean.py, and take optional "limit" and "offset" parameters to return one page
+    of their docIDs; total is then the number of docIDs returned. With snippets, each Vector and BM25 result
+    also has the highlighted snippet of its body best matching the query.
+    client.py is the command line client
+'''
+
+import json
+import argparse
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from corpus import readCorpus
+from doc import Collection
+from docstore import loadDocumentStore
+from index import InvertedIndex
+from query import QueryProcessor, QueryCache, parseFieldWeights
+
+MODELS = ("0", "1", "2")
+
+class SearchService:
+    ''' answers Boolean and Vector queries against an index and a collection loaded once'''
+
+    def __init__(self, index, collection, strategy="exhaustive", cache_size=1000, spell=False, fields=None):
+        self.index = index
+        self.collection = collection
+        self.strategy = strategy
+        self.spell = spell
+        self.fields = fields
+        self.cache = QueryCache(cache_size) if cache_size > 0 else None
+
+    def preprocess(self, text):
+        queryProcessor = QueryProcessor(text, self.index, self.collection, self.strategy, self.cache, self.spell, self.fields)
+        return queryProcessor, queryProcessor.preprocessing()[0]
+
+    def stats(self):
+        return {"results": self.cache.stats() if self.cache is not None else None, "postings": self.index.decoded.stats()}
+
+    def title(self, docid):
+        doc = self.collection.find(str(docid)) if self.collection is not None else None
+        return " ".join(doc.title.split()) if doc is not None else ""
+
+    def vectorResults(self, pairs, snippets=None):
+        ''' the JSON results of the top k pairs, with their (title, snippet) from QueryProcessor.snippets if given'''
+        if snippets is None:
+            return [{"docID": docid, "score": score, "title": self.title(docid)} for docid, score in pairs]
+        return [{"docID": docid, "score": score, "title": title, "snippet": snippet}
+                for (docid, score), (title, snippet) in zip(pairs, snippets)]
+
+    def search(self, text, model="1", k=10, limit=None, offset=0, snippets=False):
+        ''' evaluate one query; returns a JSON serializable dict'''
+        queryProcessor, terms = self.preprocess(text)
+        if model == "0":
+            if queryProcessor.hasOperators():
+                docids = queryProcessor.expressionQuery(limit, offset)
+            else:
+                docids = queryProcessor.booleanQuery(terms)[offset:offset + limit if limit is not None else None]
+            return {"model": model, "terms": terms, "total": len(docids), "results": list(docids)}
+        if model == "2":
+            pairs = queryProcessor.bm25Query(terms, k)
+        else:
+            pairs = queryProcessor.vectorQuery(terms, k, 0)
+        return {"model": model, "terms": terms, "results": self.vectorResults(pairs, queryProcessor.snippets(terms, pairs) if snippets else None)}
+
+    def searchBatch(self, queries, model="1", k=10, snippets=False):
+        ''' evaluate a list of {"id", "query"}; Vector queries are scored together with batchVectorQuery,
+            when they search the body with the exhaustive strategy; the other strategies and weighted fields
+            evaluate each query on its own'''
+        if model != "1" or self.fields is not None or self.strategy != "exhaustive":
+            return {"model": model, "results": [dict(self.search(query["query"], model, k, snippets=snippets), id=query["id"]) for query in queries]}
+
+        preprocessed = [self.preprocess(query["query"]) for query in queries]
+        queryProcessor = preprocessed[0][0] if preprocessed else None
+        ranked = queryProcessor.batchVectorQuery([terms for _, terms in preprocessed], k) if preprocessed else []
+        return {"model": model, "results": [{"id": query["id"], "terms": terms, "results": self.vectorResults(pairs, queryProcessor.snippets(terms, pairs) if snippets else None)}
+                                            for query, (queryProcessor, terms), pairs in zip(queries, preprocessed, ranked)]}
+
+class SearchHandler(BaseHTTPRequestHandler):
+    ''' routes the HTTP requests to the server's SearchService'''
+
+    protocol_version = "HTTP/1.1" # keep-alive, so a client can send many queries over one connection
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            return self.reply(200, {"nDocs": self.server.service.index.nDocs})
+        if url.path == "/stats":
+            return self.reply(200, self.server.service.stats())
+        if url.path != "/search":
+            return self.reply(404, {"error": "Unknown path {}".format(url.path)})
+
+        params = dict([(name, values[0]) for name, values in parse_qs(url.query).items()])
+        if "q" not in params:
+            return self.reply(400, {"error": "Missing query parameter q"})
+        request = {"query": params["q"], "model": params.get("model", "1"), "k": params.get("k", 10)}
+        for name in ("limit", "offset", "snippets"):
+            if name in params:
+                request[name] = params[name]
+        self.handle_search(request)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/search":
+            return self.reply(404, {"error": "Unknown path {}".format(self.path)})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        except ValueError as e:
+            return self.reply(400, {"error": "Invalid JSON: {}".format(e)})
+        self.handle_search(request)
+
+    def handle_search(self, request):
+        if not isinstance(request, dict):
+            return self.reply(400, {"error": "The request must be a JSON object"})
+        model = str(request.get("model", "1"))
+        if model not in MODELS:
+            return self.reply(400, {"error": "Unknown model {}, use 0 for Boolean, 1 for Vector or 2 for BM25".format(model)})
+        try:
+            k = int(request.get("k", 10))
+            limit = int(request["limit"]) if request.get("limit") is not None else None
+            offset = int(request.get("offset", 0))
+            snippets = bool(int(request.get("snippets", 0)))
+        except ValueError:
+            return self.reply(400, {"error": "k, limit, offset and snippets must be integers"})
+
+        service = self.server.service
+        try:
+            if "queries" in request:
+                return self.reply(200, service.searchBatch(request["queries"], model, k, snippets))
+            if "query" not in request:
+                return self.reply(400, {"error": "Missing query"})
+            self.reply(200, service.search(request["query"], model, k, limit, offset, snippets))
+        except (KeyError, TypeError, AttributeError) as e:
+            self.reply(400, {"error": "Malformed request: {}".format(e)})
+        except Exception as e:
+            # Any other failure is answered too, rather than dropping the connection
+            self.log_error("Error answering %r: %r", request, e)
+            self.reply(500, {"error": "Internal error: {!r}".format(e)})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class SearchServer(ThreadingMixIn, HTTPServer):
+    ''' an HTTP server handling each connection in its own thread'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, verbose=False):
+        HTTPServer.__init__(self, address, SearchHandler)
+        self.service = service
+        self.verbose = verbose
+
+def serve():
+    ''' load the index and the collection, then answer queries until interrupted'''
+    parser = argparse.ArgumentParser(description="Serve queries against index_file over HTTP")
+    parser.add_argument("index_file")
+    parser.add_argument("--collection", default="cran.all", help="the collection the results are taken from, when the index has no document store")
+    parser.add_argument("--format", default="cranfield", help="the format of the collection file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--strategy", choices=["exhaustive", "wand", "impact"], default="exhaustive",
+                        help="top K evaluation of the Vector model: exhaustive scoring, WAND dynamic pruning or score-at-a-time on impact-ordered postings")
+    parser.add_argument("--cache-size", type=int, default=1000, help="the number of query results cached, 0 to disable the cache")
+    parser.add_argument("--spell", action="store_true", help="correct the spelling of the query words missing from the index")
+    parser.add_argument("--fields", type=parseFieldWeights, metavar="FIELD=WEIGHT,...",
+                        help="the fields searched by the query words and their weights, e.g. title=2,body=1")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+    if args.fields is not None and args.strategy != "exhaustive":
+        parser.error("--fields is only supported with --strategy exhaustive")
+
+    invertedIndex = InvertedIndex()
+    invertedIndex.load(args.index_file)
+
+    collection = loadDocumentStore(args.index_file)
+    if collection is None:
+        collection = Collection()
+        for doc in readCorpus(args.collection, args.format):
+            collection.add(doc.docID, doc)
+
+    server = SearchServer((args.host, args.port), SearchService(invertedIndex, collection, args.strategy, args.cache_size, args.spell, args.fields), args.verbose)
+    print("Serving {} documents on http://{}:{}".format(invertedIndex.nDocs, args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def test():
+    ''' non-ASCII queries, over GET and POST, are answered like any other query'''
+    import threading
+    from doc import Document
+    try:
+        from urllib2 import urlopen, Request
+        from urllib import quote
+    except ImportError:
+        from urllib.request import urlopen, Request
+        from urllib.parse import quote
+
+    index = InvertedIndex()
+    collection = Collection()
+    for docid, body in enumerate([u"la m\u00e9thode des caract\u00e9ristiques", u"heat transfer"], 1):
+        doc = Document(str(docid), "", "", body)
+        index.indexDoc(doc)
+        collection.add(doc.docID, doc)
+    index.sort()
+    index.computeStatistics()
+
+    server = SearchServer(("127.0.0.1", 0), SearchService(index, collection))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/search".format(server.server_address[1])
+    try:
+        for query in [u"m\u00e9thode", u"M\u00c9THODE caract\u00e9ristiques", u"\u00fcber", u"\ud55c\uad6d\uc5b4"]:
+            for request in [Request(url + "?q=" + quote(query.encode("utf-8")) + "&model=0"),
+                            Request(url, json.dumps({"query": query, "model": "1", "k": 1}).encode("utf-8"), {"Content-Type": "application/json"})]:
+                response = json.loads(urlopen(request).read().decode("utf-8"))
+                results = [result if isinstance(result, int) else result["docID"] for result in response["results"]]
+                assert results == ([1] if u"m\u00e9thode" in query.lower() else []), (query, response)
+    finally:
+        server.shutdown()
+        server.server_close()
+    print("Pass")
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,322 @@
+'''
+document-partitioned index: shards by docID range, queried by a scatter-gather coordinator
+
+    python shards.py build cran.all index_prefix 4 [--workers 4] [--memory-budget MB]
+    python shards.py query index_prefix 1 query.text batch [-k 10] [--processes]
+
+    the collection is split into N contiguous docID ranges of about the same number of documents. Each
+    shard is indexed on its own, as SPIMI blocks (spimi.py), then the document frequencies of all the
+    shards are merged into the statistics of the whole collection, saved as index_prefix.stats: nDocs,
+    the average document lengths and the document frequency of every term. Each shard is finally merged
+    into its index file, index_prefix.0, index_prefix.1, ..., with the IDFs, document norms and
+    average lengths of the whole collection, so that every shard scores its documents exactly like the
+    unsharded index does.
+
+    a ShardCoordinator sends each query to all the shards, in-process or in one worker process per shard,
+    and merges their results: the top k of the Vector and BM25 models are the best of the shards' top k,
+    and the Boolean docIDs are concatenated in shard order, since the docID ranges are disjoint and increasing.
+    Sharded results are identical to those of the unsharded index, except with spelling correction, which
+    is not supported as each shard only records its own vocabulary
+'''
+
+import os
+import heapq
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+from util import Analyzer
+from corpus import readCorpus, READERS
+from indexfile import IndexWriter, IndexFile
+from index import InvertedIndex, IndexItem, inverseDocumentFrequency, averageLength, BODY
+from spimi import writeBlocks, mergeBlocks, mergeTerms
+from query import QueryProcessor, printVectorResults, parseFieldWeights
+from cranqry import loadCranQry
+
+STATS_SUFFIX = ".stats"
+DEFAULT_BUDGET = 256 * 1024 * 1024 # the memory budget of the blocks of a shard, in bytes
+
+def statsFilename(prefix):
+    return prefix + STATS_SUFFIX
+
+def shardFilename(prefix, shardNo):
+    return "{}.{}".format(prefix, shardNo)
+
+def docIDRanges(docids, n):
+    ''' split the docIDs into at most n contiguous (first, last) ranges of about the same number of documents'''
+    docids = sorted(set(docids))
+    size = max((len(docids) + n - 1) // n, 1)
+    return [(docids[i], docids[min(i + size, len(docids)) - 1]) for i in range(0, len(docids), size)]
+
+class CollectionStatistics:
+    ''' the statistics of the whole collection shared by its shards: the number of documents, the average
+        document length of each field, and the document frequency of each term, a dict when collected and a
+        memory-mapped StringMap when loaded'''
+
+    def __init__(self, nDocs, averageLengths, frequencies, shards=(), source=None):
+        self.nDocs = nDocs
+        self.averageLengths = averageLengths
+        self.frequencies = frequencies
+        self.shards = shards # the {"file", "first", "last", "docs"} of each shard, in docID order
+        self.source = source
+
+    def df(self, term):
+        ''' the number of documents of the collection containing a term, 0 if none'''
+        df = self.frequencies.get(term)
+        return int(df) if df is not None else 0
+
+    def averageLength(self, field=BODY):
+        return self.averageLengths.get(field, 0.0)
+
+    def save(self, filename):
+        writer = IndexWriter(filename)
+        writer.close({"nDocs": self.nDocs, "avgdl": self.averageLengths, "shards": list(self.shards)}, {},
+                     {b"DF": dict([(term, str(df)) for term, df in self.frequencies.items()])})
+
+    @staticmethod
+    def load(filename):
+        source = IndexFile(filename)
+        return CollectionStatistics(source.meta["nDocs"], source.meta["avgdl"], source.stringMap(b"DF"), source.meta["shards"], source)
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+def collectStatistics(shardBlocks):
+    ''' merge the blocks of all the shards into the CollectionStatistics of the whole collection'''
+    blocks = [IndexFile(blockFile) for blockFiles in shardBlocks for blockFile in blockFiles]
+    try:
+        nDocs = sum([block.meta["nDocs"] for block in blocks])
+        totals = {}
+        for block in blocks:
+            for field, total in block.meta["lengths"].items():
+                totals[field] = totals.get(field, 0) + total
+        frequencies = {}
+        for term, entries in mergeTerms(blocks):
+            frequencies[term] = sum([blocks[blockNo].record(i)[1] for blockNo, i in entries])
+        return CollectionStatistics(nDocs, dict([(field, averageLength([total], nDocs)) for field, total in totals.items()]), frequencies)
+    finally:
+        for block in blocks:
+            block.close()
+
+### BUILDING ###
+
+def indexShard(job):
+    ''' index the documents of one docID range into SPIMI blocks, in a worker process;
+        return the block filenames, the number of documents and the recorded vocabulary'''
+    collection, format, first, last, directory, memory_budget = job
+    os.mkdir(directory)
+    analyzer = Analyzer(record=True)
+    docs = (doc for doc in readCorpus(collection, format) if first <= int(doc.docID) <= last)
+    blockFiles, nDocs = writeBlocks(docs, analyzer, directory, memory_budget)
+    return blockFiles, nDocs, analyzer.vocabulary
+
+def finalizeShard(job):
+    ''' merge the blocks of one shard into its index file, with the statistics of the whole collection'''
+    blockFiles, filename, vocabulary, stats_file, meta = job
+    analyzer = Analyzer(record=True)
+    analyzer.vocabulary = vocabulary
+    collection = CollectionStatistics.load(stats_file)
+    try:
+        mergeBlocks(blockFiles, filename, analyzer, collection, {"shard": meta})
+    finally:
+        collection.close()
+
+def buildShards(collection, prefix, n, format="cranfield", workers=1, memory_budget=DEFAULT_BUDGET):
+    ''' index a collection into n shards by docID range, see the module documentation. Return the CollectionStatistics'''
+    ranges = docIDRanges([int(doc.docID) for doc in readCorpus(collection, format)], n)
+    tmpdir = tempfile.mkdtemp(prefix="shards", dir=os.path.dirname(os.path.abspath(prefix)))
+    pool = multiprocessing.Pool(min(workers, len(ranges))) if workers > 1 else None
+    run = pool.map if pool is not None else map
+    try:
+        # Each shard is indexed independently
+        indexed = list(run(indexShard, [(collection, format, first, last, os.path.join(tmpdir, "shard{}".format(shardNo)), memory_budget)
+                                        for shardNo, (first, last) in enumerate(ranges)]))
+
+        # The statistics of the whole collection, shared by all the shards
+        statistics = collectStatistics([blockFiles for blockFiles, _, _ in indexed])
+        statistics.shards = [{"file": os.path.basename(shardFilename(prefix, shardNo)), "first": first, "last": last, "docs": nDocs}
+                             for shardNo, ((first, last), (_, nDocs, _)) in enumerate(zip(ranges, indexed))]
+        statistics.save(statsFilename(prefix))
+
+        list(run(finalizeShard, [(blockFiles, shardFilename(prefix, shardNo), vocabulary, statsFilename(prefix), shard)
+                                 for shardNo, ((blockFiles, _, vocabulary), shard) in enumerate(zip(indexed, statistics.shards))]))
+        return statistics
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(tmpdir)
+
+### QUERYING ###
+
+class ShardIndex(InvertedIndex):
+    ''' the index file of one shard, which finds the terms indexed in other shards only with an empty
+        posting list and their IDF in the whole collection, so that the query vectors and the Boolean
+        ANDs are the same as with the unsharded index'''
+
+    def __init__(self, collection):
+        InvertedIndex.__init__(self)
+        self.collection = collection
+
+    def find(self, term):
+        item = InvertedIndex.find(self, term)
+        if item == "None":
+            df = self.collection.df(term)
+            if df:
+                item = IndexItem(term)
+                item.idf = inverseDocumentFrequency(self.collection.nDocs, df)
+                self.decoded.put(term, item)
+        return item
+
+    def docFrequency(self, term):
+        return self.collection.df(term)
+
+def searchShard(index, text, model, k, limit, strategy="exhaustive", fields=None):
+    ''' evaluate a query on one shard: return its preprocessed terms and its results,
+        the first limit docIDs for the Boolean model, the top k (docID, score) pairs otherwise'''
+    queryProcessor = QueryProcessor(text, index, None, strategy, fields=fields)
+    terms = queryProcessor.preprocessing()[0]
+    if model == "0":
+        if queryProcessor.hasOperators():
+            return terms, list(queryProcessor.expressionQuery(limit, 0))
+        return terms, list(queryProcessor.booleanQuery(terms)[:limit])
+    if model == "2":
+        return terms, queryProcessor.bm25Query(terms, k)
+    return terms, queryProcessor.vectorQuery(terms, k, 0)
+
+def openShard(directory, shard, stats_file):
+    collection = CollectionStatistics.load(stats_file)
+    index = ShardIndex(collection)
+    index.load(os.path.join(directory, shard["file"]))
+    return index
+
+class LocalShard:
+    ''' a shard searched in the coordinator's process'''
+
+    def __init__(self, directory, shard, stats_file, strategy, fields):
+        self.index = openShard(directory, shard, stats_file)
+        self.options = (strategy, fields)
+
+    def send(self, request):
+        self.request = request
+
+    def receive(self):
+        return searchShard(self.index, *(self.request + self.options))
+
+    def close(self):
+        self.index.close()
+        self.index.collection.close()
+
+def serveShard(connection, directory, shard, stats_file, strategy, fields):
+    ''' the loop of a shard worker process: answer requests until None is received'''
+    index = openShard(directory, shard, stats_file)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        connection.send(searchShard(index, *(request + (strategy, fields))))
+    index.close()
+    connection.close()
+
+class ShardProcess:
+    ''' a shard searched by a worker process, through a pipe'''
+
+    def __init__(self, directory, shard, stats_file, strategy, fields):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serveShard, args=(child, directory, shard, stats_file, strategy, fields))
+        self.process.daemon = True
+        self.process.start()
+
+    def send(self, request):
+        self.connection.send(request)
+
+    def receive(self):
+        return self.connection.recv()
+
+    def close(self):
+        self.connection.send(None)
+        self.process.join()
+
+class ShardCoordinator:
+    ''' fans the queries out to the shards of a sharded index and merges their results'''
+
+    def __init__(self, prefix, processes=False, strategy="exhaustive", fields=None):
+        ''' with processes, each shard is searched by a worker process; strategy and fields are those of QueryProcessor'''
+        self.statistics = CollectionStatistics.load(statsFilename(prefix))
+        directory = os.path.dirname(os.path.abspath(prefix))
+        Shard = ShardProcess if processes else LocalShard
+        self.shards = [Shard(directory, shard, statsFilename(prefix), strategy, fields) for shard in self.statistics.shards]
+
+    def search(self, text, model="1", k=10, limit=None, offset=0):
+        ''' evaluate one query on all the shards; returns the preprocessed terms and the merged results'''
+        # The shards answer in parallel: all the requests are sent before the first result is read
+        for shard in self.shards:
+            shard.send((text, model, k, offset + limit if limit is not None else None))
+        results = [shard.receive() for shard in self.shards]
+        terms = results[0][0] if results else []
+
+        if model == "0":
+            docids = [docid for _, shard_docids in results for docid in shard_docids]
+            return terms, docids[offset:offset + limit if limit is not None else None]
+        # Highest score first, ties broken by the lower docID, as within a shard
+        return terms, heapq.nlargest(k, [pair for _, pairs in results for pair in pairs], key=lambda elem : (elem[1], -elem[0]))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.statistics.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query an index sharded by docID range")
+    commands = parser.add_subparsers(dest="command")
+
+    build = commands.add_parser("build", help="index a collection into N shards")
+    build.add_argument("collection")
+    build.add_argument("index_prefix", help="the shards are saved as index_prefix.0, index_prefix.1, ... and index_prefix.stats")
+    build.add_argument("shards", type=int)
+    build.add_argument("--format", choices=sorted(READERS), default="cranfield", help="format of the collection file")
+    build.add_argument("--workers", type=int, default=1, help="number of processes indexing the shards")
+    build.add_argument("--memory-budget", type=float, default=DEFAULT_BUDGET / (1024 * 1024),
+                       help="the MB of postings a shard holds in memory before flushing a block")
+
+    search = commands.add_parser("query", help="process the queries of query_text against the shards")
+    search.add_argument("index_prefix")
+    search.add_argument("processing_algorithm", choices=["0", "1", "2"], help="0 for Boolean, 1 for Vector and 2 for BM25")
+    search.add_argument("query_text")
+    search.add_argument("query_id", help="a query ID of query_text, or batch to process all queries")
+    search.add_argument("-k", type=int, default=10, help="the number of results of the Vector and BM25 models")
+    search.add_argument("--processes", action="store_true", help="search each shard in its own worker process")
+    search.add_argument("--strategy", choices=["exhaustive", "wand"], default="exhaustive",
+                        help="top K evaluation of the Vector model: exhaustive scoring or WAND dynamic pruning")
+    search.add_argument("--fields", type=parseFieldWeights, metavar="FIELD=WEIGHT,...",
+                        help="the fields searched by the query words and their weights, e.g. title=2,body=1")
+    args = parser.parse_args()
+    if args.command == "query" and args.fields is not None and args.strategy != "exhaustive":
+        parser.error("--fields is only supported with --strategy exhaustive")
+
+    if args.command == "build":
+        statistics = buildShards(args.collection, args.index_prefix, args.shards, args.format, args.workers, int(args.memory_budget * 1024 * 1024))
+        for shard in statistics.shards:
+            print("Shard {}: docIDs {} to {}, {} documents".format(shard["file"], shard["first"], shard["last"], shard["docs"]))
+        print("Total documents indexed: {}".format(statistics.nDocs))
+        print('Done')
+        return
+
+    qrys = loadCranQry(args.query_text)
+    query_Ids = sorted([int(queryId) for queryId in qrys]) if args.query_id == "batch" else [args.query_id]
+    coordinator = ShardCoordinator(args.index_prefix, args.processes, args.strategy, args.fields)
+    try:
+        for queryId in query_Ids:
+            terms, results = coordinator.search(qrys[str(queryId)].text, args.processing_algorithm, args.k)
+            if args.processing_algorithm != "0":
+                printVectorResults(queryId, results)
+            elif results or args.query_id != "batch":
+                print("QueryID: {}\t#Docs: {}\tDocIDs: {}".format(queryId, len(results), results))
+    finally:
+        coordinator.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+query-biased snippets of the search results
+
+    the positions of a body term in the index count the tokens of the body left after stopword removal,
+    from 1. The positions of the query terms in a result document, read from its postings, are enough to
+    pick the window of WINDOW consecutive positions matching the most distinct query terms, then the most
+    occurrences; the body is only tokenized again to map that window back to the raw text, with
+    util.tokenSpans, and to highlight the matching words
+'''
+
+from util import tokenSpans
+
+WINDOW = 12 # indexed positions in a snippet
+HIGHLIGHT = ("<b>", "</b>")
+ELLIPSIS = "..."
+PUNCTUATION = "/,'.()=+-*" # stripped from the ends of the tokens, left out of the highlight
+
+def bestWindow(matches, window=WINDOW):
+    ''' the first and last positions of the window of window positions with the most distinct terms,
+        then the most matches, the earliest on ties; matches is a sorted list of (position, term)'''
+    best, best_span = None, None
+    counts = {}
+    first = 0
+    for last in range(len(matches)):
+        counts[matches[last][1]] = counts.get(matches[last][1], 0) + 1
+        while matches[last][0] - matches[first][0] >= window:
+            term = matches[first][1]
+            counts[term] -= 1
+            if counts[term] == 0:
+                del counts[term]
+            first += 1
+        score = (len(counts), last - first + 1)
+        if best is None or score > best:
+            best, best_span = score, (matches[first][0], matches[last][0])
+    return best_span
+
+def snippet(text, matches, analyzer, window=WINDOW, highlight=HIGHLIGHT):
+    ''' the best window of a document body, given the sorted (position, term) matches of the query terms,
+        with the matching words highlighted; the beginning of the body if nothing matches'''
+    if matches:
+        first, last = bestWindow(matches, window)
+        # Center the matches in the window
+        start = max(first - (window - (last - first + 1)) // 2, 1)
+    else:
+        start = 1
+    end = start + window - 1
+    matched = set([position for position, _ in matches])
+
+    # Number the raw tokens like the indexer: the stopwords take no position, and go with the window
+    # when they follow one of its positions, or precede the first one
+    spans = [] # the (start, end) of the highlighted words
+    position = 0
+    begin = stop = None
+    more = False
+    for token_start, token_end, token in tokenSpans(text):
+        if analyzer.isStopWord(token):
+            anchor = position + 0.5
+        else:
+            position += 1
+            anchor = position
+        if anchor <= start - 1:
+            continue
+        if anchor > end:
+            more = True
+            break
+        if begin is None:
+            begin = token_start
+        stop = token_end
+        if anchor in matched:
+            word = text[token_start:token_end]
+            lead = len(word) - len(word.lstrip(PUNCTUATION))
+            spans.append((token_start + lead, token_start + len(word.rstrip(PUNCTUATION))))
+    if begin is None:
+        return ""
+
+    # The raw text of the window, highlighted, on a single line
+    parts = []
+    offset = begin
+    for span_start, span_end in spans:
+        parts.extend([text[offset:span_start], highlight[0], text[span_start:span_end], highlight[1]])
+        offset = span_end
+    parts.append(text[offset:stop])
+    result = " ".join("".join(parts).split())
+    if text[:begin].strip():
+        result = ELLIPSIS + " " + result
+    if more:
+        result = result + " " + ELLIPSIS
+    return result
+
+def positionMatches(index, terms, docid):
+    ''' the sorted (position, term) of the occurrences of the terms in a document, from its postings'''
+    matches = []
+    for term in terms:
+        item = index.find(term)
+        posting = item.get(docid) if item != "None" else None
+        if posting is not None:
+            matches.extend([(position, term) for position in posting.positions])
+    return sorted(matches)
@@ -0,0 +1,138 @@
+'''
+single-pass in-memory indexing (SPIMI) with a memory budget
+
+    documents are indexed into an in-memory InvertedIndex block; whenever the estimated size of the
+    block reaches the memory budget, the block is sorted and flushed to disk in the binary index format.
+    The blocks are then k-way merged term by term into the final index file:
+
+        pass 1  merge the document frequencies to compute the IDFs and the document norms
+        pass 2  merge the posting lists again and write them with their IDF and max weight
+
+    only one block, one merged posting list and the per-document norms are held in memory at a time,
+    and the resulting index file is identical to the one built in memory
+'''
+
+import os
+import heapq
+import shutil
+import tempfile
+
+from array import array
+from util import Analyzer
+from symspell import writeSpellIndex
+from impact import removeImpactIndex
+from docstore import removeDocumentStore
+from indexfile import IndexWriter, IndexFile
+from index import InvertedIndex, IndexItem, FieldStatistics, inverseDocumentFrequency, maxWeight, termField, fieldSections, BODY
+
+def flushBlock(block, filename):
+    ''' write a block sorted by term and docID, without statistics, along with the total length of its documents in each field'''
+    writer = IndexWriter(filename)
+    totals = {}
+    for term in sorted(block.items):
+        item = block.items[term]
+        item.sort()
+        writer.add(term, item.docids, item.tfs, item.positions, 0.0, 0.0)
+        totals[termField(term)] = totals.get(termField(term), 0) + sum(item.tfs)
+    writer.close({"nDocs": block.nDocs, "maxDocID": max([item.docids[-1] for item in block.items.values()] or [0]), "lengths": totals},
+                 {b"DOCIDS": block.docids})
+
+def _blockTerms(blockNo, blockFile):
+    for i, term in enumerate(blockFile.terms()):
+        yield term, blockNo, i
+
+def mergeTerms(blocks):
+    ''' k-way merge of the sorted term dictionaries of the blocks; yield (term, [(block, record index)])'''
+    merged = heapq.merge(*[_blockTerms(blockNo, blocks[blockNo]) for blockNo in range(len(blocks))])
+    term, entries = None, []
+    for next_term, blockNo, i in merged:
+        if next_term != term and entries:
+            yield term, entries
+            entries = []
+        term = next_term
+        entries.append((blockNo, i))
+    if entries:
+        yield term, entries
+
+def writeBlocks(docs, analyzer, directory, memory_budget):
+    ''' index a document stream into sorted blocks written to directory, flushing a block whenever the
+        memory budget is reached. Return the block filenames and the number of indexed documents'''
+    blockFiles = []
+    block = InvertedIndex(analyzer)
+    nDocs = 0
+    for doc in docs:
+        block.indexDoc(doc)
+        if block.memoryUsage() >= memory_budget:
+            blockFiles.append(os.path.join(directory, "block{}".format(len(blockFiles))))
+            flushBlock(block, blockFiles[-1])
+            nDocs += block.nDocs
+            block = InvertedIndex(analyzer)
+    if block.nDocs or not blockFiles:
+        blockFiles.append(os.path.join(directory, "block{}".format(len(blockFiles))))
+        flushBlock(block, blockFiles[-1])
+        nDocs += block.nDocs
+    return blockFiles, nDocs
+
+def mergeBlocks(blockFiles, filename, analyzer, collection=None, meta={}):
+    ''' merge sorted blocks into the index file filename, in two passes. When the blocks hold one shard of a
+        larger collection, collection gives the statistics of the whole collection (see shards.CollectionStatistics):
+        the IDFs, the document norms and the average lengths are then those of the whole collection instead of
+        those of the blocks. meta is added to the metadata of the index file'''
+    blocks = [IndexFile(blockFile) for blockFile in blockFiles]
+    try:
+        nDocs = sum([blockFile.meta["nDocs"] for blockFile in blocks])
+        if collection is not None:
+            nDocs = collection.nDocs
+
+        # Pass 1: document frequencies, IDFs, the sums of squared TF-IDF weights and the length of each document in each field
+        maxDocID = max([blockFile.meta["maxDocID"] for blockFile in blocks])
+        statistics = FieldStatistics(maxDocID)
+
+        for term, entries in mergeTerms(blocks):
+            if collection is not None:
+                idf = inverseDocumentFrequency(nDocs, collection.df(term))
+            else:
+                idf = inverseDocumentFrequency(nDocs, sum([blocks[blockNo].record(i)[1] for blockNo, i in entries]))
+            for blockNo, i in entries:
+                docids, tfs = blocks[blockNo].frequencies(i)
+                statistics.add(term, docids, tfs, idf)
+        fieldStats = statistics.fields(nDocs)
+        if collection is not None:
+            fieldStats = dict([(field, (norms, lengths, collection.averageLength(field))) for field, (norms, lengths, _) in fieldStats.items()])
+        docNorms, lengths, avgdl = fieldStats.pop(BODY)
+
+        # Pass 2: merge the posting lists into the final index
+        writer = IndexWriter(filename)
+        for term, entries in mergeTerms(blocks):
+            item = IndexItem(term)
+            for blockNo, i in entries:
+                item.extend(*blocks[blockNo].postings(i))
+            item.sort()
+            idf = inverseDocumentFrequency(nDocs, collection.df(term) if collection is not None else len(item.docids))
+            field = termField(term)
+            norms = docNorms if field == BODY else fieldStats[field][0]
+            writer.add(term, item.docids, item.tfs, item.positions, idf, maxWeight(item.docids, item.tfs, idf, norms))
+        fields, arrays = fieldSections(fieldStats)
+        docids = sorted([docid for blockFile in blocks for docid in blockFile.array(b"DOCIDS", 'i')])
+        arrays.update({b"DOCNORM": docNorms, b"DOCLEN": lengths, b"DOCIDS": array('i', docids)})
+        writer.close(dict(meta, nDocs=nDocs, avgdl=avgdl, fields=fields, analyzer=analyzer.config()),
+                     arrays, {b"VOCAB": analyzer.vocabulary})
+        writeSpellIndex(filename)
+        removeImpactIndex(filename)
+        removeDocumentStore(filename)
+    finally:
+        for blockFile in blocks:
+            blockFile.close()
+
+def spimiIndex(docs, filename, memory_budget, tmpdir=None):
+    ''' index a document stream into filename, keeping the in-memory block under memory_budget bytes.
+        Return the number of indexed documents and the number of blocks'''
+    analyzer = Analyzer(record=True) # shared by all blocks, recording the whole vocabulary
+    tmpdir = tempfile.mkdtemp(prefix="spimi", dir=tmpdir or os.path.dirname(os.path.abspath(filename)))
+
+    try:
+        blockFiles, nDocs = writeBlocks(docs, analyzer, tmpdir, memory_budget)
+        mergeBlocks(blockFiles, filename, analyzer)
+        return nDocs, len(blockFiles)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,187 @@
+'''
+spelling correction of query words with symmetric deletes (SymSpell)
+
+    the dictionary is the indexed vocabulary: the words of the documents before stemming, each weighted
+    by the document frequency of its stem. Every word is stored under all the strings obtained by deleting
+    up to MAX_DISTANCE characters from its first PREFIX_LENGTH characters. A misspelled word is corrected
+    by generating its own deletes the same way and checking the words stored under them with the
+    Damerau-Levenshtein distance, so that no insertion, replacement or transposition is ever generated
+
+    the correction index is written next to the index file, as index_file.spell, with the string map
+    sections of the binary index format. It is memory-mapped and binary searched in place on first use
+'''
+
+import os
+
+from util import LRUCache
+from indexfile import IndexWriter, IndexFile
+
+MAX_DISTANCE = 2    # the largest edit distance of a correction
+PREFIX_LENGTH = 7   # only the deletes of the first characters of a word are stored
+SUFFIX = ".spell"
+
+def deletes(word, max_distance):
+    ''' the strings obtained by deleting up to max_distance characters from word, including word itself'''
+    result = set([word])
+    edits = [word]
+    for _ in range(max_distance):
+        edits = set([edit[:i] + edit[i+1:] for edit in edits for i in range(len(edit))])
+        result.update(edits)
+    return result
+
+def editDistance(a, b, max_distance):
+    ''' the optimal string alignment distance between a and b (insertions, deletions, replacements and
+        transpositions of adjacent characters), or max_distance + 1 once it is known to be larger'''
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    # The common prefix and suffix never change the distance
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1-end] == b[-1-end]:
+        end += 1
+    a, b = a[start:len(a)-end], b[start:len(b)-end]
+    if not a or not b:
+        return len(a) + len(b)
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            current[j] = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + cost)
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                current[j] = min(current[j], previous2[j-2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+class SpellCorrector:
+    ''' corrects words to the closest dictionary word, preferring the most frequent among equally close words.
+        words maps each word to its weight, and deletes each delete to the space separated words stored
+        under it: dicts when built in memory, StringMaps when loaded from a correction index file'''
+
+    def __init__(self, words, deletes, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH, source=None):
+        self.words = words
+        self.deletes = deletes
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.source = source
+        self.corrections = LRUCache(10000)
+
+    def weight(self, word):
+        weight = self.words.get(word)
+        return int(weight) if weight is not None else None
+
+    def lookup(self, word):
+        ''' return (correction, edit distance), or None if no word is within max_distance'''
+        if self.weight(word) is not None:
+            return word, 0
+
+        best = None # (distance, -weight, word), the smallest is the best correction
+        seen = set()
+        for delete in deletes(word[:self.prefix_length], self.max_distance):
+            entry = self.deletes.get(delete)
+            if entry is None:
+                continue
+            for candidate in entry.split(" "):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = editDistance(word, candidate, best[0] if best is not None else self.max_distance)
+                if distance > self.max_distance:
+                    continue
+                suggestion = (distance, -self.weight(candidate), candidate)
+                if best is None or suggestion < best:
+                    best = suggestion
+        return (best[2], best[0]) if best is not None else None
+
+    def correct(self, word):
+        ''' return the correction of a word, or the word itself if it is known or has no close word'''
+        correction = self.corrections.get(word)
+        if correction is None:
+            suggestion = self.lookup(word)
+            correction = suggestion[0] if suggestion is not None else word
+            self.corrections.put(word, correction)
+        return correction
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+def buildCorrector(weights, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH):
+    ''' build an in-memory SpellCorrector from a word -> weight mapping'''
+    entries = {}
+    for word in sorted(weights):
+        for delete in deletes(word[:prefix_length], max_distance):
+            entries.setdefault(delete, []).append(word)
+    return SpellCorrector(dict(weights), dict([(delete, " ".join(words)) for delete, words in entries.items()]),
+                         max_distance, prefix_length)
+
+def spellFilename(index_file):
+    return index_file + SUFFIX
+
+def vocabularyWeights(indexFile):
+    ''' the word -> document frequency of its stem mapping of the vocabulary of an IndexFile'''
+    weights = {}
+    vocabulary = indexFile.stringMap(b"VOCAB")
+    for word, stem in (vocabulary.items() if vocabulary is not None else []):
+        i = indexFile.lookup(stem)
+        if i >= 0 and " " not in word:
+            weights[word] = indexFile.record(i)[1]
+    return weights
+
+def writeSpellIndex(index_file, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH):
+    ''' build the correction index of an index file, and write it next to it'''
+    indexFile = IndexFile(index_file)
+    try:
+        corrector = buildCorrector(vocabularyWeights(indexFile), max_distance, prefix_length)
+    finally:
+        indexFile.close()
+
+    writer = IndexWriter(spellFilename(index_file))
+    writer.close({"max_distance": max_distance, "prefix_length": prefix_length}, {},
+                 {b"WORDS": dict([(word, str(weight)) for word, weight in corrector.words.items()]), b"DELETES": corrector.deletes})
+
+def loadSpellIndex(index_file):
+    ''' memory-map the correction index written next to an index file, or return None if there is none'''
+    if not os.path.exists(spellFilename(index_file)):
+        return None
+    source = IndexFile(spellFilename(index_file))
+    return SpellCorrector(source.stringMap(b"WORDS"), source.stringMap(b"DELETES"),
+                          source.meta["max_distance"], source.meta["prefix_length"], source)
+
+def test():
+    ''' a common word beats a rare one at the same edit distance, with the document frequencies
+        of the in-memory index and of the correction index written next to the index file'''
+    import shutil
+    import tempfile
+    from doc import Document
+    from index import InvertedIndex
+
+    # "heat" is in three documents and "sheet" in one: "heet" is 1 edit away from both
+    index = InvertedIndex()
+    for docid, body in enumerate(["heat flux", "heat transfer", "heat of the wall", "a thin sheet"], 1):
+        index.indexDoc(Document(str(docid), "", "", body))
+    assert buildCorrector({"heat": 3, "sheet": 1}).correct("heet") == "heat"
+    assert index.spellCorrector().correct("heet") == "heat"
+
+    directory = tempfile.mkdtemp()
+    try:
+        index_file = os.path.join(directory, "index")
+        index.save(index_file)
+        loaded = InvertedIndex()
+        loaded.load(index_file)
+        corrector = loaded.spellCorrector()
+        assert corrector.weight("heat") == 3 and corrector.weight("sheet") == 1, (corrector.weight("heat"), corrector.weight("sheet"))
+        assert corrector.correct("heet") == "heat"
+        loaded.close()
+    finally:
+        shutil.rmtree(directory)
+    print("Pass")
+
+if __name__ == '__main__':
+    test()
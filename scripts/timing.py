@@ -0,0 +1,154 @@
+'''
+per-stage timing of the query path
+
+    a QueryTimer records the wall time spent in each stage of one query (tokenize, spell, stopwords,
+    stem, fetch, intersect, score, sort, ...) and counters such as the postings touched and the
+    candidates scored. QueryProcessor times its stages with the timer in its timer attribute, which is
+    NULL_TIMER unless profiling is enabled: its stages and counters do nothing, so that the
+    instrumentation costs a method call per stage when disabled.
+
+    a StageProfile collects the QueryTimers of many queries, and prints or dumps as JSON the
+    per-stage latency percentiles and histograms
+'''
+
+import json
+import time
+import cProfile
+import pstats
+
+STAGES = ["tokenize", "spell", "stopwords", "stem", "fetch", "intersect", "evaluate", "score", "sort"] # in query path order
+BUCKETS = [0.01, 0.1, 1.0, 10.0, 100.0] # histogram bucket upper bounds, in ms
+
+class Stage:
+    ''' context manager adding the wall time of a with block to a stage of a QueryTimer'''
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.stages[self.name] = self.timer.stages.get(self.name, 0.0) + time.time() - self.start
+        return False
+
+class QueryTimer:
+    ''' the stage wall times, in seconds, and counters of one query'''
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def total(self):
+        return sum(self.stages.values())
+
+class NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class NullTimer:
+    ''' the timer of queries that are not profiled: records nothing'''
+
+    enabled = False
+
+    def __init__(self):
+        self.null_stage = NullStage()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def count(self, name, n=1):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def percentile(values, p):
+    ''' the nearest-rank p-th percentile of a list of values'''
+    ordered = sorted(values)
+    return ordered[max(int(round(p / 100.0 * len(ordered))) - 1, 0)]
+
+def histogram(values):
+    ''' the number of values (in ms) falling in each bucket of BUCKETS, plus the values above the last bucket'''
+    counts = [0] * (len(BUCKETS) + 1)
+    for value in values:
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        counts[i] += 1
+    return counts
+
+class StageProfile:
+    ''' the QueryTimers of a run of queries, aggregated per stage'''
+
+    def __init__(self):
+        self.queries = [] # (queryId, model, QueryTimer)
+
+    def add(self, queryId, model, timer):
+        self.queries.append((queryId, model, timer))
+
+    def stageNames(self):
+        ''' the stages timed in any query, in query path order'''
+        names = set()
+        for _, _, timer in self.queries:
+            names.update(timer.stages)
+        return sorted(names, key=lambda name : (STAGES.index(name) if name in STAGES else len(STAGES), name))
+
+    def summary(self):
+        ''' {stage: {"queries", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms", "histogram"}} and the summed counters'''
+        stages = {}
+        for name in self.stageNames():
+            times = [1000 * timer.stages[name] for _, _, timer in self.queries if name in timer.stages]
+            stages[name] = {"queries": len(times), "mean_ms": sum(times) / len(times), "p50_ms": percentile(times, 50),
+                            "p90_ms": percentile(times, 90), "p99_ms": percentile(times, 99), "max_ms": max(times),
+                            "histogram": histogram(times)}
+        counts = {}
+        for _, _, timer in self.queries:
+            for name, n in timer.counts.items():
+                counts[name] = counts.get(name, 0) + n
+        return stages, counts
+
+    def report(self):
+        ''' print the per-stage latencies and histograms, and the counters per query'''
+        if not self.queries:
+            return
+        stages, counts = self.summary()
+        bounds = ["<={:g}".format(bound) for bound in BUCKETS] + [">{:g}".format(BUCKETS[-1])]
+        print("\n== Query stages ({} queries, times in ms) ==".format(len(self.queries)))
+        print("{:<10}\t{:>8}\t{:>8}\t{:>8}\t{:>8}\t{:>8}\t{}".format("stage", "mean", "p50", "p90", "p99", "max", "  ".join(bounds)))
+        for name in self.stageNames():
+            stage = stages[name]
+            print("{:<10}\t{:>8.3f}\t{:>8.3f}\t{:>8.3f}\t{:>8.3f}\t{:>8.3f}\t{}".format(name, stage["mean_ms"], stage["p50_ms"],
+                  stage["p90_ms"], stage["p99_ms"], stage["max_ms"], "  ".join(["{:>{}}".format(n, len(bound)) for n, bound in zip(stage["histogram"], bounds)])))
+        for name in sorted(counts):
+            print("{:<10}\t{:.1f} per query".format(name, float(counts[name]) / len(self.queries)))
+
+    def dump(self, filename):
+        ''' write the per-query stage times and counters, and the summary, as JSON'''
+        stages, counts = self.summary()
+        with open(filename, "w") as f:
+            json.dump({"buckets_ms": BUCKETS, "stages": stages, "counts": counts,
+                       "queries": [{"id": queryId, "model": model, "stages_ms": dict([(name, 1000 * seconds) for name, seconds in timer.stages.items()]),
+                                    "counts": timer.counts} for queryId, model, timer in self.queries]}, f, indent=2, sort_keys=True)
+
+def profileCall(filename, function, *args):
+    ''' run function(*args) under cProfile, save the statistics to filename and print the top functions'''
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(filename)
+        pstats.Stats(filename).sort_stats("cumulative").print_stats(20)
@@ -1,12 +1,157 @@
-
 '''
    utility functions for processing terms
 
     shared by both indexing and query processing
 '''
 
+import os
+import re
+import copy
+import threading
+
+from collections import OrderedDict
 from nltk.stem import PorterStemmer
 
+STOPWORDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stopwords")
+
+class LRUCache:
+    ''' a bounded mapping evicting the least recently used entry, with hit/miss counters.
+        Safe to share between threads'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                # Move the entry to the most recently used end
+                value = self.data.pop(key)
+                self.data[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.data:
+                self.data.pop(key)
+            elif len(self.data) >= self.capacity:
+                self.data.popitem(last=False)
+            self.data[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.data), "capacity": self.capacity}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+def loadStopWords(filename=STOPWORDS_FILE):
+    ''' read the stopwords file into a set'''
+    with open(filename, "r") as f:
+        return frozenset([line.strip() for line in f if line.strip()])
+
+class Analyzer:
+    ''' the text analysis pipeline: lowercase and split, remove stopwords, stem.
+
+        The stopword set is loaded once and stems are memoized in a bounded LRU cache.
+        An analyzer restored from an index also looks words up in the vocabulary -> stem
+        map recorded at indexing time, so query terms are stemmed exactly as indexed'''
+
+    STEMMERS = {"porter": PorterStemmer}
+
+    def __init__(self, stopwords=None, stemmer="porter", cache_size=50000, vocabulary=None, record=False):
+        ''' stopwords defaults to the stopwords file; vocabulary is a read-only word -> stem mapping;
+            with record, every word -> stem pair analyzed is kept in self.vocabulary for persistence;
+            queries are analyzed by queryView(), which records nothing'''
+        if stemmer not in self.STEMMERS:
+            raise ValueError("Unknown stemmer {}. Supported stemmers: {}".format(stemmer, ", ".join(sorted(self.STEMMERS))))
+        self.stopwords = frozenset(stopwords) if stopwords is not None else loadStopWords()
+        self.stemmer_name = stemmer
+        self.stemmer = self.STEMMERS[stemmer]()
+        self.cache_size = cache_size
+        self.stems = LRUCache(cache_size)
+        self.vocabulary = vocabulary if vocabulary is not None else {}
+        self.record = record
+        self.view = None
+
+    def config(self):
+        ''' the configuration persisted with an index'''
+        return {"stopwords": sorted(self.stopwords), "stemmer": self.stemmer_name, "cache_size": self.cache_size}
+
+    def queryView(self):
+        ''' the analyzer of the queries: a recording analyzer returns a view sharing its stopwords, stemmer
+            and vocabulary, with its own stem cache, that records nothing, so that query words never enter
+            the indexed vocabulary'''
+        if not self.record:
+            return self
+        if self.view is None:
+            view = copy.copy(self)
+            view.record = False
+            view.stems = LRUCache(self.cache_size)
+            self.view = view
+        return self.view
+
+    def tokenize(self, text):
+        return lowerCaseAndSplit(nativeText(text))
+
+    def isStopWord(self, word):
+        return word in self.stopwords
+
+    def stem(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = self.vocabulary.get(word)
+            if stem is None:
+                stem = nativeText(self.stemmer.stem(word.decode("utf-8") if str is bytes else word))
+                if self.record:
+                    self.vocabulary[word] = stem
+            self.stems.put(word, stem)
+        return stem
+
+    def analyzeTokens(self, tokens):
+        ''' remove stopwords and stem a token stream in a single pass'''
+        stopwords = self.stopwords
+        return [self.stem(token) for token in tokens if token not in stopwords]
+
+    def analyze(self, text):
+        ''' return the list of terms of a text'''
+        return self.analyzeTokens(self.tokenize(text))
+
+def nativeText(text):
+    ''' text as a native str, UTF-8 encoded under Python 2 and decoded under Python 3, whether it is
+        given encoded or decoded. All the analyzed text goes through it, so that the terms are always
+        native strs; invalid UTF-8 is replaced'''
+    if str is bytes:
+        if isinstance(text, str):
+            try:
+                text.decode("utf-8")
+                return text
+            except UnicodeDecodeError:
+                text = text.decode("utf-8", "replace")
+        return text.encode("utf-8")
+    return text.decode("utf-8", "replace") if isinstance(text, bytes) else text
+
+_default_analyzer = None
+
+def defaultAnalyzer():
+    ''' the shared Analyzer used by the module level functions below'''
+    global _default_analyzer
+    if _default_analyzer is None:
+        _default_analyzer = Analyzer()
+    return _default_analyzer
+
 def lowerCaseAndSplit(sentence):
     tokens = sentence.lower().strip().split()
     cleaned_tokens = []
@@ -19,19 +164,20 @@ def lowerCaseAndSplit(sentence):
 
     return cleaned_tokens
 
+def tokenSpans(sentence):
+    ''' yield the (start, end, token) of each token of lowerCaseAndSplit, start and end delimiting
+        the raw token in the sentence, punctuation included'''
+    for match in re.finditer(r"\S+", sentence):
+        token = match.group().lower().replace("'", "").strip("/,'.()=+-*")
+        if token != "":
+            yield match.start(), match.end(), token
+
 def isStopWord(word):
     ''' using the NLTK functions, return true/false'''
-    
-    # ToDo (Done)
-    list_of_stop_words = []
 
-    with open("stopwords", "r") as file:
-        data = file.readlines()
-
-        for line in data:
-            list_of_stop_words.append(line.strip())
-    
-    return True if word in list_of_stop_words else False
+    # ToDo (Done)
+    # The stopwords file is read once by the shared Analyzer
+    return defaultAnalyzer().isStopWord(word)
 
 def removeStopWords(words):
 
@@ -40,17 +186,18 @@ def removeStopWords(words):
     for word in words:
         if not isStopWord(word):
             list_without_stop_words.append(word)
-    
+
     return list_without_stop_words
 
 def stemming(words):
     ''' return the stem, using a NLTK stemmer. check the project description for installing and using it'''
 
     # ToDo (Done)
-    ps = PorterStemmer()
+    # The shared Analyzer keeps one PorterStemmer and memoizes the stems
+    analyzer = defaultAnalyzer()
     list_of_stemmed_words = []
-    
+
     for word in words:
-        list_of_stemmed_words.append(str(ps.stem(word)))
+        list_of_stemmed_words.append(analyzer.stem(word))
 
-    return list_of_stemmed_words
\ No newline at end of file
+    return list_of_stemmed_words